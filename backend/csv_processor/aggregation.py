@@ -0,0 +1,220 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import pandas as pd
+from django.conf import settings
+from .artifacts import artifact_path
+import logging
+
+logger = logging.getLogger(__name__)
+
+AGGREGATE_FUNCTIONS = ('sum', 'count', 'mean', 'min', 'max')
+METRIC_PATTERN = re.compile(r'\s*(\w+)\(([^()]*)\)\s*(?:,|$)')
+
+# How each partial column is merged with partials of the same group
+PARTIAL_MERGE = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+
+
+class AggregationError(ValueError):
+    pass
+
+
+def parse_metrics(spec: str) -> list:
+    """
+    Parse "sum(x),count(),mean(y)" into [('sum', 'x'), ('count', None), ('mean', 'y')].
+    """
+    metrics = []
+    position = 0
+    spec = spec or ''
+    while position < len(spec):
+        match = METRIC_PATTERN.match(spec, position)
+        if not match:
+            raise AggregationError(f"Cannot parse metrics near '{spec[position:]}'")
+        func, column = match.group(1).lower(), match.group(2).strip()
+        if func not in AGGREGATE_FUNCTIONS:
+            raise AggregationError(f"Unsupported aggregate '{func}', use one of {', '.join(AGGREGATE_FUNCTIONS)}")
+        if not column and func != 'count':
+            raise AggregationError(f"{func}() needs a column")
+        metrics.append((func, column or None))
+        position = match.end()
+    if not metrics:
+        raise AggregationError('At least one metric is required')
+    return metrics
+
+
+def metric_name(func: str, column: str) -> str:
+    return f"{func}({column or ''})"
+
+
+def partial_columns(metrics: list) -> dict:
+    """
+    Partial aggregates needed for the requested metrics, as
+    {partial_name: (partial_function, column)}. mean is carried as sum + count.
+    """
+    partials = {}
+    for func, column in metrics:
+        if func == 'mean':
+            partials[f"sum__{column}"] = ('sum', column)
+            partials[f"count__{column}"] = ('count', column)
+        elif func == 'count' and column is None:
+            partials['count__'] = ('size', None)
+        else:
+            partials[f"{func}__{column}"] = (func, column)
+    return partials
+
+
+class PartialAggregator:
+    """
+    Chunk-at-a-time group-by. Each chunk is reduced with a vectorized groupby
+    to one partial row per group; partials are merged as they accumulate.
+    When the number of distinct groups exceeds ``max_groups`` the merged
+    partials are hash-partitioned by key and spilled to ``spill_dir``, and
+    each partition is merged on its own at the end.
+    """
+
+    def __init__(self, group_by: list, metrics: list, spill_dir: str, max_groups: int, partitions: int):
+        self.group_by = group_by
+        self.metrics = metrics
+        self.partials = partial_columns(metrics)
+        self.numeric_columns = {column for func, column in metrics if func in ('sum', 'mean')}
+        self.spill_dir = spill_dir
+        self.max_groups = max_groups
+        self.partitions = partitions
+        self._pending = []
+        self._pending_rows = 0
+        self._spills = 0
+
+    def update(self, chunk: pd.DataFrame):
+        for column in self.numeric_columns:
+            chunk[column] = pd.to_numeric(chunk[column], errors='coerce')
+
+        grouped = chunk.groupby(self.group_by, dropna=False, sort=False)
+        named = {
+            name: (column, func)
+            for name, (func, column) in self.partials.items()
+            if func != 'size'
+        }
+        partial = grouped.agg(**named) if named else pd.DataFrame(index=grouped.size().index)
+        if 'count__' in self.partials:
+            partial['count__'] = grouped.size()
+
+        self._pending.append(partial)
+        self._pending_rows += len(partial)
+        if self._pending_rows > self.max_groups:
+            self._compact()
+
+    def _merge(self, frames: list) -> pd.DataFrame:
+        combined = pd.concat(frames)
+        merge = {name: PARTIAL_MERGE['count' if func == 'size' else func] for name, (func, _) in self.partials.items()}
+        return combined.groupby(level=list(range(len(self.group_by))), dropna=False, sort=False).agg(merge)
+
+    def _compact(self):
+        merged = self._merge(self._pending)
+        if len(merged) <= self.max_groups:
+            self._pending = [merged]
+            self._pending_rows = len(merged)
+            return
+
+        os.makedirs(self.spill_dir, exist_ok=True)
+        for partition, frame in self._partition(merged):
+            frame.to_pickle(os.path.join(self.spill_dir, f"part-{partition:03d}-{self._spills:05d}.pkl"))
+        self._spills += 1
+        self._pending = []
+        self._pending_rows = 0
+        logger.info(f"Aggregation spilled {len(merged)} groups to {self.spill_dir}")
+
+    def _partition(self, frame: pd.DataFrame):
+        keys = frame.index.to_frame(index=False)
+        buckets = pd.util.hash_pandas_object(keys, index=False).to_numpy() % self.partitions
+        for partition in range(self.partitions):
+            mask = buckets == partition
+            if mask.any():
+                yield partition, frame[mask]
+
+    def result(self) -> pd.DataFrame:
+        if not self._spills:
+            merged = self._merge(self._pending) if self._pending else None
+            return self._finalize(merged)
+
+        in_memory = dict(self._partition(self._merge(self._pending))) if self._pending else {}
+        results = []
+        for partition in range(self.partitions):
+            frames = [pd.read_pickle(path) for path in sorted(glob.glob(os.path.join(self.spill_dir, f"part-{partition:03d}-*.pkl")))]
+            if partition in in_memory:
+                frames.append(in_memory[partition])
+            if frames:
+                results.append(self._finalize(self._merge(frames)))
+        return pd.concat(results, ignore_index=True) if results else self._finalize(None)
+
+    def _finalize(self, merged) -> pd.DataFrame:
+        columns = self.group_by + [metric_name(func, column) for func, column in self.metrics]
+        if merged is None:
+            return pd.DataFrame(columns=columns)
+
+        result = merged.reset_index()
+        result.columns = self.group_by + list(merged.columns)
+        for func, column in self.metrics:
+            if func == 'mean':
+                result[metric_name(func, column)] = result[f"sum__{column}"] / result[f"count__{column}"]
+            elif func == 'count' and column is None:
+                result[metric_name(func, column)] = result['count__']
+            else:
+                result[metric_name(func, column)] = result[f"{func}__{column}"]
+        return result[columns]
+
+
+def file_version(db_file) -> str:
+    """
+    Identify the current content of a file for cache keys.
+    """
+    if db_file.content_hash:
+        return db_file.content_hash
+    stat = os.stat(db_file.file_path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def query_key(db_file, group_by: list, metrics: list) -> str:
+    payload = json.dumps([file_version(db_file), group_by, [list(metric) for metric in metrics]])
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def result_paths(file_path: str, key: str) -> dict:
+    return {
+        'data': artifact_path(file_path, f"agg-{key}.csv"),
+        'meta': artifact_path(file_path, f"agg-{key}.json"),
+        'spill': artifact_path(file_path, f"agg-{key}.spill"),
+    }
+
+
+def load_cached_result(file_path: str, key: str):
+    """
+    Return the metadata of a cached aggregate, or None.
+    """
+    paths = result_paths(file_path, key)
+    if not (os.path.exists(paths['meta']) and os.path.exists(paths['data'])):
+        return None
+    with open(paths['meta']) as meta:
+        return json.load(meta)
+
+
+def store_result(file_path: str, key: str, result: pd.DataFrame, meta: dict):
+    paths = result_paths(file_path, key)
+    result.to_csv(paths['data'] + '.tmp', index=False)
+    os.replace(paths['data'] + '.tmp', paths['data'])
+    with open(paths['meta'] + '.tmp', 'w') as output:
+        json.dump(meta, output)
+    os.replace(paths['meta'] + '.tmp', paths['meta'])
+    shutil.rmtree(paths['spill'], ignore_errors=True)
+
+
+def new_aggregator(file_path: str, key: str, group_by: list, metrics: list) -> PartialAggregator:
+    return PartialAggregator(
+        group_by,
+        metrics,
+        spill_dir=result_paths(file_path, key)['spill'],
+        max_groups=settings.CSV_AGGREGATE_MAX_GROUPS,
+        partitions=settings.CSV_AGGREGATE_SPILL_PARTITIONS,
+    )
@@ -3,4 +3,8 @@ from django.apps import AppConfig
 
 class CsvProcessorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'csv_processor'
\ No newline at end of file
+    name = 'csv_processor'
+
+    def ready(self):
+        # Connects the signals invalidating cached file records
+        from . import file_cache  # noqa: F401
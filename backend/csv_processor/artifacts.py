@@ -0,0 +1,40 @@
+import glob
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Derived artifacts (row index, range results, ...) live next to the CSV as
+# "<file_path>.<name>", so everything derived from a file can be found, shared
+# and removed through its path alone.
+
+
+def artifact_path(file_path: str, name: str) -> str:
+    """
+    Path of the artifact ``name`` derived from ``file_path``.
+    """
+    return f"{file_path}.{name}"
+
+
+def list_artifacts(file_path: str, pattern: str = '*') -> list:
+    if not file_path:
+        return []
+    return glob.glob(glob.escape(file_path) + '.' + pattern)
+
+
+def remove_artifacts(file_path: str, pattern: str = '*'):
+    """
+    Remove the artifacts derived from ``file_path`` (files and directories)
+    whose name matches the glob ``pattern``; all of them by default.
+    """
+    for path in list_artifacts(file_path, pattern):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not remove artifact {path}: {e}")
@@ -0,0 +1,121 @@
+import pandas as pd
+import psutil
+from django.conf import settings
+from .metrics import CHUNK_BYTES, CHUNK_DECISIONS, CHUNK_ROWS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Chunks are sized in bytes, not rows: the sizer measures how much memory a
+# parsed row takes (on a sample of each chunk) and picks the next chunk's
+# row count so it fits CSV_CHUNK_MEMORY_BUDGET. Before the first chunk the
+# width is estimated from the raw bytes per row at the start of the file.
+# The budget shrinks to a fraction of the memory still available to the
+# process (host or cgroup limit, whichever is lower), so chunks get smaller
+# under memory pressure instead of the worker being OOM-killed.
+
+SAMPLE_ROWS = 1000
+HINT_BYTES = 1024 * 1024
+CGROUP_MEMORY_MAX = '/sys/fs/cgroup/memory.max'
+CGROUP_MEMORY_CURRENT = '/sys/fs/cgroup/memory.current'
+
+
+def _cgroup_available():
+    """
+    Bytes left under the cgroup v2 memory limit, or None without a limit.
+    """
+    try:
+        with open(CGROUP_MEMORY_MAX) as limit_file:
+            limit = limit_file.read().strip()
+        if limit == 'max':
+            return None
+        with open(CGROUP_MEMORY_CURRENT) as current_file:
+            return int(limit) - int(current_file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def available_memory() -> int:
+    available = psutil.virtual_memory().available
+    cgroup_available = _cgroup_available()
+    if cgroup_available is not None:
+        available = min(available, cgroup_available)
+    return max(0, available)
+
+
+def raw_bytes_per_row(file_path: str, start: int = 0) -> float:
+    """
+    Average raw bytes per line in the first HINT_BYTES from ``start``.
+    """
+    with open(file_path, 'rb') as source:
+        source.seek(start)
+        sample = source.read(HINT_BYTES)
+    return len(sample) / max(1, sample.count(b'\n'))
+
+
+class ChunkSizer:
+    """
+    Chooses the number of rows of each chunk. With ``fixed_rows`` every
+    chunk has that many rows, as with a plain pandas chunksize.
+    """
+
+    def __init__(self, row_bytes_hint: float = None, fixed_rows: int = None, budget_bytes: int = None):
+        self.fixed_rows = fixed_rows
+        self.budget_bytes = budget_bytes or settings.CSV_CHUNK_MEMORY_BUDGET
+        self.bytes_per_row = row_bytes_hint * settings.CSV_CHUNK_PARSE_EXPANSION if row_bytes_hint else None
+        self.rows = None
+
+    def budget(self):
+        """
+        Returns:
+            Tuple of (budget_bytes, under_pressure)
+        """
+        headroom = int(available_memory() * settings.CSV_CHUNK_AVAILABLE_FRACTION)
+        if headroom < self.budget_bytes:
+            return headroom, True
+        return self.budget_bytes, False
+
+    def next_rows(self) -> int:
+        if self.fixed_rows:
+            return self.fixed_rows
+        budget, pressure = self.budget()
+        if not self.bytes_per_row:
+            rows, limit = settings.CSV_CHUNK_INITIAL_ROWS, 'initial'
+        else:
+            rows, limit = int(budget / self.bytes_per_row), 'pressure' if pressure else 'budget'
+        if rows < settings.CSV_CHUNK_MIN_ROWS:
+            rows, limit = settings.CSV_CHUNK_MIN_ROWS, 'min_rows'
+        elif rows > settings.CSV_CHUNK_MAX_ROWS:
+            rows, limit = settings.CSV_CHUNK_MAX_ROWS, 'max_rows'
+        if rows != self.rows:
+            CHUNK_DECISIONS.labels(limit=limit).inc()
+            if self.rows is not None:
+                logger.info(
+                    f"Chunk size {self.rows} -> {rows} rows ({limit}, {self.bytes_per_row or 0:.0f} bytes/row, "
+                    f"budget {budget} bytes)"
+                )
+            self.rows = rows
+        return rows
+
+    def observe(self, chunk: pd.DataFrame):
+        if not len(chunk):
+            return
+        sample = chunk.iloc[:SAMPLE_ROWS]
+        self.bytes_per_row = int(sample.memory_usage(index=False, deep=True).sum()) / len(sample)
+        CHUNK_ROWS.observe(len(chunk))
+        CHUNK_BYTES.observe(self.bytes_per_row * len(chunk))
+
+
+def read_chunks(source, sizer: ChunkSizer, **options):
+    """
+    Parse ``source`` with pandas.read_csv in chunks sized by ``sizer``. The
+    index runs on across chunks like with a pandas chunksize.
+    """
+    with pd.read_csv(source, iterator=True, **options) as reader:
+        while True:
+            try:
+                chunk = reader.get_chunk(sizer.next_rows())
+            except StopIteration:
+                return
+            sizer.observe(chunk)
+            yield chunk
@@ -0,0 +1,317 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .aggregation import file_version
+from .artifacts import artifact_path
+from . import row_index
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Diff of two uploaded files, run as Celery chords in two phases:
+#
+# 1. Both files are split into record-aligned byte ranges; each range task
+#    hashes its rows and writes them to one spill file per hash partition
+#    (by key columns, or by the whole row without a key).
+# 2. Each partition is small enough to diff in memory and is diffed by its
+#    own task: rows are joined on the key (or the row hash), repeated keys
+#    are paired in file order, so without a key this compares the row-hash
+#    multisets of both files.
+#
+# Values are compared as raw text. The result is a CSV next to file A with
+# one row per change (added, removed or modified, with the columns that
+# changed), paginated through its row index.
+
+CHANGE_TYPES = ('added', 'removed', 'modified')
+
+
+class DiffError(ValueError):
+    pass
+
+
+def diff_key(db_a, db_b, key_columns: list) -> str:
+    payload = json.dumps([str(db_a.id), file_version(db_a), str(db_b.id), file_version(db_b), key_columns])
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def result_paths(file_path: str, key: str) -> dict:
+    return {
+        'data': artifact_path(file_path, f"diff-{key}.csv"),
+        'meta': artifact_path(file_path, f"diff-{key}.json"),
+        'plan': artifact_path(file_path, f"diff-{key}.plan.json"),
+        'spill': artifact_path(file_path, f"diff-{key}.spill"),
+    }
+
+
+def _load_json(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path) as source:
+        return json.load(source)
+
+
+def _store_json(path: str, payload: dict):
+    with open(path + '.tmp', 'w') as output:
+        json.dump(payload, output)
+    os.replace(path + '.tmp', path)
+
+
+def load_result(file_path: str, key: str):
+    """
+    Metadata of a finished (or failed) diff, or None.
+    """
+    return _load_json(result_paths(file_path, key)['meta'])
+
+
+def remove_result(file_path: str, key: str):
+    paths = result_paths(file_path, key)
+    for name in ('data', 'meta', 'plan'):
+        if os.path.exists(paths[name]):
+            os.remove(paths[name])
+    row_index_path = artifact_path(paths['data'], row_index.ROW_INDEX_ARTIFACT)
+    if os.path.exists(row_index_path):
+        os.remove(row_index_path)
+    shutil.rmtree(paths['spill'], ignore_errors=True)
+
+
+def _plan_is_fresh(path: str) -> bool:
+    try:
+        return time.time() - os.path.getmtime(path) <= settings.CSV_DIFF_STALL_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def running_plan(file_path: str, key: str):
+    """
+    Plan of a diff that is being computed, or None when none was started
+    within CSV_DIFF_STALL_SECONDS.
+    """
+    path = result_paths(file_path, key)['plan']
+    return _load_json(path) if _plan_is_fresh(path) else None
+
+
+def _input_ranges(db_file) -> list:
+    """
+    Record-aligned byte ranges of a file for the partitioning tasks; one
+    range when the byte scanner cannot split the file's dialect.
+    """
+    parts = max(1, -(-db_file.file_size // settings.CSV_DISTRIBUTED_RANGE_BYTES))
+    if parts > 1 and row_index.needs_parser_count(db_file.file_path):
+        parts = 1
+    try:
+        return row_index.find_record_ranges(db_file.file_path, parts)
+    except row_index.IrregularQuotes as e:
+        logger.info(f"Diffing {db_file.id} as a single range: {e}")
+        return row_index.find_record_ranges(db_file.file_path, 1)
+
+
+def plan_diff(db_a, db_b, key_columns: list) -> dict:
+    """
+    Work plan of a diff, passed to every task of it.
+
+    Raises:
+        DiffError: A key column is missing from one of the files
+    """
+    columns_a, columns_b = list(db_a.columns or []), list(db_b.columns or [])
+    missing = [column for column in key_columns if column not in columns_a or column not in columns_b]
+    if missing:
+        raise DiffError(f"Key columns missing from one of the files: {', '.join(missing)}")
+
+    key = diff_key(db_a, db_b, key_columns)
+    total_bytes = db_a.file_size + db_b.file_size
+    partitions = max(settings.CSV_DIFF_MIN_PARTITIONS, -(-total_bytes // settings.CSV_DIFF_PARTITION_BYTES))
+    ranges = {side: [list(span) for span in _input_ranges(db_file)] for side, db_file in (('a', db_a), ('b', db_b))}
+
+    return {
+        'key': key,
+        'file_ids': {'a': str(db_a.id), 'b': str(db_b.id)},
+        'paths': {'a': db_a.file_path, 'b': db_b.file_path},
+        'columns': {'a': columns_a, 'b': columns_b},
+        'common': [column for column in columns_a if column in columns_b],
+        'output_columns': columns_a + [column for column in columns_b if column not in columns_a],
+        'key_columns': key_columns,
+        'partitions': int(partitions),
+        'ranges': ranges,
+        'result_paths': result_paths(db_a.file_path, key),
+    }
+
+
+def claim_plan(plan: dict) -> bool:
+    """
+    Store the plan unless the same diff is already running; the plan file
+    doubles as the lock against concurrent runs.
+
+    Returns:
+        True if the caller should run the diff
+    """
+    path = plan['result_paths']['plan']
+    if _plan_is_fresh(path):
+        return False
+    with open(path + '.tmp', 'w') as output:
+        json.dump(plan, output)
+    try:
+        if os.path.exists(path):
+            os.remove(path)  # stalled run
+        os.link(path + '.tmp', path)
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(path + '.tmp')
+    os.makedirs(plan['result_paths']['spill'], exist_ok=True)
+    return True
+
+
+def _spill_path(plan: dict, side: str, partition: int, range_index: int) -> str:
+    return os.path.join(plan['result_paths']['spill'], f"{side}-{partition:05d}-{range_index:05d}.csv")
+
+
+def _row_hashes(chunk: pd.DataFrame, columns: list) -> np.ndarray:
+    return pd.util.hash_pandas_object(chunk[columns], index=False).to_numpy()
+
+
+class DiffPartitioner:
+    """
+    Writes the rows of one byte range of one side to the spill file of their
+    hash partition. Chunks must hold raw text values.
+    """
+
+    def __init__(self, plan: dict, side: str, range_index: int):
+        self.plan = plan
+        self.side = side
+        self.range_index = range_index
+        self.rows = 0
+        self._spills = {}
+
+    def update(self, chunk: pd.DataFrame):
+        row_hash = _row_hashes(chunk, self.plan['common'])
+        if self.plan['key_columns']:
+            partition_hash = _row_hashes(chunk, self.plan['key_columns'])
+        else:
+            partition_hash = row_hash
+        chunk = chunk.assign(_row_hash=row_hash.astype(str))
+        partition_of = partition_hash % np.uint64(self.plan['partitions'])
+        for partition in np.unique(partition_of):
+            spill = self._spills.get(partition)
+            if spill is None:
+                spill = self._spills[partition] = open(
+                    _spill_path(self.plan, self.side, int(partition), self.range_index), 'w', newline=''
+                )
+            chunk[partition_of == partition].to_csv(spill, header=False, index=False)
+        self.rows += len(chunk)
+
+    def close(self):
+        for spill in self._spills.values():
+            spill.close()
+        self._spills = {}
+
+
+def _read_partition(plan: dict, side: str, partition: int) -> pd.DataFrame:
+    names = plan['columns'][side] + ['_row_hash']
+    frames = [
+        pd.read_csv(path, header=None, names=names, dtype=str, na_filter=False)
+        for path in sorted(glob.glob(os.path.join(plan['result_paths']['spill'], f"{side}-{partition:05d}-*.csv")))
+    ]
+    frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=names, dtype=str)
+    join_columns = plan['key_columns'] or ['_row_hash']
+    # Pair repeated keys in file order
+    return frame.assign(_occurrence=frame.groupby(join_columns, sort=False).cumcount())
+
+
+def diff_partition(plan: dict, partition: int) -> dict:
+    """
+    Diff one hash partition of both files and write its changes to
+    ``out-<partition>.csv`` in the spill directory (without header).
+
+    Returns:
+        Number of added, removed and modified rows
+    """
+    a = _read_partition(plan, 'a', partition)
+    b = _read_partition(plan, 'b', partition)
+    join_columns = (plan['key_columns'] or ['_row_hash']) + ['_occurrence']
+    joined = a[join_columns].assign(_hash_a=a['_row_hash'], _position_a=np.arange(len(a))).merge(
+        b[join_columns].assign(_hash_b=b['_row_hash'], _position_b=np.arange(len(b))),
+        on=join_columns, how='outer',
+    )
+    in_a, in_b = joined['_position_a'].notna(), joined['_position_b'].notna()
+
+    removed = a.iloc[joined.loc[in_a & ~in_b, '_position_a'].astype(np.int64)].assign(change='removed')
+    added = b.iloc[joined.loc[~in_a & in_b, '_position_b'].astype(np.int64)].assign(change='added')
+    paired = joined[in_a & in_b & (joined['_hash_a'] != joined['_hash_b'])]
+    old = a.iloc[paired['_position_a'].astype(np.int64)][plan['common']].reset_index(drop=True)
+    modified = b.iloc[paired['_position_b'].astype(np.int64)].reset_index(drop=True)
+    differs = (old != modified[plan['common']]).to_numpy()
+    modified = modified.assign(
+        change='modified',
+        changed_columns=[
+            ';'.join(column for column, changed in zip(plan['common'], row) if changed) for row in differs
+        ],
+    )
+
+    output = pd.concat([removed, added, modified], ignore_index=True)
+    output = output.reindex(columns=['change'] + plan['output_columns'] + ['changed_columns'])
+    output.to_csv(os.path.join(plan['result_paths']['spill'], f"out-{partition:05d}.csv"), header=False, index=False)
+    return {'added': len(added), 'removed': len(removed), 'modified': len(modified)}
+
+
+def finish_diff(plan: dict, counts: list) -> dict:
+    """
+    Concatenate the partition outputs into the result CSV and store the
+    result metadata.
+    """
+    paths = plan['result_paths']
+    columns = ['change'] + plan['output_columns'] + ['changed_columns']
+    with open(paths['data'] + '.tmp', 'w', newline='') as output:
+        pd.DataFrame(columns=columns).to_csv(output, index=False)
+        output.flush()
+        for partition in range(plan['partitions']):
+            with open(os.path.join(paths['spill'], f"out-{partition:05d}.csv")) as part:
+                shutil.copyfileobj(part, output)
+    os.replace(paths['data'] + '.tmp', paths['data'])
+
+    meta = {
+        'status': 'completed',
+        'key': plan['key'],
+        'file_ids': plan['file_ids'],
+        'key_columns': plan['key_columns'],
+        'columns': columns,
+        **{change: sum(part[change] for part in counts) for change in CHANGE_TYPES},
+    }
+    meta['total_changes'] = sum(meta[change] for change in CHANGE_TYPES)
+    _store_json(paths['meta'], meta)
+    os.remove(paths['plan'])
+    shutil.rmtree(paths['spill'], ignore_errors=True)
+    return meta
+
+
+def store_failure(plan: dict, error: str):
+    paths = plan['result_paths']
+    if os.path.exists(paths['meta']):
+        return
+    _store_json(paths['meta'], {'status': 'failed', 'key': plan['key'], 'error': error})
+    if os.path.exists(paths['plan']):
+        os.remove(paths['plan'])
+    shutil.rmtree(paths['spill'], ignore_errors=True)
+
+
+def diff_progress(plan: dict) -> dict:
+    """
+    Stage and completed fraction of a running diff, from the markers its
+    tasks leave in the spill directory.
+    """
+    spill = plan['result_paths']['spill']
+    partitions_done = len(glob.glob(os.path.join(spill, 'out-*.csv')))
+    if partitions_done:
+        return {'stage': 'diffing', 'progress': round(100.0 * partitions_done / plan['partitions'], 1)}
+    range_count = len(plan['ranges']['a']) + len(plan['ranges']['b'])
+    ranges_done = len(glob.glob(os.path.join(spill, 'range-*.done')))
+    return {'stage': 'partitioning', 'progress': round(100.0 * ranges_done / range_count, 1)}
+
+
+def mark_range_done(plan: dict, side: str, range_index: int):
+    open(os.path.join(plan['result_paths']['spill'], f"range-{side}-{range_index:05d}.done"), 'w').close()
@@ -0,0 +1,337 @@
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+# Per-column value distributions built during the ingest scan. Both sketches
+# keep a small JSON-serializable state that can be merged with the state of
+# another part of the file (range tasks, appended batches).
+
+
+class NumericHistogram:
+    """
+    Fixed-bin histogram. Bin edges come from the first sample; when later
+    values fall outside the covered range the bin width doubles (neighbouring
+    bins merge) until they fit, so memory stays at ``bins`` counters. Text
+    that does not parse as a number (a later chunk of a column whose first
+    chunk was numeric) is counted as ``coerced``, apart from nulls.
+    """
+
+    kind = 'numeric'
+
+    def __init__(self, bins: int):
+        self.bins = bins + bins % 2
+        self.low = None
+        self.width = None
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.minimum = None
+        self.maximum = None
+        self.count = 0
+        self.null_count = 0
+        self.coerced = 0
+
+    def update(self, series: pd.Series):
+        numbers = pd.to_numeric(series, errors='coerce')
+        coerced = 0
+        if not pd.api.types.is_numeric_dtype(series.dtype):
+            coerced = int((numbers.isna() & series.notna()).sum())
+            self.coerced += coerced
+        values = numbers.to_numpy(dtype=np.float64, na_value=np.nan)
+        finite = values[np.isfinite(values)]
+        self.null_count += len(values) - len(finite) - coerced
+        if not len(finite):
+            return
+
+        low, high = float(finite.min()), float(finite.max())
+        if self.low is None:
+            self.low = low
+            self.width = (high - low) / self.bins if high > low else max(abs(low), 1.0) / self.bins
+        self._cover(low, high)
+
+        positions = np.minimum(((finite - self.low) // self.width).astype(np.int64), self.bins - 1)
+        self.counts += np.bincount(positions, minlength=self.bins)
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else max(self.maximum, high)
+        self.count += len(finite)
+
+    def _cover(self, low: float, high: float):
+        half = self.bins // 2
+        while high >= self.low + self.width * self.bins:
+            merged = self.counts.reshape(half, 2).sum(axis=1)
+            self.counts = np.concatenate([merged, np.zeros(half, dtype=np.int64)])
+            self.width *= 2
+        while low < self.low:
+            merged = self.counts.reshape(half, 2).sum(axis=1)
+            self.counts = np.concatenate([np.zeros(half, dtype=np.int64), merged])
+            self.low -= self.width * self.bins
+            self.width *= 2
+            while high >= self.low + self.width * self.bins:
+                merged = self.counts.reshape(half, 2).sum(axis=1)
+                self.counts = np.concatenate([merged, np.zeros(half, dtype=np.int64)])
+                self.width *= 2
+
+    def merge(self, other: 'NumericHistogram'):
+        self.null_count += other.null_count
+        self.coerced += other.coerced
+        if other.low is None:
+            return
+        if self.low is None:
+            self.low, self.width, self.counts = other.low, other.width, other.counts.copy()
+        else:
+            self._cover(other.minimum, other.maximum)
+            centers = other.low + other.width * (np.arange(other.bins) + 0.5)
+            mask = other.counts > 0
+            positions = np.clip(((centers[mask] - self.low) // self.width).astype(np.int64), 0, self.bins - 1)
+            np.add.at(self.counts, positions, other.counts[mask])
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.count += other.count
+
+    def to_dict(self) -> dict:
+        return {
+            'kind': self.kind,
+            'bins': self.bins,
+            'low': self.low,
+            'width': self.width,
+            'counts': self.counts.tolist(),
+            'min': self.minimum,
+            'max': self.maximum,
+            'count': self.count,
+            'null_count': self.null_count,
+            'coerced': self.coerced,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'NumericHistogram':
+        histogram = cls(state['bins'])
+        histogram.low = state['low']
+        histogram.width = state['width']
+        histogram.counts = np.array(state['counts'], dtype=np.int64)
+        histogram.minimum = state['min']
+        histogram.maximum = state['max']
+        histogram.count = state['count']
+        histogram.null_count = state['null_count']
+        histogram.coerced = state.get('coerced', 0)
+        return histogram
+
+    def describe(self) -> dict:
+        """
+        Final histogram: empty outer bins are trimmed and the outer edges are
+        refined to the exact minimum and maximum.
+        """
+        bins = []
+        non_empty = np.flatnonzero(self.counts)
+        if len(non_empty):
+            first, last = int(non_empty[0]), int(non_empty[-1])
+            for position in range(first, last + 1):
+                start = self.low + self.width * position
+                end = start + self.width
+                bins.append({
+                    'start': self.minimum if position == first else start,
+                    'end': self.maximum if position == last else end,
+                    'count': int(self.counts[position]),
+                })
+        return {
+            'kind': self.kind,
+            'count': self.count,
+            'null_count': self.null_count,
+            'coerced': self.coerced,
+            'min': self.minimum,
+            'max': self.maximum,
+            'bins': bins,
+        }
+
+
+class TopKSketch:
+    """
+    Space-Saving summary of the most frequent values. Each chunk is reduced
+    with value_counts and merged into the summary with the mergeable
+    Space-Saving rule: a value missing from one side is credited with that
+    side's floor (the largest count it may have dropped), and only the top
+    ``capacity`` counters are kept.
+    """
+
+    kind = 'categorical'
+
+    def __init__(self, k: int, capacity: int = None):
+        self.k = k
+        self.capacity = capacity or k * 10
+        self.counts = pd.Series(dtype=np.int64)
+        self.errors = pd.Series(dtype=np.int64)
+        self.floor = 0
+        self.count = 0
+        self.null_count = 0
+
+    def update(self, series: pd.Series):
+        self.null_count += int(series.isna().sum())
+        values = series.dropna().astype(str)
+        self.count += len(values)
+        if not len(values):
+            return
+        value_counts = values.value_counts()
+        top = value_counts.iloc[:self.capacity]
+        floor = int(value_counts.iloc[self.capacity]) if len(value_counts) > self.capacity else 0
+        self._merge(top, pd.Series(0, index=top.index, dtype=np.int64), floor)
+
+    def _merge(self, counts: pd.Series, errors: pd.Series, floor: int):
+        index = self.counts.index.union(counts.index)
+        mine = self.counts.reindex(index)
+        theirs = counts.reindex(index)
+        merged_counts = mine.fillna(self.floor) + theirs.fillna(floor)
+        merged_errors = (
+            self.errors.reindex(index).fillna(0) + errors.reindex(index).fillna(0)
+            + mine.isna() * self.floor + theirs.isna() * floor
+        )
+        order = merged_counts.sort_values(ascending=False, kind='stable')
+        self.floor = max(self.floor + floor, int(order.iloc[self.capacity])) if len(order) > self.capacity else self.floor + floor
+        kept = order.index[:self.capacity]
+        self.counts = merged_counts[kept].astype(np.int64)
+        self.errors = merged_errors[kept].astype(np.int64)
+
+    def merge(self, other: 'TopKSketch'):
+        self.count += other.count
+        self.null_count += other.null_count
+        self._merge(other.counts, other.errors, other.floor)
+
+    def to_dict(self) -> dict:
+        return {
+            'kind': self.kind,
+            'k': self.k,
+            'capacity': self.capacity,
+            'values': self.counts.index.tolist(),
+            'counts': self.counts.tolist(),
+            'errors': self.errors.tolist(),
+            'floor': self.floor,
+            'count': self.count,
+            'null_count': self.null_count,
+        }
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'TopKSketch':
+        sketch = cls(state['k'], state['capacity'])
+        sketch.counts = pd.Series(state['counts'], index=state['values'], dtype=np.int64)
+        sketch.errors = pd.Series(state['errors'], index=state['values'], dtype=np.int64)
+        sketch.floor = state['floor']
+        sketch.count = state['count']
+        sketch.null_count = state['null_count']
+        return sketch
+
+    def describe(self) -> dict:
+        top = self.counts.sort_values(ascending=False, kind='stable').iloc[:self.k]
+        return {
+            'kind': self.kind,
+            'count': self.count,
+            'null_count': self.null_count,
+            'approximate': self.floor > 0,
+            'top': [
+                {'value': value, 'count': int(count), 'max_error': int(self.errors[value])}
+                for value, count in top.items()
+            ],
+        }
+
+
+class MixedColumn:
+    """
+    Column whose parts were sketched as different kinds, e.g. a range task
+    that saw numbers first merged with one that saw text first. Neither
+    sketch can be converted into the other, so only the counts are kept.
+    """
+
+    kind = 'mixed'
+
+    def __init__(self):
+        self.count = 0
+        self.null_count = 0
+
+    @classmethod
+    def of(cls, *sketches) -> 'MixedColumn':
+        mixed = cls()
+        for sketch in sketches:
+            mixed.merge(sketch)
+        return mixed
+
+    def update(self, series: pd.Series):
+        nulls = int(series.isna().sum())
+        self.null_count += nulls
+        self.count += len(series) - nulls
+
+    def merge(self, other):
+        # Coerced values of a histogram are values too
+        self.count += other.count + getattr(other, 'coerced', 0)
+        self.null_count += other.null_count
+
+    def to_dict(self) -> dict:
+        return {'kind': self.kind, 'count': self.count, 'null_count': self.null_count}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'MixedColumn':
+        mixed = cls()
+        mixed.count = state['count']
+        mixed.null_count = state['null_count']
+        return mixed
+
+    def describe(self) -> dict:
+        return self.to_dict()
+
+
+SKETCH_TYPES = {sketch.kind: sketch for sketch in (NumericHistogram, TopKSketch, MixedColumn)}
+
+
+class ColumnDistributionCollector:
+    """
+    Ingest collector building one sketch per column: a histogram for numeric
+    columns, a top-K table for everything else. Column kinds are decided on
+    the first chunk; see NumericHistogram for text in later chunks and
+    MixedColumn for merging parts of different kinds.
+    """
+
+    def __init__(self, bins: int = None, top_k: int = None):
+        self.bins = bins or settings.CSV_HISTOGRAM_BINS
+        self.top_k = top_k or settings.CSV_TOP_K_VALUES
+        self.sketches = {}
+
+    def update(self, chunk: pd.DataFrame):
+        if not self.sketches:
+            for column in chunk.columns:
+                dtype = chunk[column].dtype
+                numeric = pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                self.sketches[column] = NumericHistogram(self.bins) if numeric else TopKSketch(self.top_k)
+        for column, sketch in self.sketches.items():
+            sketch.update(chunk[column])
+
+    def merge(self, other: 'ColumnDistributionCollector') -> list:
+        """
+        Merge the sketches of ``other`` into these.
+        
+        Returns:
+            Columns whose sketches had different kinds and became MixedColumn
+        """
+        mixed = []
+        for column, sketch in other.sketches.items():
+            mine = self.sketches.get(column)
+            if mine is None:
+                self.sketches[column] = sketch
+            elif mine.kind == sketch.kind:
+                mine.merge(sketch)
+            else:
+                self.sketches[column] = MixedColumn.of(mine, sketch)
+                mixed.append(column)
+        return mixed
+
+    def to_dict(self) -> dict:
+        return {column: sketch.to_dict() for column, sketch in self.sketches.items()}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> 'ColumnDistributionCollector':
+        collector = cls()
+        collector.sketches = {
+            column: SKETCH_TYPES[sketch['kind']].from_dict(sketch)
+            for column, sketch in (state or {}).items()
+        }
+        return collector
+
+
+def describe_column(state: dict) -> dict:
+    """
+    Turn a persisted sketch state into the API representation.
+    """
+    return SKETCH_TYPES[state['kind']].from_dict(state).describe()
@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from .metrics import EXECUTOR_REJECTED, EXECUTOR_WAIT_SECONDS
+from .profiling import profiled
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Blocking endpoints (pandas parsing, file scans, upload and append copies)
+# are served by async views that hand the work to a bounded thread pool. The
+# event loop stays free for cheap requests, a saturated pool answers 503
+# instead of queueing without limit, and work still queued when the client
+# disconnects is dropped. Reads and writes have separate pools, so long
+# uploads cannot starve page requests.
+
+# Pool name -> (workers setting, queue setting)
+POOLS = {
+    'read': ('CSV_READ_EXECUTOR_WORKERS', 'CSV_READ_EXECUTOR_QUEUE'),
+    'write': ('CSV_WRITE_EXECUTOR_WORKERS', 'CSV_WRITE_EXECUTOR_QUEUE'),
+}
+
+
+class ExecutorSaturated(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool admitting at most ``workers + queue_size`` jobs at a time
+    (running plus waiting); submit raises ExecutorSaturated beyond that.
+    """
+
+    def __init__(self, workers: int, queue_size: int, name: str = 'read'):
+        self.workers = workers
+        self.limit = workers + queue_size
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'csv-{name}')
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def submit(self, func, *args, **kwargs):
+        with self._lock:
+            if self._in_flight >= self.limit:
+                raise ExecutorSaturated()
+            self._in_flight += 1
+        try:
+            future = self._pool.submit(func, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        # Also runs when a queued job is cancelled
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(pool: str = 'read') -> BoundedExecutor:
+    with _executors_lock:
+        executor = _executors.get(pool)
+        if executor is None:
+            workers_setting, queue_setting = POOLS[pool]
+            workers = getattr(settings, workers_setting)
+            queue_size = getattr(settings, queue_setting)
+            executor = _executors[pool] = BoundedExecutor(workers, queue_size, pool)
+            logger.info(f"{pool.capitalize()} executor started with {workers} threads, queue of {queue_size}")
+        return executor
+
+
+def get_read_executor() -> BoundedExecutor:
+    return get_executor('read')
+
+
+def reset_executors():
+    """
+    Drop the current executors so the next requests build them from settings.
+    """
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
+
+
+def _run_view(pool, view, request, args, kwargs, submitted_at):
+    EXECUTOR_WAIT_SECONDS.labels(pool=pool, endpoint=view.__name__).observe(time.perf_counter() - submitted_at)
+    close_old_connections()
+    try:
+        # ProfilingMiddleware cannot see into this thread; it leaves the
+        # requested mode on the request and the profile is taken here
+        label, mode = getattr(request, 'csv_profile', (None, None))
+        with profiled(label, mode) as session:
+            response = view(request, *args, **kwargs)
+            # Render DRF responses here rather than on the event loop
+            if callable(getattr(response, 'render', None)):
+                response = response.render()
+        if session is not None:
+            request.csv_profile_id = session.profile_id
+        return response
+    finally:
+        close_old_connections()
+
+
+def offloaded(view=None, *, pool: str = 'read'):
+    """
+    Turn a blocking view into an async view running it on the ``pool``
+    executor (``@offloaded`` for reads, ``@offloaded(pool='write')`` for
+    uploads and appends).
+    
+    Returns 503 with Retry-After when the executor is saturated. If the
+    request is cancelled (client disconnect under ASGI) before a thread picks
+    the job up, the job is dropped; a job already running finishes on its
+    thread but its response is discarded.
+    """
+    if view is None:
+        return functools.partial(offloaded, pool=pool)
+    
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            future = get_executor(pool).submit(_run_view, pool, view, request, args, kwargs, time.perf_counter())
+        except ExecutorSaturated:
+            EXECUTOR_REJECTED.labels(pool=pool, endpoint=view.__name__).inc()
+            logger.warning(f"{pool.capitalize()} executor saturated, rejecting {view.__name__}")
+            response = JsonResponse({'error': 'Server is busy, retry later'}, status=503)
+            response['Retry-After'] = str(settings.CSV_EXECUTOR_RETRY_AFTER)
+            return response
+        return await asyncio.wrap_future(future)
+    
+    return wrapper
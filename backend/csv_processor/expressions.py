@@ -0,0 +1,339 @@
+import ast
+import functools
+import numpy as np
+import pandas as pd
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Computed columns and row filters. Expressions use Python syntax, parsed
+# once with ast into a tree of vectorized operations on pandas Series:
+#
+#   price / quantity
+#   concat(first_name, " ", last_name)
+#   year(created) == 2024 and col("Unit Price") > 10
+#
+# Columns are referenced by name, or with col("...") when the name is not
+# an identifier. Only the operators and functions below are allowed: no
+# attribute access, subscripts, comprehensions or lambdas, so evaluating an
+# expression cannot run arbitrary code, and nothing is evaluated row by row.
+# Arithmetic works on numbers only (text is converted, unparsable values
+# become null); text is built with concat() and the string functions.
+
+BINARY_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+    ast.FloorDiv: lambda a, b: a // b,
+    ast.Mod: lambda a, b: a % b,
+    ast.Pow: lambda a, b: _power(a, b),
+}
+COMPARISONS = {
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+}
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+def _numeric(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values
+    return pd.to_numeric(values, errors='coerce')
+
+
+def _text(values: pd.Series) -> pd.Series:
+    return values.astype('string')
+
+
+def _dates(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, errors='coerce', format='mixed')
+
+
+def _boolean(values: pd.Series) -> pd.Series:
+    # Null is false in filters and boolean operators
+    if pd.api.types.is_bool_dtype(values) and not values.hasnans:
+        return values.astype(bool)
+    return values.fillna(False).astype(bool)
+
+
+def _power(base, exponent):
+    # In floats, so constant operands like 9 ** 9 ** 9 overflow to inf
+    # instead of building a huge Python integer
+    as_float = lambda value: value.astype('float64') if isinstance(value, pd.Series) else np.float64(value)
+    with np.errstate(over='ignore'):
+        return as_float(base) ** as_float(exponent)
+
+
+def _concat(*parts):
+    text = [_text(part) for part in parts]
+    return text[0].str.cat(text[1:], na_rep='') if len(text) > 1 else text[0].fillna('')
+
+
+def _round(values, digits=0):
+    return _numeric(values).round(int(digits.iloc[0]) if isinstance(digits, pd.Series) else int(digits))
+
+
+# name: (function of Series arguments, minimum arguments, maximum arguments)
+FUNCTIONS = {
+    'abs': (lambda x: _numeric(x).abs(), 1, 1),
+    'round': (_round, 1, 2),
+    'floor': (lambda x: np.floor(_numeric(x)), 1, 1),
+    'ceil': (lambda x: np.ceil(_numeric(x)), 1, 1),
+    'sqrt': (lambda x: np.sqrt(_numeric(x).where(_numeric(x) >= 0)), 1, 1),
+    'log': (lambda x: np.log(_numeric(x).where(_numeric(x) > 0)), 1, 1),
+    'number': (_numeric, 1, 1),
+    'text': (_text, 1, 1),
+    'concat': (_concat, 1, None),
+    'lower': (lambda x: _text(x).str.lower(), 1, 1),
+    'upper': (lambda x: _text(x).str.upper(), 1, 1),
+    'strip': (lambda x: _text(x).str.strip(), 1, 1),
+    'length': (lambda x: _text(x).str.len(), 1, 1),
+    'contains': (lambda x, part: _text(x).str.contains(part.iloc[0], regex=False), 2, 2),
+    'startswith': (lambda x, part: _text(x).str.startswith(part.iloc[0]), 2, 2),
+    'endswith': (lambda x, part: _text(x).str.endswith(part.iloc[0]), 2, 2),
+    'year': (lambda x: _dates(x).dt.year, 1, 1),
+    'month': (lambda x: _dates(x).dt.month, 1, 1),
+    'day': (lambda x: _dates(x).dt.day, 1, 1),
+    'weekday': (lambda x: _dates(x).dt.weekday, 1, 1),
+    'hour': (lambda x: _dates(x).dt.hour, 1, 1),
+    'date': (lambda x: _dates(x).dt.strftime('%Y-%m-%d'), 1, 1),
+    'isnull': (lambda x: x.isna(), 1, 1),
+    'notnull': (lambda x: x.notna(), 1, 1),
+    'coalesce': (lambda *values: functools.reduce(lambda a, b: a.combine_first(b), values), 2, None),
+    'where': (lambda condition, a, b: a.where(_boolean(condition), b), 3, 3),
+}
+# Functions whose later arguments must be literal text
+LITERAL_ARGUMENTS = {'contains', 'startswith', 'endswith', 'round'}
+
+
+class Expression:
+    """
+    A parsed expression: ``columns`` are the column names it reads,
+    ``evaluate(frame)`` computes it on a DataFrame holding them.
+    """
+
+    def __init__(self, text: str):
+        if len(text) > settings.CSV_EXPRESSION_MAX_LENGTH:
+            raise ExpressionError(f"Expression longer than {settings.CSV_EXPRESSION_MAX_LENGTH} characters")
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ExpressionError(f"Invalid expression: {e.msg}")
+        nodes = sum(1 for _ in ast.walk(tree))
+        if nodes > settings.CSV_EXPRESSION_MAX_NODES:
+            raise ExpressionError(f"Expression has more than {settings.CSV_EXPRESSION_MAX_NODES} terms")
+        self.text = text
+        self.columns = []
+        self._evaluate = self._compile(tree.body)
+
+    def _column(self, name: str):
+        if name not in self.columns:
+            self.columns.append(name)
+        return lambda frame: frame[name]
+
+    def _compile(self, node):
+        """
+        Turn an ast node into a function of the frame returning a Series
+        or a scalar.
+        """
+        if isinstance(node, ast.Constant):
+            if node.value is not None and not isinstance(node.value, (bool, int, float, str)):
+                raise ExpressionError(f"Unsupported literal {node.value!r}")
+            return lambda frame: node.value
+        if isinstance(node, ast.Name):
+            return self._column(node.id)
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            operator = BINARY_OPERATORS[type(node.op)]
+            left, right = self._compile(node.left), self._compile(node.right)
+            return lambda frame: operator(self._number(left(frame)), self._number(right(frame)))
+        if isinstance(node, ast.UnaryOp):
+            operand = self._compile(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda frame: -self._number(operand(frame))
+            if isinstance(node.op, ast.UAdd):
+                return lambda frame: self._number(operand(frame))
+            if isinstance(node.op, ast.Not):
+                return lambda frame: np.logical_not(self._condition(operand(frame)))
+        if isinstance(node, ast.BoolOp):
+            operands = [self._compile(value) for value in node.values]
+            if isinstance(node.op, ast.And):
+                return lambda frame: functools.reduce(
+                    lambda a, b: a & b, (self._condition(operand(frame)) for operand in operands)
+                )
+            return lambda frame: functools.reduce(
+                lambda a, b: a | b, (self._condition(operand(frame)) for operand in operands)
+            )
+        if isinstance(node, ast.Compare):
+            return self._compile_compare(node)
+        if isinstance(node, ast.Call):
+            return self._compile_call(node)
+        raise ExpressionError(f"Unsupported syntax: {ast.unparse(node)}")
+
+    def _compile_compare(self, node):
+        terms = [self._compile(term) for term in [node.left] + node.comparators]
+        operators = []
+        for operator in node.ops:
+            if type(operator) not in COMPARISONS:
+                raise ExpressionError(f"Unsupported comparison in {ast.unparse(node)}")
+            operators.append(COMPARISONS[type(operator)])
+
+        def compare(frame):
+            values = [self._comparable(term(frame)) for term in terms]
+            # Chained like Python: a < b < c is a < b and b < c
+            return functools.reduce(lambda a, b: a & b, (
+                self._condition(operator(left, right))
+                for operator, left, right in zip(operators, values, values[1:])
+            ))
+        return compare
+
+    def _compile_call(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            raise ExpressionError(f"Unsupported call: {ast.unparse(node)}")
+        name = node.func.id
+        if name == 'col':
+            if len(node.args) != 1 or not isinstance(node.args[0], ast.Constant) or not isinstance(node.args[0].value, str):
+                raise ExpressionError('col() takes one column name as text')
+            return self._column(node.args[0].value)
+        if name not in FUNCTIONS:
+            raise ExpressionError(f"Unknown function {name}(), use one of {', '.join(sorted(FUNCTIONS))} or col()")
+        function, minimum, maximum = FUNCTIONS[name]
+        if len(node.args) < minimum or (maximum is not None and len(node.args) > maximum):
+            raise ExpressionError(f"Wrong number of arguments for {name}()")
+        if name in LITERAL_ARGUMENTS and not all(isinstance(arg, ast.Constant) for arg in node.args[1:]):
+            raise ExpressionError(f"Only the first argument of {name}() can be a column")
+        arguments = [self._compile(arg) for arg in node.args]
+        return lambda frame: function(*(self._series(frame, argument(frame)) for argument in arguments))
+
+    @staticmethod
+    def _series(frame: pd.DataFrame, value) -> pd.Series:
+        if isinstance(value, pd.Series):
+            return value
+        return pd.Series([value] * len(frame), index=frame.index, dtype=object if value is None else None)
+
+    @staticmethod
+    def _number(value):
+        if isinstance(value, pd.Series):
+            return _numeric(value)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ExpressionError(f"Arithmetic needs numbers, got {value!r}")
+        return value
+
+    @staticmethod
+    def _comparable(value):
+        # Text columns that hold numbers compare as numbers
+        if isinstance(value, pd.Series) and value.dtype == object:
+            numbers = pd.to_numeric(value, errors='coerce')
+            if numbers.notna().sum() == value.notna().sum():
+                return numbers
+        return value
+
+    @staticmethod
+    def _condition(value):
+        return _boolean(value) if isinstance(value, pd.Series) else bool(value)
+
+    def evaluate(self, frame: pd.DataFrame) -> pd.Series:
+        """
+        Raises:
+            ExpressionError: The expression cannot be computed on these values
+        """
+        try:
+            return self._series(frame, self._evaluate(frame))
+        except ExpressionError:
+            raise
+        except (TypeError, ValueError, ArithmeticError, AttributeError) as e:
+            raise ExpressionError(f"Cannot evaluate {self.text}: {e}")
+
+    def mask(self, frame: pd.DataFrame) -> np.ndarray:
+        """
+        Rows for which a filter expression holds (null counts as false).
+        """
+        return _boolean(self.evaluate(frame)).to_numpy(dtype=bool)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse(text: str) -> Expression:
+    """
+    Parsed expression, cached so definitions are parsed once per process.
+
+    Raises:
+        ExpressionError: The expression is malformed or not allowed
+    """
+    return Expression(text)
+
+
+class ComputedColumns:
+    """
+    The computed columns of a file (a list of {"name", "expression"}, as
+    stored on the record), resolved against its columns. A computed column
+    may use the columns defined before it.
+    """
+
+    def __init__(self, definitions: list, columns: list):
+        self.columns = list(columns)
+        self.expressions = {}
+        for definition in definitions or []:
+            name = definition['name']
+            expression = parse(definition['expression'])
+            unknown = [column for column in expression.columns if column not in self.columns and column not in self.expressions]
+            if unknown:
+                raise ExpressionError(f"Unknown columns in '{name}': {', '.join(unknown)}")
+            self.expressions[name] = expression
+
+    @property
+    def names(self) -> list:
+        return list(self.expressions)
+
+    def sources(self, names: list) -> list:
+        """
+        File columns needed to compute ``names`` (file or computed columns),
+        in file order.
+        """
+        needed, pending = set(), list(names)
+        while pending:
+            name = pending.pop()
+            if name in self.expressions:
+                pending.extend(self.expressions[name].columns)
+            else:
+                needed.add(name)
+        return [column for column in self.columns if column in needed]
+
+    def filter(self, text: str) -> Expression:
+        """
+        Raises:
+            ExpressionError: The filter is malformed or uses unknown columns
+        """
+        expression = parse(text)
+        unknown = [column for column in expression.columns if column not in self.columns and column not in self.expressions]
+        if unknown:
+            raise ExpressionError(f"Unknown columns in filter: {', '.join(unknown)}")
+        return expression
+
+    def add_to(self, frame: pd.DataFrame, names: list) -> pd.DataFrame:
+        """
+        Compute ``names`` (and the computed columns they use) on a page.
+        """
+        wanted, pending = [], list(names)
+        while pending:
+            name = pending.pop()
+            if name in self.expressions and name not in wanted and name not in frame.columns:
+                wanted.append(name)
+                pending.extend(self.expressions[name].columns)
+        if not wanted:
+            return frame
+        frame = frame.copy(deep=False)
+        # Definition order, so dependencies come first
+        for name in self.expressions:
+            if name in wanted:
+                frame[name] = self.expressions[name].evaluate(frame)
+        return frame
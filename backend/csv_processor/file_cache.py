@@ -0,0 +1,275 @@
+import io
+import json
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .metrics import record_cache_lookup
+from .models import UploadedFile
+from .redis_client import get_redis, mark_unavailable
+from . import row_index
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Per-process caches for the page request path:
+#
+# - Records of completed files, so serving a page needs no database query.
+#   Saves (other than access and watermark bookkeeping) and deletes drop the
+#   record here and in every other process through a Redis pub/sub channel.
+#   Records are only cached while this process is subscribed (or Redis is
+#   disabled, i.e. a single process), and for at most CSV_FILE_CACHE_TTL.
+# - A bounded LRU pool of memory-mapped files with their row index and
+#   header, keyed by the file's size and mtime, so a page is sliced from an
+#   open mapping instead of reopening and skipping through the file.
+#
+# Evicted mappings are not closed explicitly: a request may still be reading
+# one, and it is unmapped once the last reference goes away.
+
+# Fields written while serving reads or ingesting, which cached readers of
+# completed files do not depend on
+VOLATILE_FIELDS = {'last_accessed_at', 'readable_rows', 'readable_bytes', 'processing_progress', 'task_id'}
+
+
+class MetadataCache:
+    """
+    LRU of UploadedFile records by id, with a TTL. The records are shared
+    between requests and must not be modified or saved.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bumped by every invalidation, so a record read from the database
+        # before an invalidation is not cached after it
+        self.generation = 0
+
+    def get(self, file_id: str):
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is None:
+                return None
+            db_file, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[file_id]
+                return None
+            self._entries.move_to_end(file_id)
+            return db_file
+
+    def put(self, file_id: str, db_file: UploadedFile, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[file_id] = (db_file, time.monotonic() + settings.CSV_FILE_CACHE_TTL)
+            self._entries.move_to_end(file_id)
+            while len(self._entries) > settings.CSV_FILE_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def discard(self, file_id: str):
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(file_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileHandles:
+    """
+    An open mapping of a CSV file with its row index, header record and
+    header columns.
+    """
+
+    def __init__(self, file_path: str, key: tuple, index):
+        self.file_path = file_path
+        self.key = key
+        self.index = index
+        with open(file_path, 'rb') as source:
+            self.mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = header = self.mapped[:row_index.header_end(file_path)]
+        self.columns = pd.read_csv(io.BytesIO(header), nrows=0).columns.tolist() if header.strip() else []
+
+
+class HandlePool:
+    """
+    LRU of FileHandles, at most CSV_FILE_HANDLE_POOL_SIZE files. Empty
+    files and files without a row index (not counted yet, or a dialect the
+    byte scanner cannot index) are not pooled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handles = OrderedDict()
+
+    def get(self, file_path: str):
+        """
+        Handles of the current version of ``file_path``, or None.
+        """
+        stat = os.stat(file_path)
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            handles = self._handles.get(file_path)
+            if handles is not None and handles.key == key:
+                self._handles.move_to_end(file_path)
+                record_cache_lookup('file_handle', True)
+                return handles
+        record_cache_lookup('file_handle', False)
+        index = row_index.load_row_index(file_path) if stat.st_size else None
+        if index is None:
+            return None
+        handles = FileHandles(file_path, key, index)
+        with self._lock:
+            self._handles[file_path] = handles
+            self._handles.move_to_end(file_path)
+            while len(self._handles) > settings.CSV_FILE_HANDLE_POOL_SIZE:
+                self._handles.popitem(last=False)
+        return handles
+
+    def discard(self, file_path: str):
+        with self._lock:
+            self._handles.pop(file_path, None)
+
+    def clear(self):
+        with self._lock:
+            self._handles.clear()
+
+    def __len__(self):
+        return len(self._handles)
+
+
+METADATA = MetadataCache()
+HANDLES = HandlePool()
+
+
+def _discard_local(file_id: str, file_path: str = None):
+    METADATA.discard(str(file_id))
+    if file_path:
+        HANDLES.discard(file_path)
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Daemon thread applying the invalidations published by other processes.
+    ``subscribed`` is set while messages are being received; on every
+    (re)subscription the metadata cache is cleared, as messages may have
+    been missed in between.
+    """
+
+    def __init__(self):
+        super().__init__(name='csv-file-cache-invalidation', daemon=True)
+        self.subscribed = threading.Event()
+
+    def run(self):
+        while True:
+            client = get_redis()
+            if client is None:
+                time.sleep(settings.CSV_REDIS_RETRY_SECONDS)
+                continue
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(settings.CSV_FILE_CACHE_CHANNEL)
+                METADATA.clear()
+                self.subscribed.set()
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        handle_message(message)
+            except redis.RedisError as e:
+                self.subscribed.clear()
+                METADATA.clear()
+                mark_unavailable(e)
+            finally:
+                pubsub.close()
+
+
+def handle_message(message: dict):
+    try:
+        payload = json.loads(message['data'])
+        _discard_local(payload['id'], payload.get('path'))
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring malformed file cache invalidation {message!r}: {e}")
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def cache_enabled() -> bool:
+    """
+    Whether records may be cached: always with Redis disabled (a single
+    process, where the signals below see every change), otherwise only
+    while subscribed to the invalidation channel.
+    """
+    global _listener
+    if not getattr(settings, 'CSV_REDIS_URL', None):
+        return True
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = InvalidationListener()
+                _listener.start()
+    return _listener.subscribed.is_set()
+
+
+def get_file(file_id) -> UploadedFile:
+    """
+    The record of ``file_id``, from the cache when the file is completed.
+    The result is shared and must not be saved.
+
+    Raises:
+        UploadedFile.DoesNotExist: No such file
+    """
+    key = str(file_id)
+    enabled = cache_enabled()
+    if enabled:
+        db_file = METADATA.get(key)
+        record_cache_lookup('file_metadata', db_file is not None)
+        if db_file is not None:
+            return db_file
+    generation = METADATA.generation
+    db_file = UploadedFile.objects.get(id=file_id)
+    if enabled and db_file.status == 'completed':
+        METADATA.put(key, db_file, generation)
+    return db_file
+
+
+def invalidate(file_id, file_path: str = None):
+    """
+    Drop the cached record (and mapped file) of ``file_id`` in every process.
+    """
+    _discard_local(file_id, file_path)
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.publish(settings.CSV_FILE_CACHE_CHANNEL, json.dumps({'id': str(file_id), 'path': file_path}))
+    except redis.RedisError as e:
+        mark_unavailable(e)
+
+
+@receiver(post_save, sender=UploadedFile)
+def _invalidate_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    if created or (update_fields and set(update_fields) <= VOLATILE_FIELDS):
+        return
+    # After the commit, so no process reloads the old row in between
+    transaction.on_commit(lambda: invalidate(instance.id, instance.file_path))
+
+
+@receiver(post_delete, sender=UploadedFile)
+def _invalidate_deleted(sender, instance, **kwargs):
+    # Bound now: Django clears the primary key before an enclosing
+    # transaction commits
+    file_id, file_path = instance.id, instance.file_path
+    transaction.on_commit(lambda: invalidate(file_id, file_path))
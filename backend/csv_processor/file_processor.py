@@ -1,22 +1,75 @@
 import pandas as pd
+import numpy as np
+import fcntl
+import io
 import os
+import shutil
+import json
+import hashlib
+import sqlite3
 import tempfile
 import uuid
 from typing import Generator, Dict, Any, Tuple
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from .models import UploadedFile
+from .artifacts import artifact_path, remove_artifacts
+from .distributions import ColumnDistributionCollector
+from .ingest_control import CancellationCheck, IngestCancelled, ReadableWatermark, publish_watermark
+from .sampling import RESERVOIR_ARTIFACT, ReservoirSampler, reservoir_path
+from .single_flight import SingleFlight
+from .uploads import finalize_upload, move_file
+from .zone_map import ZONE_MAP_ARTIFACT, ZoneMap, ZoneMapCollector, load_zone_map, zone_map_path
+from . import chunking, diffing, file_cache, key_index, row_index, sql_query, validation
+from .metrics import INGEST_STAGE_SECONDS, INGEST_BYTES, INGEST_ROWS, DATA_CHUNK_SECONDS, offset_bucket, record_cache_lookup
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shared by all processor instances of this process
+DATA_CHUNK_FLIGHTS = SingleFlight('data_chunk')
+
+# Artifacts that describe the old content and are rebuilt on demand after an
+# append (aggregation results, SQL database, diffs). Row index, zone map,
+# reservoir, bad rows and key indexes are extended with the appended rows.
+STALE_AFTER_APPEND = ('agg-*', 'sqlite*', 'diff-*')
+
+
+class AppendError(ValueError):
+    pass
+
+
+class RawRecordsUnavailable(ValueError):
+    """
+    The file has no row index and its dialect cannot be indexed by the byte
+    scanner, so original record bytes cannot be located.
+    """
+
+
 class LargeCSVProcessor:
-    def __init__(self, chunk_size: int = 10000):
+    def __init__(self, chunk_size: int = None):
         """
         Initialize the processor with configurable chunk size.
         
         Args:
-            chunk_size: Number of rows to process at a time
+            chunk_size: Fixed number of rows to process at a time; by default
+                chunks are sized to a memory budget (see chunking)
+        """
+        self.fixed_chunk_size = chunk_size
+        self.chunk_size = chunk_size or settings.CSV_CHUNK_INITIAL_ROWS
+    
+    def _read_chunks(self, source, file_path: str, start: int = 0, **options):
+        """
+        Parse ``source`` (a path or a stream over ``file_path`` from byte
+        ``start``) in chunks of self.fixed_chunk_size rows, or sized by
+        memory from the row width at ``start``.
         """
-        self.chunk_size = chunk_size
+        sizer = chunking.ChunkSizer(
+            row_bytes_hint=None if self.fixed_chunk_size else chunking.raw_bytes_per_row(file_path, start),
+            fixed_rows=self.fixed_chunk_size,
+        )
+        return chunking.read_chunks(source, sizer, **options)
         
     def save_uploaded_file(self, uploaded_file, filename: str) -> UploadedFile:
         """
@@ -33,18 +86,20 @@ class LargeCSVProcessor:
         file_path = os.path.join(uploads_dir, unique_filename)
         
         # Save file to disk
-        with open(file_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
+        # Spooled uploads are moved rather than copied
+        with INGEST_STAGE_SECONDS.labels(stage='upload_copy').time():
+            content_hash = finalize_upload(uploaded_file, file_path)
         
         # Get file size
         file_size = os.path.getsize(file_path)
+        INGEST_BYTES.labels(stage='upload_copy').inc(file_size)
         
         # Create database record
         db_file = UploadedFile.objects.create(
             filename=filename,
             file_path=file_path,
             file_size=file_size,
+            content_hash=content_hash,
             status='uploading'
         )
         
@@ -66,32 +121,89 @@ class LargeCSVProcessor:
         temp_file_path = os.path.join(temp_dir, unique_filename)
         
         # Save file to temp location
-        with open(temp_file_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
+        # Spooled uploads are moved rather than copied
+        with INGEST_STAGE_SECONDS.labels(stage='upload_copy').time():
+            content_hash = finalize_upload(uploaded_file, temp_file_path)
         
         # Get file size
         file_size = os.path.getsize(temp_file_path)
+        INGEST_BYTES.labels(stage='upload_copy').inc(file_size)
         
         # Create database record with temp path
         db_file = UploadedFile.objects.create(
             filename=filename,
             file_path=temp_file_path,  # Will be moved later
             file_size=file_size,
+            content_hash=content_hash,
             status='uploading'
         )
         
         logger.info(f"Saved large file {filename} to temp location with ID {db_file.id}")
         return db_file
     
+    def share_duplicate_content(self, db_file: UploadedFile) -> bool:
+        """
+        If identical content was already ingested, drop the new copy and point
+        the record at the existing file, reusing its metadata and every derived
+        artifact. Physical data is reference counted through file_path, see
+        UploadedFile.delete.
+        
+        Returns:
+            True if the record now shares an existing file and is completed
+        """
+        if not db_file.content_hash:
+            return False
+        
+        own_copy = db_file.file_path
+        # The original stays locked until the record points at its file, so
+        # a concurrent UploadedFile.delete of it sees the new reference
+        with transaction.atomic():
+            original = (
+                UploadedFile.objects
+                .select_for_update()
+                .filter(content_hash=db_file.content_hash, file_size=db_file.file_size, status='completed')
+                .exclude(id=db_file.id)
+                .exclude(file_path='')
+                .order_by('created_at')
+            )
+            # Validation results depend on the rules the content was checked against
+            if db_file.validation_rules:
+                original = original.filter(validation_rules=db_file.validation_rules)
+            else:
+                original = original.filter(validation_rules__isnull=True)
+            original = original.first()
+            found = original is not None and os.path.exists(original.file_path)
+            record_cache_lookup('content_dedup', found)
+            if not found:
+                return False
+            
+            db_file.file_path = original.file_path
+            db_file.columns = original.columns
+            db_file.dtypes = original.dtypes
+            db_file.total_rows = original.total_rows
+            db_file.statistics = original.statistics
+            db_file.column_distributions = original.column_distributions
+            db_file.validation = original.validation
+            db_file.status = 'completed'
+            db_file.processing_progress = 100.0
+            db_file.save()
+        
+        if own_copy and own_copy != original.file_path and os.path.exists(own_copy):
+            os.remove(own_copy)
+        
+        logger.info(f"File {db_file.id} has the same content as {original.id}, sharing {original.file_path}")
+        return True
+    
     def create_file_record_memory(self, filename: str, file_size: int) -> UploadedFile:
         """
-        Create database record for large files processed in memory.
+        Create database record for a file whose content is handed to the
+        ingest task by reference (spool_path); the task moves it into place
+        and fills in file_path.
         """
-        # Create database record without file_path for memory processing
+        # No physical file path until the ingest stores the content
         db_file = UploadedFile.objects.create(
             filename=filename,
-            file_path='',  # No physical file path for memory processing
+            file_path='',
             file_size=file_size,
             status='uploading'
         )
@@ -101,27 +213,41 @@ class LargeCSVProcessor:
     
     def analyze_file_structure_from_content(self, file_content: bytes) -> Tuple[list, dict, int]:
         """
-        Analyze CSV file structure from file content bytes.
+        Analyze CSV file structure from file content bytes. Only the first
+        chunk is parsed, straight from the bytes, so no decoded copy of the
+        whole content is made.
         """
-        import io
-        
-        # Convert bytes to string IO
-        content_str = file_content.decode('utf-8')
-        file_io = io.StringIO(content_str)
-        
-        # Read first chunk to determine structure
-        chunk_iter = pd.read_csv(file_io, chunksize=self.chunk_size)
-        first_chunk = next(chunk_iter)
+        first_chunk = pd.read_csv(io.BytesIO(file_content), nrows=self.chunk_size)
         
         columns = first_chunk.columns.tolist()
         dtypes = first_chunk.dtypes.astype(str).to_dict()
         
         # Estimate total rows by content size
-        avg_row_size = len(content_str) / len(first_chunk) if len(first_chunk) > 0 else 1
-        estimated_rows = int(len(content_str) / avg_row_size)
+        estimated_rows = 0
+        if len(first_chunk) > 0:
+            avg_row_size = len(first_chunk.to_csv(index=False)) / len(first_chunk)
+            estimated_rows = int(len(file_content) / avg_row_size)
         
         return columns, dtypes, estimated_rows
     
+    def spool_content(self, file_content: bytes, filename: str) -> str:
+        """
+        Write content received in memory to a spool file, so it can be
+        ingested by reference like any other upload.
+        
+        Returns:
+            Path of the spool file
+        """
+        temp_dir = '/tmp/csv_temp_uploads'
+        os.makedirs(temp_dir, exist_ok=True)
+        spool_path = os.path.join(temp_dir, f"{uuid.uuid4()}{os.path.splitext(filename)[1]}")
+        with open(spool_path, 'wb') as spool:
+            spool.write(file_content)
+        return spool_path
+    
+    def _header_width(self, file_path: str) -> int:
+        return len(pd.read_csv(file_path, nrows=0).columns)
+    
     def analyze_file_structure(self, file_path: str) -> Tuple[list, dict, int]:
         """
         Analyze CSV file structure without loading entire file into memory.
@@ -129,68 +255,535 @@ class LargeCSVProcessor:
         Returns:
             Tuple of (columns, dtypes, estimated_rows)
         """
-        # Read just the first few chunks to determine structure
-        chunk_iter = pd.read_csv(file_path, chunksize=self.chunk_size)
+        with INGEST_STAGE_SECONDS.labels(stage='analysis').time():
+            # Read just the first few chunks to determine structure. Only the
+            # header's columns are parsed, so a first record with too many
+            # fields does not turn into an index
+            chunk_iter = self._read_chunks(file_path, file_path, usecols=range(self._header_width(file_path)))
+            
+            first_chunk = next(chunk_iter)
+            chunk_iter.close()
+            columns = first_chunk.columns.tolist()
+            dtypes = first_chunk.dtypes.astype(str).to_dict()
+            
+            # Estimate total rows by file size
+            file_size = os.path.getsize(file_path)
+            avg_row_size = len(first_chunk.to_csv()) / len(first_chunk)
+            estimated_rows = int(file_size / avg_row_size)
         
-        first_chunk = next(chunk_iter)
-        columns = first_chunk.columns.tolist()
-        dtypes = first_chunk.dtypes.astype(str).to_dict()
+        return columns, dtypes, estimated_rows
+    
+    def count_rows(self, file_path: str, progress=None, field_counts=None) -> int:
+        """
+        Exact number of data rows, counted by a vectorized, quote-aware scan
+        of the raw bytes instead of a full pandas parse. The row index
+        built by the same scan is saved next to the file. Dialects the
+        scanner cannot handle fall back to counting with the parser.
         
-        # Estimate total rows by file size
+        Args:
+            file_path: Path to the CSV file
+            progress: Optional callable receiving (rows_so_far, bytes_scanned)
+            field_counts: Optional callable receiving the number of fields of
+                every record (see row_index.scan_records); not called when
+                the parser counts
+            
+        Returns:
+            Number of data rows (header excluded)
+        """
         file_size = os.path.getsize(file_path)
-        avg_row_size = len(first_chunk.to_csv()) / len(first_chunk)
-        estimated_rows = int(file_size / avg_row_size)
+        with INGEST_STAGE_SECONDS.labels(stage='row_count').time():
+            total_rows = None
+            if row_index.needs_parser_count(file_path):
+                logger.info(f"PROCESSOR: Dialect of {file_path} needs the parser for row counting")
+            else:
+                try:
+                    total_rows, checkpoints = row_index.scan_records(
+                        file_path, row_index.header_end(file_path), file_size, settings.CSV_ROW_INDEX_STRIDE,
+                        progress=progress, field_counts=field_counts,
+                    )
+                    row_index.save_row_index(file_path, row_index.merge_segments([(total_rows, checkpoints)]))
+                except row_index.IrregularQuotes as e:
+                    # Field counts reported so far are right, the rest go unchecked
+                    logger.info(f"PROCESSOR: Counting {file_path} with the parser: {e}")
+            if total_rows is None:
+                total_rows = 0
+                for chunk in self.stream_csv_chunks(file_path, usecols=[0]):
+                    total_rows += len(chunk)
+                    if progress:
+                        progress(total_rows, None)
         
-        return columns, dtypes, estimated_rows
+        INGEST_ROWS.labels(stage='row_count').inc(total_rows)
+        INGEST_BYTES.labels(stage='row_count').inc(file_size)
+        return total_rows
     
-    def get_data_chunk(self, file_path: str, offset: int, limit: int) -> pd.DataFrame:
+    def get_data_chunk(self, file_path: str, offset: int, limit: int, columns: list = None) -> pd.DataFrame:
         """
         Get a specific chunk of data from the CSV file.
         
+        Concurrent identical reads (same file version, offset, limit and
+        columns) are coalesced into one parse in this process; for files
+        not in the handle pool, other processes wait for it through Redis.
+        
         Args:
             file_path: Path to the CSV file
             offset: Starting row number
             limit: Number of rows to return
+            columns: Only return these columns (all columns if None)
             
         Returns:
             DataFrame with the requested rows
         """
         try:
-            # Skip rows before offset and read only the required number
-            if offset == 0:
-                df = pd.read_csv(file_path, nrows=limit)
-            else:
-                df = pd.read_csv(file_path, skiprows=range(1, offset + 1), nrows=limit)
-            
-            return df
+            stat = os.stat(file_path)
+            key = hashlib.blake2b(json.dumps(
+                [file_path, stat.st_size, stat.st_mtime_ns, offset, limit, columns]
+            ).encode('utf-8'), digest_size=16).hexdigest()
+            return DATA_CHUNK_FLIGHTS.do(
+                key,
+                lambda: self._read_chunk(file_path, offset, limit, columns),
+                share=lambda df: df.copy(),
+                # A slice of a pooled mapping is cheaper than a Redis round trip
+                across_processes=file_cache.HANDLES.get(file_path) is None,
+            )
         except Exception as e:
             logger.error(f"Error reading chunk from {file_path}: {e}")
             raise
     
-    def stream_csv_chunks(self, file_path: str) -> Generator[pd.DataFrame, None, None]:
+    def _read_chunk(self, file_path: str, offset: int, limit: int, columns: list = None) -> pd.DataFrame:
+        with DATA_CHUNK_SECONDS.labels(offset_bucket=offset_bucket(offset)).time():
+            # Slice the rows from the pooled mapping through the row index
+            handles = file_cache.HANDLES.get(file_path)
+            if handles is not None:
+                span = row_index.find_row_span(file_path, handles.index, offset, limit, mapped=handles.mapped) \
+                    if len(handles.index) else None
+                if span is None:
+                    return pd.DataFrame(columns=columns or handles.columns)
+                # Parsed behind the header record, so the parser knows the
+                # width of the file when the page holds only short records
+                return pd.read_csv(
+                    io.BytesIO(handles.header + handles.mapped[span[0]:span[1]]),
+                    usecols=columns or range(len(handles.columns))
+                )
+            
+            # Skip rows before offset and read only the required number.
+            # Extra fields of malformed records are dropped, see validation.py
+            usecols = columns or range(self._header_width(file_path))
+            if offset == 0:
+                return pd.read_csv(file_path, nrows=limit, usecols=usecols)
+            return pd.read_csv(file_path, skiprows=range(1, offset + 1), nrows=limit, usecols=usecols)
+    
+    def _raw_row_index(self, file_path: str):
+        """
+        The row index of ``file_path``, built by a byte scan on first use.
+        Never falls back to the parser, which counts rows but cannot locate
+        them.
+        
+        Raises:
+            RawRecordsUnavailable: The dialect cannot be indexed
+        """
+        index = row_index.load_row_index(file_path)
+        if index is not None:
+            return index
+        if row_index.needs_parser_count(file_path):
+            raise RawRecordsUnavailable(f"The CSV dialect of {file_path} cannot be indexed")
+        try:
+            total_rows, checkpoints = row_index.scan_records(
+                file_path, row_index.header_end(file_path), os.path.getsize(file_path), settings.CSV_ROW_INDEX_STRIDE,
+            )
+        except row_index.IrregularQuotes as e:
+            raise RawRecordsUnavailable(f"{file_path} cannot be indexed: {e}")
+        index = row_index.merge_segments([(total_rows, checkpoints)])
+        row_index.save_row_index(file_path, index)
+        return index
+    
+    def get_raw_span(self, file_path: str, offset: int, limit: int):
+        """
+        Locate the original bytes of rows [offset, offset + limit) without
+        parsing them, using the row index (built on first use).
+        
+        Args:
+            file_path: Path to the CSV file
+            offset: Starting row number
+            limit: Number of rows
+            
+        Returns:
+            List of (start, end) byte ranges: the header, then the rows if
+            offset is inside the file
+            
+        Raises:
+            RawRecordsUnavailable: The dialect cannot be indexed
+        """
+        index = self._raw_row_index(file_path)
+        
+        with DATA_CHUNK_SECONDS.labels(offset_bucket=offset_bucket(offset)).time():
+            ranges = [(0, row_index.header_end(file_path))]
+            if len(index):
+                span = row_index.find_row_span(file_path, index, offset, limit)
+                if span is not None:
+                    ranges.append(span)
+        return ranges
+    
+    def read_raw_records(self, file_path: str, row_numbers) -> list:
+        """
+        Original text of records by data row number, e.g. of rows that failed
+        validation and may not parse. Rows past the end of the file give None.
+        
+        Raises:
+            RawRecordsUnavailable: The dialect cannot be indexed
+        """
+        index = self._raw_row_index(file_path)
+        
+        records = []
+        with open(file_path, 'rb') as source:
+            for row in row_numbers:
+                span = row_index.find_row_span(file_path, index, int(row), 1) if len(index) else None
+                if span is None:
+                    records.append(None)
+                    continue
+                source.seek(span[0])
+                records.append(source.read(span[1] - span[0]).decode('utf-8', errors='replace').rstrip('\r\n'))
+        return records
+    
+    def read_rows(self, file_path: str, columns: list, row_numbers, dtype=None) -> pd.DataFrame:
+        """
+        Read arbitrary rows by number using the row index: each requested row
+        is parsed starting from the nearest checkpoint before it, so only the
+        blocks containing the rows are read.
+        
+        Args:
+            file_path: Path to the CSV file
+            columns: Column names of the file
+            row_numbers: Data row numbers (0-based)
+            dtype: Optional pandas dtype (or {column: dtype}) to parse with
+            
+        Returns:
+            DataFrame indexed by row number, in ascending row order
+        """
+        index = row_index.load_row_index(file_path)
+        if index is None:
+            self.count_rows(file_path)
+            index = row_index.load_row_index(file_path)
+        if index is None:
+            raise ValueError(f"No row index available for {file_path}")
+        
+        row_numbers = np.unique(np.asarray(row_numbers, dtype=np.int64))
+        if not len(row_numbers):
+            return pd.DataFrame(columns=columns)
+        positions = np.searchsorted(index[:, 0], row_numbers, side='right') - 1
+        
+        frames = []
+        for position in np.unique(positions):
+            checkpoint_row, offset = int(index[position, 0]), int(index[position, 1])
+            wanted = row_numbers[positions == position]
+            # Behind the header, see validation.py
+            with row_index.open_records(file_path, offset) as stream:
+                block = pd.read_csv(
+                    stream, usecols=range(len(columns)), nrows=int(wanted[-1]) - checkpoint_row + 1, dtype=dtype
+                )
+            block.columns = columns
+            block.index = block.index + checkpoint_row
+            frames.append(block.loc[block.index.intersection(wanted)])
+        return pd.concat(frames)
+    
+    def filter_rows(self, file_path: str, computed, predicate, names: list, offset: int, limit: int) -> Dict[str, Any]:
+        """
+        Page of the rows for which ``predicate`` holds. Chunks are parsed
+        from the start of the file with only the columns the filter and the
+        page need, and the scan stops as soon as the page is full.
+        
+        Args:
+            file_path: Path to the CSV file
+            computed: expressions.ComputedColumns of the file
+            predicate: Parsed filter expression
+            names: File and computed columns of the page
+            offset: Number of matching rows to skip
+            limit: Number of matching rows to return
+        
+        Returns:
+            Dictionary with rows (indexed by data row number), has_next and
+            scanned_rows
+        """
+        usecols = computed.sources(names + predicate.columns) or computed.columns[:1]
+        pages, matched, scanned = [], 0, 0
+        chunks = self.stream_csv_chunks(file_path, usecols=usecols)
+        try:
+            for chunk in chunks:
+                scanned += len(chunk)
+                chunk = computed.add_to(chunk, predicate.columns)
+                chunk = chunk[predicate.mask(chunk)]
+                if matched + len(chunk) > offset:
+                    pages.append(chunk.iloc[max(0, offset - matched):])
+                matched += len(chunk)
+                # One row past the page tells whether there is a next one
+                if matched > offset + limit:
+                    break
+        finally:
+            chunks.close()
+        
+        rows = pd.concat(pages) if pages else pd.DataFrame(columns=usecols)
+        rows = computed.add_to(rows.iloc[:limit], names)[names]
+        return {'rows': rows, 'has_next': matched > offset + limit, 'scanned_rows': scanned}
+        
+    def find_in_range(self, file_path: str, columns: list, column: str, low=None, high=None,
+                      limit: int = 1000) -> Dict[str, Any]:
+        """
+        Rows whose ``column`` value lies in [low, high], reading only the
+        zone map blocks that can hold such values. Consecutive blocks are
+        read as one byte range located through the row index.
+        
+        Args:
+            low, high: Bounds already converted with ZoneMap.parse_bound;
+                None leaves that side open
+            limit: Stop after this many matching rows
+            
+        Returns:
+            Dictionary with the matching rows (DataFrame indexed by row
+            number), blocks_scanned, blocks_total and truncated (the limit
+            was reached with part of the candidate blocks still unread, so
+            more rows may match)
+        """
+        zone_map = load_zone_map(file_path)
+        index = row_index.load_row_index(file_path)
+        if zone_map is None or index is None:
+            raise ValueError(f"No zone map available for {file_path}")
+        
+        blocks = zone_map.overlapping_blocks(column, low, high)
+        runs = np.split(blocks, np.flatnonzero(np.diff(blocks) != 1) + 1) if len(blocks) else []
+        file_size = os.path.getsize(file_path)
+        matches = []
+        found = 0
+        truncated = False
+        for position, run in enumerate(runs):
+            first_row = int(zone_map.first_rows[run[0]])
+            span = row_index.find_row_span(file_path, index, first_row, 1)
+            if span is None:
+                break
+            following = run[-1] + 1
+            end = file_size
+            if following < len(zone_map):
+                next_span = row_index.find_row_span(file_path, index, int(zone_map.first_rows[following]), 1)
+                end = next_span[0] if next_span else file_size
+            
+            with row_index.open_records(file_path, span[0], end) as stream:
+                chunks = self._read_chunks(stream, file_path, span[0], usecols=range(len(columns)))
+                try:
+                    for chunk in chunks:
+                        chunk.columns = columns
+                        # The index runs on across chunks
+                        chunk.index = chunk.index + first_row
+                        matched = chunk[zone_map.in_range(chunk[column], column, low, high)]
+                        if found + len(matched) >= limit:
+                            truncated = (
+                                found + len(matched) > limit
+                                or position < len(runs) - 1
+                                or next(chunks, None) is not None
+                            )
+                            matches.append(matched.iloc[:limit - found])
+                            found = limit
+                            break
+                        matches.append(matched)
+                        found += len(matched)
+                finally:
+                    chunks.close()
+            if found >= limit:
+                break
+        
+        return {
+            'rows': pd.concat(matches) if matches else pd.DataFrame(columns=columns),
+            'blocks_scanned': int(len(blocks)),
+            'blocks_total': len(zone_map),
+            'truncated': truncated,
+        }
+    
+    def build_key_index(self, file_path: str, column: str, progress=None) -> int:
+        """
+        Build the key index of ``column`` (see key_index) in one pass over
+        the file, reading only that column as raw text.
+        
+        Args:
+            file_path: Path to the CSV file
+            column: Column to index
+            progress: Optional callable receiving the number of rows processed
+            
+        Returns:
+            Number of rows indexed
+        """
+        builder = key_index.new_builder(file_path, column)
+        with INGEST_STAGE_SECONDS.labels(stage='key_index').time():
+            for chunk in self.stream_csv_chunks(file_path, usecols=[column], dtype=str, na_filter=False):
+                builder.update(chunk)
+                if progress:
+                    progress(builder.rows)
+            builder.write(key_index.key_index_path(file_path, column))
+        INGEST_ROWS.labels(stage='key_index').inc(builder.rows)
+        logger.info(f"PROCESSOR: Built key index of '{column}' over {builder.rows} rows of {file_path}")
+        return builder.rows
+    
+    def find_by_key(self, file_path: str, columns: list, column: str, value: str,
+                    limit: int = 1000) -> Dict[str, Any]:
+        """
+        Rows whose ``column`` holds exactly the text ``value``, found through
+        the key index of the column and read through the row index.
+        
+        Returns:
+            Dictionary with the matching rows (DataFrame indexed by row
+            number, ``column`` as text) and truncated
+        """
+        index = key_index.load_key_index(file_path, column)
+        if index is None:
+            raise ValueError(f"No key index on '{column}' for {file_path}")
+        
+        candidates = index.rows_for(value)
+        matches = []
+        found = 0
+        truncated = False
+        for start in range(0, len(candidates), limit):
+            rows = self.read_rows(file_path, columns, candidates[start:start + limit], dtype={column: str})
+            # A missing value here was NA-like text hashing like ``value``
+            matched = rows[rows[column].isna() | (rows[column] == value)]
+            if found + len(matched) >= limit:
+                truncated = found + len(matched) > limit or start + limit < len(candidates)
+                matches.append(matched.iloc[:limit - found])
+                found = limit
+                break
+            matches.append(matched)
+            found += len(matched)
+        
+        return {
+            'rows': pd.concat(matches) if matches else pd.DataFrame(columns=columns),
+            'truncated': truncated,
+        }
+    
+    def build_sql_database(self, file_path: str, version: str, columns: list) -> str:
+        """
+        Bulk-load the CSV into a SQLite database next to it (table "data")
+        for the SQL query endpoint. The database is built under a temporary
+        name and moved into place, so concurrent builds are harmless.
+        
+        Args:
+            file_path: Path to the CSV file
+            version: File version recorded in the database for staleness checks
+            columns: Header columns; fields past them (rows with too many
+                fields) are not loaded
+            
+        Returns:
+            Path of the database
+        """
+        path = sql_query.database_path(file_path)
+        build_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        logger.info(f"PROCESSOR: Building SQL database for {file_path}")
+        
+        rows = 0
+        try:
+            with INGEST_STAGE_SECONDS.labels(stage='sql_load').time():
+                connection = sqlite3.connect(build_path)
+                try:
+                    connection.execute("PRAGMA journal_mode = OFF")
+                    connection.execute("PRAGMA synchronous = OFF")
+                    for chunk in self.stream_csv_chunks(file_path, usecols=range(len(columns))):
+                        chunk.to_sql('data', connection, if_exists='append', index=False)
+                        rows += len(chunk)
+                    connection.execute("CREATE TABLE _meta (version TEXT)")
+                    connection.execute("INSERT INTO _meta VALUES (?)", (version,))
+                    connection.commit()
+                finally:
+                    connection.close()
+            os.replace(build_path, path)
+        except Exception:
+            if os.path.exists(build_path):
+                os.remove(build_path)
+            raise
+        
+        INGEST_ROWS.labels(stage='sql_load').inc(rows)
+        logger.info(f"PROCESSOR: SQL database for {file_path} ready, {rows} rows")
+        return path
+    
+    def stream_csv_chunks(self, file_path: str, usecols: list = None, **options) -> Generator[pd.DataFrame, None, None]:
         """
         Generator that yields chunks of the CSV file.
         
         Args:
             file_path: Path to the CSV file
+            usecols: Only parse these columns (all columns if None)
+            options: Further pandas.read_csv options
             
         Yields:
             DataFrame chunks
         """
         try:
-            chunk_iter = pd.read_csv(file_path, chunksize=self.chunk_size)
+            chunk_iter = self._read_chunks(file_path, file_path, usecols=usecols, **options)
             for chunk in chunk_iter:
                 yield chunk
         except Exception as e:
             logger.error(f"Error streaming chunks from {file_path}: {e}")
             raise
     
-    def get_file_statistics(self, file_path: str) -> Dict[str, Any]:
+    def aggregate_file(self, file_path: str, aggregator, progress=None):
+        """
+        Run a chunked group-by aggregation over the file.
+        
+        Args:
+            file_path: Path to the CSV file
+            aggregator: aggregation.PartialAggregator receiving each chunk
+            progress: Optional callable receiving the number of rows processed
+            
+        Returns:
+            DataFrame with one row per group
+        """
+        usecols = list(dict.fromkeys(
+            aggregator.group_by + [column for _, column in aggregator.metrics if column]
+        ))
+        rows = 0
+        with INGEST_STAGE_SECONDS.labels(stage='aggregate_scan').time():
+            for chunk in self.stream_csv_chunks(file_path, usecols=usecols):
+                aggregator.update(chunk)
+                rows += len(chunk)
+                if progress:
+                    progress(rows)
+            result = aggregator.result()
+        INGEST_ROWS.labels(stage='aggregate_scan').inc(rows)
+        return result
+    
+    def partition_for_diff(self, plan: dict, side: str, range_index: int, start: int, end: int) -> int:
+        """
+        Spill the rows of one byte range of a diff input to its hash
+        partitions (see diffing), reading values as raw text.
+
+        Args:
+            plan: Plan from diffing.plan_diff
+            side: 'a' or 'b'
+            range_index: Position of the range in plan['ranges'][side]
+            start, end: Byte range of the range
+
+        Returns:
+            Number of rows partitioned
+        """
+        partitioner = diffing.DiffPartitioner(plan, side, range_index)
+        with INGEST_STAGE_SECONDS.labels(stage='diff_partition').time():
+            try:
+                with row_index.open_records(plan['paths'][side], start, end) as stream:
+                    chunks = self._read_chunks(stream, plan['paths'][side], start, dtype=str, na_filter=False,
+                                               usecols=range(len(plan['columns'][side])))
+                    for chunk in chunks:
+                        chunk.columns = plan['columns'][side]
+                        partitioner.update(chunk)
+            except pd.errors.EmptyDataError:
+                pass
+            finally:
+                partitioner.close()
+        diffing.mark_range_done(plan, side, range_index)
+        INGEST_ROWS.labels(stage='diff_partition').inc(partitioner.rows)
+        return partitioner.rows
+
+    def get_file_statistics(self, file_path: str, collectors: list = None, **options) -> Dict[str, Any]:
         """
         Get comprehensive statistics about the CSV file.
         
         Args:
             file_path: Path to the CSV file
+            collectors: Optional objects with an update(chunk) method that are
+                fed every chunk of the same pass (distributions, ...)
+            options: Further pandas.read_csv options
             
         Returns:
             Dictionary with file statistics
@@ -208,23 +801,30 @@ class LargeCSVProcessor:
         null_counts = {}
         
         try:
-            for chunk in self.stream_csv_chunks(file_path):
-                if chunk_count == 0:
-                    # First chunk - initialize structure
-                    stats['columns'] = chunk.columns.tolist()
-                    stats['dtypes'] = chunk.dtypes.astype(str).to_dict()
-                    null_counts = chunk.isnull().sum().to_dict()
-                else:
-                    # Accumulate null counts
-                    chunk_nulls = chunk.isnull().sum().to_dict()
-                    for col, count in chunk_nulls.items():
-                        null_counts[col] += count
+            with INGEST_STAGE_SECONDS.labels(stage='stats_scan').time():
+                for chunk in self.stream_csv_chunks(file_path, **options):
+                    if chunk_count == 0:
+                        # First chunk - initialize structure
+                        stats['columns'] = chunk.columns.tolist()
+                        stats['dtypes'] = chunk.dtypes.astype(str).to_dict()
+                        null_counts = chunk.isnull().sum().to_dict()
+                    else:
+                        # Accumulate null counts
+                        chunk_nulls = chunk.isnull().sum().to_dict()
+                        for col, count in chunk_nulls.items():
+                            null_counts[col] += count
                 
-                stats['total_rows'] += len(chunk)
-                stats['memory_usage'] += chunk.memory_usage(deep=True).sum()
-                chunk_count += 1
+                    for collector in collectors or ():
+                        collector.update(chunk)
+                    
+                    stats['total_rows'] += len(chunk)
+                    stats['memory_usage'] += chunk.memory_usage(deep=True).sum()
+                    chunk_count += 1
             
-            stats['null_counts'] = null_counts
+            stats['null_counts'] = {col: int(count) for col, count in null_counts.items()}
+            stats['memory_usage'] = int(stats['memory_usage'])
+            INGEST_ROWS.labels(stage='stats_scan').inc(stats['total_rows'])
+            INGEST_BYTES.labels(stage='stats_scan').inc(stats['file_size'])
             
         except Exception as e:
             logger.error(f"Error calculating statistics for {file_path}: {e}")
@@ -232,30 +832,515 @@ class LargeCSVProcessor:
         
         return stats
     
-    def process_file_async(self, file_id: str, move_from_temp: bool = False, file_content: bytes = None):
+    def prepare_distributed_ingest(self, file_id: str) -> list:
+        """
+        Analyze the file structure and split it into record-aligned byte
+        ranges for distributed ingest.
+        
+        Returns:
+            List of (start, end) byte ranges, one per range task, or None if
+            the range tasks cannot count the file's dialect and it must be
+            ingested on a single worker
+        """
+        db_file = UploadedFile.objects.get(id=file_id)
+        if row_index.needs_parser_count(db_file.file_path):
+            logger.info(f"PROCESSOR: Dialect of {db_file.filename} needs the parser, not distributing")
+            return None
+        parts = max(1, -(-db_file.file_size // settings.CSV_DISTRIBUTED_RANGE_BYTES))
+        try:
+            ranges = row_index.find_record_ranges(db_file.file_path, parts)
+        except row_index.IrregularQuotes as e:
+            logger.info(f"PROCESSOR: Not distributing {db_file.filename}: {e}")
+            return None
+        
+        db_file.status = 'processing'
+        db_file.readable_rows = None
+        db_file.readable_bytes = None
+        db_file.save()
+        
+        columns, dtypes, estimated_rows = self.analyze_file_structure(db_file.file_path)
+        
+        db_file.columns = columns
+        db_file.dtypes = dtypes
+        db_file.total_rows = estimated_rows
+        db_file.processing_progress = 10.0
+        db_file.save()
+        
+        logger.info(f"PROCESSOR: Split {db_file.filename} into {len(ranges)} ranges for distributed ingest")
+        return ranges
+    
+    def analyze_byte_range(self, file_id: str, range_index: int, start: int, end: int, range_count: int) -> Dict[str, Any]:
+        """
+        Compute the partial statistics and row index segment of one byte range.
+        
+        The result is also written to a per-range artifact, so re-running the
+        ingest only recomputes ranges that never finished.
+        
+        Returns:
+            JSON-serializable dict with rows, null counts, dtypes and checkpoints
+        """
+        db_file = UploadedFile.objects.get(id=file_id)
+        results_dir = artifact_path(db_file.file_path, 'ranges')
+        result_path = os.path.join(results_dir, f"{range_index:05d}.json")
+        if os.path.exists(result_path):
+            with open(result_path) as cached:
+                result = json.load(cached)
+            if result['start'] == start and result['end'] == end:
+                logger.info(f"PROCESSOR: Reusing finished range {range_index} of {file_id}")
+                self._advance_range_progress(file_id, range_count)
+                self._publish_range_watermark(file_id, results_dir)
+                return result
+        
+        cancel = CancellationCheck(file_id, db_file.file_path)
+        field_check = validation.FieldCountCheck(len(db_file.columns))
+        rows, checkpoints = row_index.scan_records(
+            db_file.file_path, start, end, settings.CSV_ROW_INDEX_STRIDE, progress=cancel, field_counts=field_check
+        )
+        
+        distributions = ColumnDistributionCollector()
+        reservoir = ReservoirSampler(seed=range_index)
+        zones = ZoneMapCollector()
+        validator = validation.ValidationCollector(db_file.validation_rules, db_file.columns)
+        profile = self._profile_byte_range(
+            db_file.file_path, db_file.columns, start, end, [distributions, reservoir, zones, validator, cancel]
+        ) if rows else {'rows': 0, 'null_counts': {col: 0 for col in db_file.columns}, 'dtypes': {}, 'memory_usage': 0}
+        validator.add_field_counts(field_check)
+        
+        result = {
+            'range_index': range_index,
+            'start': start,
+            'end': end,
+            'rows': rows,
+            'null_counts': profile['null_counts'],
+            'dtypes': profile['dtypes'],
+            'memory_usage': profile['memory_usage'],
+            'checkpoints': checkpoints,
+            'distributions': distributions.to_dict(),
+            'validation': validator.summary(),
+        }
+        os.makedirs(results_dir, exist_ok=True)
+        reservoir.save(os.path.join(results_dir, f"{range_index:05d}.reservoir.pkl"))
+        validator.save(os.path.join(results_dir, f"{range_index:05d}.badrows.npy"))
+        zones.zone_map().save(os.path.join(results_dir, f"{range_index:05d}.zonemap.pkl"))
+        with open(result_path + '.tmp', 'w') as output:
+            json.dump(result, output)
+        os.replace(result_path + '.tmp', result_path)
+        
+        self._advance_range_progress(file_id, range_count)
+        self._publish_range_watermark(file_id, results_dir)
+        INGEST_ROWS.labels(stage='range_scan').inc(rows)
+        INGEST_BYTES.labels(stage='range_scan').inc(end - start)
+        logger.info(f"PROCESSOR: Range {range_index} of {file_id} done, {rows} rows")
+        return result
+    
+    def _profile_byte_range(self, file_path: str, columns: list, start: int, end: int, collectors: list = None) -> Dict[str, Any]:
+        """
+        Parse the data records in bytes [start, end) chunk by chunk and
+        gather row and null counts, dtypes and memory usage, feeding every
+        chunk to ``collectors`` on the way.
+        """
+        profile = {'rows': 0, 'null_counts': {col: 0 for col in columns}, 'dtypes': {}, 'memory_usage': 0}
+        with row_index.open_byte_range(file_path, start, end) as stream:
+            try:
+                # Only the header's columns, see validation.py
+                chunks = self._read_chunks(
+                    stream, file_path, start, header=None, names=columns, usecols=range(len(columns))
+                )
+                for chunk in chunks:
+                    if not profile['dtypes']:
+                        profile['dtypes'] = chunk.dtypes.astype(str).to_dict()
+                    for collector in collectors or ():
+                        collector.update(chunk)
+                    for col, count in chunk.isnull().sum().items():
+                        profile['null_counts'][col] += int(count)
+                    profile['memory_usage'] += int(chunk.memory_usage(deep=True).sum())
+                    profile['rows'] += len(chunk)
+            except pd.errors.EmptyDataError:
+                pass
+        return profile
+    
+    def _advance_range_progress(self, file_id: str, range_count: int):
+        UploadedFile.objects.filter(id=file_id).update(
+            processing_progress=F('processing_progress') + 90.0 / range_count
+        )
+    
+    def _publish_range_watermark(self, file_id: str, results_dir: str):
+        """
+        Publish the rows of the finished ranges that form an unbroken prefix
+        of the file as readable. Ranges finish in any order, so a range only
+        counts once every range before it is done.
+        """
+        rows, readable_bytes = 0, None
+        range_index = 0
+        while True:
+            result_path = os.path.join(results_dir, f"{range_index:05d}.json")
+            try:
+                with open(result_path) as finished:
+                    result = json.load(finished)
+            except FileNotFoundError:
+                break
+            if readable_bytes is not None and result['start'] != readable_bytes:
+                break
+            rows += result['rows']
+            readable_bytes = result['end']
+            range_index += 1
+        if range_index:
+            publish_watermark(file_id, rows, readable_bytes)
+    
+    def merge_range_results(self, file_id: str, results: list):
+        """
+        Merge per-range results into the UploadedFile record and persist the
+        combined row index.
+        """
+        db_file = UploadedFile.objects.get(id=file_id)
+        results = sorted(results, key=lambda result: result['start'])
+        
+        null_counts = {col: 0 for col in db_file.columns}
+        dtypes = {}
+        distributions = ColumnDistributionCollector()
+        for result in results:
+            for col, count in result['null_counts'].items():
+                null_counts[col] += count
+            mixed = distributions.merge(ColumnDistributionCollector.from_dict(result.get('distributions')))
+            if mixed:
+                logger.warning(
+                    f"PROCESSOR: Range at byte {result['start']} of {file_id} sketched {', '.join(mixed)} "
+                    f"as another kind; keeping only their counts"
+                )
+            for col, dtype in result['dtypes'].items():
+                dtypes[col] = merge_dtype(dtypes.get(col), dtype)
+        
+        total_rows = sum(result['rows'] for result in results)
+        index = row_index.merge_segments([(result['rows'], result['checkpoints']) for result in results])
+        row_index.save_row_index(db_file.file_path, index)
+        
+        # Range reservoirs and zone maps number rows from 0; shift them to
+        # file row numbers
+        reservoir = ReservoirSampler()
+        zone_maps = []
+        bad_rows = []
+        row_base = 0
+        for result in results:
+            partial_path = os.path.join(
+                artifact_path(db_file.file_path, 'ranges'), f"{result['range_index']:05d}.reservoir.pkl"
+            )
+            partial = ReservoirSampler.load(partial_path) if os.path.exists(partial_path) else None
+            if partial is not None and len(partial.sample):
+                partial.sample.index = partial.sample.index + row_base
+                reservoir.merge(partial)
+            zones_path = os.path.join(
+                artifact_path(db_file.file_path, 'ranges'), f"{result['range_index']:05d}.zonemap.pkl"
+            )
+            if os.path.exists(zones_path):
+                partial_zones = ZoneMap.load(zones_path)
+                partial_zones.shift(row_base)
+                zone_maps.append(partial_zones)
+            bad_rows_part = os.path.join(
+                artifact_path(db_file.file_path, 'ranges'), f"{result['range_index']:05d}.badrows.npy"
+            )
+            if os.path.exists(bad_rows_part):
+                entries = np.load(bad_rows_part)
+                entries['row'] += row_base
+                bad_rows.append(entries)
+            row_base += result['rows']
+        reservoir.save(reservoir_path(db_file.file_path))
+        
+        # Ranges that finished before zone maps existed leave a gap; no map then
+        if zone_maps and len(zone_maps) == len(results):
+            for partial_zones in zone_maps[1:]:
+                zone_maps[0].extend(partial_zones)
+            zone_maps[0].save(zone_map_path(db_file.file_path))
+        
+        db_file.total_rows = total_rows
+        db_file.readable_rows = total_rows
+        db_file.readable_bytes = db_file.file_size
+        db_file.dtypes = {col: dtypes.get(col, db_file.dtypes.get(col)) for col in db_file.columns}
+        db_file.statistics = {
+            'total_rows': total_rows,
+            'columns': db_file.columns,
+            'dtypes': db_file.dtypes,
+            'null_counts': null_counts,
+            'memory_usage': sum(result['memory_usage'] for result in results),
+            'file_size': os.path.getsize(db_file.file_path),
+        }
+        db_file.column_distributions = distributions.to_dict()
+        # Ranges that finished before validation existed have no summary
+        if all('validation' in result for result in results):
+            entries = np.concatenate(bad_rows) if bad_rows else np.empty(0, dtype=validation.BAD_ROW_DTYPE)
+            validation.save_entries(validation.bad_rows_path(db_file.file_path, db_file.validation_rules), entries)
+            db_file.validation = validation.merge_summaries([result['validation'] for result in results], entries)
+        db_file.status = 'completed'
+        db_file.processing_progress = 100.0
+        db_file.save()
+        
+        shutil.rmtree(artifact_path(db_file.file_path, 'ranges'), ignore_errors=True)
+        logger.info(f"PROCESSOR: Merged {len(results)} ranges for {db_file.filename}, {total_rows} rows")
+    
+    def append_to_file(self, file_id: str, uploaded_file) -> Dict[str, Any]:
+        """
+        Append the rows of an uploaded CSV batch to an ingested file and update
+        its metadata incrementally: only the appended bytes are scanned for
+        the row count, row index, null counts, dtypes, distributions and the
+        reservoir sample.
+        
+        A file shared with other records (identical uploads) is copied first,
+        so the other records keep their content.
+        
+        Args:
+            file_id: UUID of the UploadedFile record
+            uploaded_file: Django uploaded file whose header must match the file's columns
+            
+        Returns:
+            Dictionary with appended_rows, total_rows and file_size
+        
+        Raises:
+            AppendError: The batch cannot be appended (status, header, or
+                rows that do not parse); the file is left unchanged
+        """
+        while True:
+            db_file = UploadedFile.objects.get(id=file_id)
+            if not db_file.file_path:
+                raise AppendError('Files processed in memory cannot be appended to')
+            locked_path = db_file.file_path
+            with open(artifact_path(locked_path, 'append.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                db_file.refresh_from_db()
+                # A concurrent append may have moved the record to a private copy
+                if db_file.file_path == locked_path:
+                    return self._append_locked(db_file, uploaded_file)
+    
+    def _append_locked(self, db_file: UploadedFile, uploaded_file) -> Dict[str, Any]:
+        if db_file.status != 'completed':
+            raise AppendError(f'File processing not completed. Current status: {db_file.status}')
+        
+        # Header of the batch
+        source = uploaded_file.file
+        source.seek(0)
+        header_length = next((start + length for start, length, _ in row_index.record_lines(source)), 0)
+        source.seek(0)
+        header = source.read(header_length)
+        columns = pd.read_csv(io.BytesIO(header), nrows=0).columns.tolist() if header.strip() else []
+        if columns != db_file.columns:
+            raise AppendError(f'Header {columns} does not match the file columns {db_file.columns}')
+        
+        if UploadedFile.objects.filter(file_path=db_file.file_path).exclude(id=db_file.id).exists():
+            self._copy_for_append(db_file)
+        
+        file_path = db_file.file_path
+        old_size = os.path.getsize(file_path)
+        with INGEST_STAGE_SECONDS.labels(stage='append').time():
+            old_rows = db_file.total_rows or 0
+            distributions = ColumnDistributionCollector.from_dict(db_file.column_distributions) if db_file.column_distributions else None
+            appended_sample = ReservoirSampler(seed=old_rows)
+            zones = load_zone_map(file_path)
+            appended_zones = ZoneMapCollector(row_base=old_rows)
+            # Field counts come from the record scan, as at ingest; without a
+            # row index the dialect needs the parser and is not scanned
+            field_check = validation.FieldCountCheck(len(db_file.columns))
+            index = row_index.load_row_index(file_path)
+            drop_index = False
+            validator = validation.ValidationCollector(db_file.validation_rules, db_file.columns)
+            collectors = [appended_sample, appended_zones, validator] + ([distributions] if distributions else [])
+            
+            # The batch is parsed from its place in the file before anything
+            # else is updated; until then a failure cuts the file back
+            try:
+                with open(file_path, 'ab') as destination:
+                    if old_size:
+                        with open(file_path, 'rb') as existing:
+                            existing.seek(old_size - 1)
+                            if existing.read(1) != b'\n':
+                                destination.write(b'\n')
+                    start = destination.tell()
+                    shutil.copyfileobj(source, destination, 1024 * 1024)
+                end = os.path.getsize(file_path)
+                
+                if index is not None:
+                    try:
+                        scanned_rows, checkpoints = row_index.scan_records(
+                            file_path, start, end, settings.CSV_ROW_INDEX_STRIDE, field_counts=field_check
+                        )
+                    except row_index.IrregularQuotes as e:
+                        # The file cannot be indexed any more
+                        logger.info(f"PROCESSOR: Dropping the row index of {file_path}: {e}")
+                        index = None
+                        drop_index = True
+                profile = self._profile_byte_range(file_path, db_file.columns, start, end, collectors)
+            except (pd.errors.ParserError, UnicodeDecodeError) as e:
+                os.truncate(file_path, old_size)
+                raise AppendError(f'Batch could not be parsed: {e}')
+            except Exception:
+                os.truncate(file_path, old_size)
+                raise
+            rows = profile['rows']
+            validator.add_field_counts(field_check)
+            
+            if drop_index:
+                remove_artifacts(file_path, row_index.ROW_INDEX_ARTIFACT)
+            if index is not None:
+                row_index.save_row_index(file_path, np.concatenate([
+                    index, row_index.merge_segments([(scanned_rows, checkpoints)]) + [old_rows, 0]
+                ]))
+            
+            bad_rows_path = validation.bad_rows_path(file_path, db_file.validation_rules)
+            existing_bad_rows = validation.load_bad_rows(file_path, db_file.validation_rules)
+            if existing_bad_rows is not None and db_file.validation is not None:
+                appended_bad_rows = validator.entries()
+                appended_bad_rows['row'] += old_rows
+                entries = np.concatenate([np.asarray(existing_bad_rows), appended_bad_rows])
+                validation.save_entries(bad_rows_path, entries)
+                db_file.validation = validation.merge_summaries([db_file.validation, validator.summary()], entries)
+            
+            sample_path = reservoir_path(file_path)
+            if os.path.exists(sample_path) and appended_sample.sample is not None:
+                reservoir = ReservoirSampler.load(sample_path, seed=old_rows)
+                appended_sample.sample.index = appended_sample.sample.index + old_rows
+                reservoir.merge(appended_sample)
+                reservoir.save(sample_path)
+            
+            if zones is not None:
+                zones.extend(appended_zones.zone_map())
+                zones.save(zone_map_path(file_path))
+            
+            self._extend_key_indexes(file_path, db_file.columns, start, end, old_rows)
+        
+        dtypes = dict(db_file.dtypes or {})
+        for col, dtype in profile['dtypes'].items():
+            dtypes[col] = merge_dtype(dtypes.get(col), dtype)
+        
+        db_file.total_rows = old_rows + rows
+        db_file.file_size = end
+        db_file.dtypes = dtypes
+        # The hash is of the old content; the size and mtime identify the file from now on
+        db_file.content_hash = None
+        if distributions:
+            db_file.column_distributions = distributions.to_dict()
+        if db_file.statistics:
+            stats = db_file.statistics
+            db_file.statistics = {
+                **stats,
+                'total_rows': db_file.total_rows,
+                'dtypes': dtypes,
+                'null_counts': {
+                    col: stats['null_counts'].get(col, 0) + profile['null_counts'][col] for col in db_file.columns
+                },
+                'memory_usage': stats.get('memory_usage', 0) + profile['memory_usage'],
+                'file_size': end,
+            }
+        db_file.save()
+        
+        for pattern in STALE_AFTER_APPEND:
+            remove_artifacts(file_path, pattern)
+        
+        INGEST_ROWS.labels(stage='append').inc(rows)
+        INGEST_BYTES.labels(stage='append').inc(end - start)
+        logger.info(f"PROCESSOR: Appended {rows} rows ({end - start} bytes) to {db_file.filename}")
+        return {'appended_rows': rows, 'total_rows': db_file.total_rows, 'file_size': end}
+    
+    def _extend_key_indexes(self, file_path: str, columns: list, start: int, end: int, first_row: int):
+        """
+        Merge the keys of the records in bytes [start, end), the first being
+        row ``first_row``, into the built key indexes of the file. An index
+        that cannot be extended is removed and rebuilt on demand.
+        """
+        indexed = key_index.indexed_columns(file_path, columns)
+        if not indexed:
+            return
+        builders = {column: key_index.new_builder(file_path, column, first_row=first_row) for column in indexed}
+        try:
+            with row_index.open_byte_range(file_path, start, end) as stream:
+                chunks = self._read_chunks(
+                    stream, file_path, start, header=None, names=columns,
+                    usecols=[columns.index(column) for column in indexed], dtype=str, na_filter=False
+                )
+                for chunk in chunks:
+                    for builder in builders.values():
+                        builder.update(chunk)
+        except pd.errors.EmptyDataError:
+            pass
+        except Exception as e:
+            logger.error(f"PROCESSOR: Dropping the key indexes of {file_path}: {e}")
+            for column, builder in builders.items():
+                builder.discard()
+                remove_artifacts(file_path, f"{key_index.index_name(column)}.npy")
+            return
+        for column, builder in builders.items():
+            path = key_index.key_index_path(file_path, column)
+            try:
+                builder.write(path, base=path)
+            except Exception as e:
+                logger.error(f"PROCESSOR: Dropping the key index of '{column}' of {file_path}: {e}")
+                remove_artifacts(file_path, f"{key_index.index_name(column)}.npy")
+    
+    def _copy_for_append(self, db_file: UploadedFile):
+        """
+        Give the record a private copy of a shared file (and the artifacts
+        that get updated in place) before it is modified.
+        """
+        old_path = db_file.file_path
+        new_path = os.path.join(os.path.dirname(old_path), f"{uuid.uuid4()}{os.path.splitext(old_path)[1]}")
+        with INGEST_STAGE_SECONDS.labels(stage='append_copy').time():
+            shutil.copyfile(old_path, new_path)
+            key_indexes = [f"{key_index.index_name(column)}.npy" for column in
+                           key_index.indexed_columns(old_path, db_file.columns)]
+            for name in (row_index.ROW_INDEX_ARTIFACT, RESERVOIR_ARTIFACT, ZONE_MAP_ARTIFACT,
+                         validation.bad_rows_artifact(db_file.validation_rules), *key_indexes):
+                if os.path.exists(artifact_path(old_path, name)):
+                    shutil.copyfile(artifact_path(old_path, name), artifact_path(new_path, name))
+        db_file.file_path = new_path
+        db_file.save(update_fields=['file_path'])
+        logger.info(f"PROCESSOR: Copied shared file {old_path} to {new_path} before appending")
+    
+    def process_file_async(self, file_id: str, move_from_temp: bool = False, file_content: bytes = None,
+                           spool_path: str = None):
         """
         Process file asynchronously (to be used with Celery).
         
         Args:
             file_id: UUID of the UploadedFile record
             move_from_temp: If True, move file from temp to permanent location first
-            file_content: For large files, process directly from memory content
+            file_content: Content received in memory; it is spooled to disk and
+                ingested like spool_path
+            spool_path: File on shared storage holding the content of a record
+                without file_path; it is moved into the upload directory
+        
+        Raises:
+            IngestCancelled: The record was deleted while processing
         """
         try:
             logger.info(f"PROCESSOR: Starting async processing for file {file_id}")
             db_file = UploadedFile.objects.get(id=file_id)
             logger.info(f"PROCESSOR: Found file record: {db_file.filename}")
+            # Checked between chunks and before every save, which would
+            # otherwise re-create a deleted record
+            cancel = CancellationCheck(file_id, db_file.file_path)
             
             db_file.status = 'processing'
+            db_file.readable_rows = None
+            db_file.readable_bytes = None
             db_file.save()
             logger.info(f"PROCESSOR: Updated status to processing")
             
             # Handle different processing modes
             if file_content:
-                # Large file: process from memory content
-                logger.info(f"PROCESSOR: Processing large file {db_file.filename} from memory content, size: {len(file_content)} bytes")
-                columns, dtypes, estimated_rows = self.analyze_file_structure_from_content(file_content)
-                logger.info(f"PROCESSOR: Analysis complete - columns: {len(columns)}, estimated rows: {estimated_rows}")
+                logger.info(f"PROCESSOR: Spooling {len(file_content)} bytes of in-memory content for {db_file.filename}")
+                spool_path = self.spool_content(file_content, db_file.filename)
+            
+            if spool_path:
+                # Content handed over by reference: move it into place so the
+                # file is ingested, viewed and appended to from a path
+                uploads_dir = '/tmp/csv_uploads'
+                os.makedirs(uploads_dir, exist_ok=True)
+                permanent_path = os.path.join(uploads_dir, f"{uuid.uuid4()}{os.path.splitext(db_file.filename)[1]}")
+                method = move_file(spool_path, permanent_path)
+                
+                cancel.file_path = permanent_path
+                cancel.check(force=True)
+                db_file.file_path = permanent_path
+                db_file.save()
+                
+                logger.info(f"PROCESSOR: Stored {spool_path} at {permanent_path} by {method}")
+                columns, dtypes, estimated_rows = self.analyze_file_structure(db_file.file_path)
             elif move_from_temp:
                 # Move from temp to permanent location if needed
                 logger.info(f"PROCESSOR: Moving file from temp location")
@@ -266,10 +1351,11 @@ class LargeCSVProcessor:
                 permanent_path = temp_path.replace('/csv_temp_uploads/', '/csv_uploads/')
                 
                 # Move file
-                import shutil
-                shutil.move(temp_path, permanent_path)
+                move_file(temp_path, permanent_path)
                 
                 # Update database path
+                cancel.file_path = permanent_path
+                cancel.check(force=True)
                 db_file.file_path = permanent_path
                 db_file.save()
                 
@@ -281,30 +1367,71 @@ class LargeCSVProcessor:
                 columns, dtypes, estimated_rows = self.analyze_file_structure(db_file.file_path)
                 logger.info(f"PROCESSOR: Small file analysis complete")
             
-            # Update database with initial analysis
-            logger.info(f"PROCESSOR: Updating database with analysis results")
+            # Columns first, so pages below the readable watermark can be
+            # served while the rows are counted
+            cancel.check(force=True)
             db_file.columns = columns
             db_file.dtypes = dtypes
-            db_file.total_rows = estimated_rows
+            db_file.save()
+            
+            # Replace the estimate with an exact count from the byte scanner,
+            # which runs at close to disk bandwidth and builds the row index
+            total_rows = estimated_rows
+            field_check = validation.FieldCountCheck(len(columns))
+            if db_file.file_path:
+                watermark = ReadableWatermark(db_file, row_index.header_end(db_file.file_path))
+                
+                def scan_progress(rows, bytes_scanned):
+                    cancel(rows, bytes_scanned)
+                    watermark(rows, bytes_scanned)
+                
+                total_rows = self.count_rows(db_file.file_path, progress=scan_progress, field_counts=field_check)
+                logger.info(f"PROCESSOR: Exact row count: {total_rows}")
+            
+            # Update database with initial analysis
+            logger.info(f"PROCESSOR: Updating database with analysis results")
+            cancel.check(force=True)
+            db_file.total_rows = total_rows
+            db_file.readable_rows = total_rows
+            db_file.readable_bytes = db_file.file_size
             db_file.processing_progress = 50.0
             db_file.save()
             
             # Get detailed statistics only for files with physical paths
             if db_file.file_path:
                 logger.info(f"PROCESSOR: Getting detailed statistics for file with path")
-                stats = self.get_file_statistics(db_file.file_path)
+                distributions = ColumnDistributionCollector()
+                reservoir = ReservoirSampler()
+                zones = ZoneMapCollector()
+                # Field counts were checked by the row count scan
+                validator = validation.ValidationCollector(db_file.validation_rules, columns)
+                stats = self.get_file_statistics(
+                    db_file.file_path, collectors=[distributions, reservoir, zones, validator, cancel],
+                    usecols=list(range(len(columns))),
+                )
+                reservoir.save(reservoir_path(db_file.file_path))
+                zones.zone_map().save(zone_map_path(db_file.file_path))
+                validator.add_field_counts(field_check)
+                validator.save(validation.bad_rows_path(db_file.file_path, validator.declared))
                 # Update with final results
                 db_file.total_rows = stats['total_rows']
+                db_file.statistics = stats
+                db_file.column_distributions = distributions.to_dict()
+                db_file.validation = validator.summary()
                 logger.info(f"PROCESSOR: Statistics complete, final row count: {stats['total_rows']}")
             else:
                 logger.info(f"PROCESSOR: Skipping detailed statistics for memory-processed file")
             
+            cancel.check(force=True)
             db_file.status = 'completed'
             db_file.processing_progress = 100.0
             db_file.save()
             
             logger.info(f"PROCESSOR: Successfully processed file {db_file.filename}")
             
+        except IngestCancelled:
+            logger.info(f"PROCESSOR: File {file_id} was deleted, processing stopped")
+            raise
         except Exception as e:
             logger.error(f"PROCESSOR: Error processing file {file_id}: {e}")
             logger.exception("PROCESSOR: Full traceback:")
@@ -316,4 +1443,16 @@ class LargeCSVProcessor:
                 logger.info(f"PROCESSOR: Updated file {file_id} status to failed")
             except Exception as db_error:
                 logger.error(f"PROCESSOR: Failed to update database status: {db_error}")
-            raise
\ No newline at end of file
+            raise
+
+
+def merge_dtype(current: str, other: str) -> str:
+    """
+    Combine dtypes inferred independently for different parts of a file.
+    """
+    if current is None or current == other:
+        return other
+    numeric = ('int64', 'float64')
+    if current in numeric and other in numeric:
+        return 'float64'
+    return 'object'
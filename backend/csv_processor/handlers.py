@@ -0,0 +1,163 @@
+import asyncio
+import io
+import threading
+from asgiref.sync import sync_to_async
+from django.core import signals
+from django.core.exceptions import RequestAborted
+from django.core.handlers.asgi import ASGIHandler
+from django.http import FileResponse
+from django.urls import Resolver404, resolve, set_script_prefix
+
+# Routes whose view reads the request body as it arrives instead of after
+# Django spooled it to a temporary file: uploads would otherwise be written
+# to disk once by the handler and again by the multipart parser, and the
+# view's storage check would only run once the body is on disk
+STREAMED_BODY_ROUTES = {'upload_large_csv', 'append_to_file'}
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    Request body pulled from the ASGI connection as it is read. Reads block
+    the calling thread (the view's executor thread) on the event loop, so
+    they must not happen on the loop itself.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._pending = memoryview(b'')
+        self._more = True
+        self.aborted = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if threading.get_ident() == self._loop_thread:
+            raise RuntimeError("Streamed request bodies cannot be read on the event loop")
+        while not self._pending and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                self.aborted = True
+                raise RequestAborted()
+            self._pending = memoryview(message.get('body', b''))
+            self._more = message.get('more_body', False)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def finish(self):
+        """
+        Read nothing more: the view is done, and whatever it left unread
+        (e.g. a refused upload) must not be pulled in by later readers such
+        as the error reporter parsing request.POST.
+        """
+        self._pending = memoryview(b'')
+        self._more = False
+
+
+class DisconnectAwareASGIHandler(ASGIHandler):
+    """
+    ASGI handler that cancels the view when the client disconnects before
+    the response is ready (the behaviour Django adopts in 5.0). Cancelling
+    an offloaded read drops its job if it is still queued on the executor.
+    
+    Requests to STREAMED_BODY_ROUTES are handed to the view before their
+    body is read; a disconnect shows up as RequestAborted while the view
+    reads the body.
+    """
+
+    def load_middleware(self, is_async=False):
+        super().load_middleware(is_async)
+        chain = self._middleware_chain
+
+        async def finish_streamed_body(request):
+            try:
+                return await chain(request)
+            finally:
+                if isinstance(request._stream, ReceiveStream):
+                    request._stream.finish()
+
+        self._middleware_chain = finish_streamed_body
+
+    async def handle(self, scope, receive, send):
+        if self.streams_body(scope):
+            await self.handle_streamed(scope, receive, send)
+            return
+        try:
+            body_file = await self.read_body(receive)
+        except RequestAborted:
+            return
+        set_script_prefix(self.get_script_prefix(scope))
+        await sync_to_async(signals.request_started.send, thread_sensitive=True)(
+            sender=self.__class__, scope=scope
+        )
+        request, error_response = self.create_request(scope, body_file)
+        if request is None:
+            body_file.close()
+            await self.send_response(error_response, send)
+            return
+
+        tasks = [
+            asyncio.create_task(self.get_response_async(request)),
+            asyncio.create_task(self.listen_for_disconnect(receive)),
+        ]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        done, pending = done.pop(), pending.pop()
+        pending.cancel()
+        try:
+            await pending
+        except (asyncio.CancelledError, RequestAborted):
+            pass
+        try:
+            response = done.result()
+        except RequestAborted:
+            body_file.close()
+            return
+
+        response._handler_class = self.__class__
+        if isinstance(response, FileResponse):
+            response.block_size = self.chunk_size
+        await self.send_response(response, send)
+
+    async def handle_streamed(self, scope, receive, send):
+        body_file = ReceiveStream(receive, asyncio.get_running_loop())
+        set_script_prefix(self.get_script_prefix(scope))
+        await sync_to_async(signals.request_started.send, thread_sensitive=True)(
+            sender=self.__class__, scope=scope
+        )
+        request, error_response = self.create_request(scope, body_file)
+        if request is None:
+            await self.send_response(error_response, send)
+            return
+        try:
+            response = await self.get_response_async(request)
+        except RequestAborted:
+            return
+        if body_file.aborted:
+            return
+
+        response._handler_class = self.__class__
+        if isinstance(response, FileResponse):
+            response.block_size = self.chunk_size
+        await self.send_response(response, send)
+
+    def streams_body(self, scope) -> bool:
+        if scope['method'] != 'POST':
+            return False
+        script_name = scope.get('root_path', '')
+        path = scope['path']
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+        try:
+            return resolve(path).url_name in STREAMED_BODY_ROUTES
+        except Resolver404:
+            return False
+
+    async def listen_for_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise RequestAborted()
@@ -0,0 +1,212 @@
+import os
+import time
+from django.conf import settings
+from django.db.models import Q
+from redis.exceptions import RedisError
+from .artifacts import remove_artifacts
+from .models import UploadedFile
+from .redis_client import get_redis, mark_unavailable
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Scheduling of ingest work. Uploads are routed to a Celery queue by size so
+# small files never wait behind multi-gigabyte ingests, the bytes being
+# ingested at once are capped across all workers (admission control), and a
+# running ingest checks between chunks whether its record was deleted.
+#
+# While it runs, an ingest also publishes a readable watermark: the rows
+# (and bytes) from the start of the file it has already scanned, so their
+# pages can be served before the whole file is processed.
+
+RESERVATIONS_KEY = 'csv:ingest:reservations'  # zset: file_id -> expiry
+RESERVED_BYTES_KEY = 'csv:ingest:reserved_bytes'  # hash: file_id -> bytes
+
+# Drops expired reservations, then reserves ARGV[3] bytes for ARGV[2] unless
+# that would exceed the cap ARGV[4]. A single file larger than the cap is
+# admitted when nothing else is running, so it cannot starve forever.
+RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+for _, member in ipairs(redis.call('zrangebyscore', KEYS[1], '-inf', now)) do
+    redis.call('hdel', KEYS[2], member)
+end
+redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+if redis.call('hexists', KEYS[2], ARGV[2]) == 1 then
+    redis.call('zadd', KEYS[1], now + tonumber(ARGV[5]), ARGV[2])
+    return 1
+end
+local total = 0
+for _, reserved in ipairs(redis.call('hvals', KEYS[2])) do
+    total = total + tonumber(reserved)
+end
+local size = tonumber(ARGV[3])
+if total > 0 and total + size > tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('hset', KEYS[2], ARGV[2], size)
+redis.call('zadd', KEYS[1], now + tonumber(ARGV[5]), ARGV[2])
+return 1
+"""
+
+
+class IngestCancelled(Exception):
+    """
+    Raised inside an ingest whose UploadedFile record was deleted.
+    """
+
+    def __init__(self, file_id, file_path=None):
+        super().__init__(f"Ingest of {file_id} was cancelled")
+        self.file_id = file_id
+        self.file_path = file_path
+
+
+def ingest_queue(file_size: int) -> str:
+    """
+    Celery queue for ingesting a file of ``file_size`` bytes, from the
+    (max_bytes, queue) pairs of CSV_INGEST_QUEUES.
+    """
+    for max_bytes, queue in settings.CSV_INGEST_QUEUES:
+        if max_bytes is None or file_size < max_bytes:
+            return queue
+    return settings.CSV_INGEST_QUEUES[-1][1]
+
+
+def needs_admission(file_size: int) -> bool:
+    return file_size >= settings.CSV_INGEST_ADMISSION_MIN_BYTES
+
+
+def reserve_ingest_bytes(file_id, file_size: int) -> bool:
+    """
+    Reserve ``file_size`` bytes of the CSV_INGEST_MAX_BYTES budget for an
+    ingest. Reserving again for the same file refreshes the reservation.
+    Without Redis every ingest is admitted.
+
+    Returns:
+        True if the ingest may start now
+    """
+    client = get_redis()
+    if client is None:
+        return True
+    try:
+        admitted = client.eval(
+            RESERVE_SCRIPT, 2, RESERVATIONS_KEY, RESERVED_BYTES_KEY,
+            time.time(), str(file_id), int(file_size),
+            settings.CSV_INGEST_MAX_BYTES, settings.CSV_INGEST_RESERVATION_TTL,
+        )
+    except RedisError as e:
+        mark_unavailable(e)
+        return True
+    return bool(admitted)
+
+
+def release_ingest_bytes(file_id):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        pipeline = client.pipeline()
+        pipeline.zrem(RESERVATIONS_KEY, str(file_id))
+        pipeline.hdel(RESERVED_BYTES_KEY, str(file_id))
+        pipeline.execute()
+    except RedisError as e:
+        mark_unavailable(e)
+
+
+class CancellationCheck:
+    """
+    Ingest collector (and scan progress callback) raising IngestCancelled
+    once the UploadedFile record is gone. The database is asked at most
+    every ``interval`` seconds.
+    """
+
+    def __init__(self, file_id, file_path: str = None, interval: float = None):
+        self.file_id = file_id
+        self.file_path = file_path
+        self.interval = settings.CSV_INGEST_CANCEL_CHECK_SECONDS if interval is None else interval
+        self.checked_at = None
+
+    def check(self, force: bool = False):
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < self.interval:
+            return
+        self.checked_at = now
+        try:
+            UploadedFile.objects.get(id=self.file_id)
+        except UploadedFile.DoesNotExist:
+            raise IngestCancelled(self.file_id, self.file_path)
+
+    def update(self, chunk):
+        self.check()
+
+    def __call__(self, *progress):
+        self.check()
+
+
+def publish_watermark(file_id, rows: int, readable_bytes: int = None) -> bool:
+    """
+    Record that the first ``rows`` data rows (ending at byte
+    ``readable_bytes``) can be read. The watermark only moves forward, and
+    only while the file is processing.
+
+    Returns:
+        True if the watermark was moved
+    """
+    updated = UploadedFile.objects.filter(id=file_id, status='processing').filter(
+        Q(readable_rows__isnull=True) | Q(readable_rows__lt=rows)
+    ).update(readable_rows=rows, readable_bytes=readable_bytes)
+    return bool(updated)
+
+
+class ReadableWatermark:
+    """
+    Scan progress callback of a single-worker ingest publishing the readable
+    watermark of ``db_file``, at most every ``interval`` seconds; the first
+    call publishes right away, so the first page is readable after the
+    first scanned buffer. Run the cancellation check before it, as saving
+    a deleted record fails.
+    """
+
+    def __init__(self, db_file, data_start: int = 0, interval: float = None):
+        self.db_file = db_file
+        self.data_start = data_start
+        self.interval = settings.CSV_WATERMARK_INTERVAL_SECONDS if interval is None else interval
+        self.published_at = None
+
+    def __call__(self, rows: int, bytes_scanned: int = None):
+        now = time.monotonic()
+        if self.published_at is not None and now - self.published_at < self.interval:
+            return
+        self.published_at = now
+        self.db_file.readable_rows = rows
+        self.db_file.readable_bytes = None if bytes_scanned is None else self.data_start + bytes_scanned
+        self.db_file.save(update_fields=['readable_rows', 'readable_bytes'])
+
+
+def discard_cancelled_ingest(file_path: str):
+    """
+    Remove what a cancelled ingest left behind: the file and artifacts it
+    may have written after the record was deleted, unless another record
+    still uses the same path.
+    """
+    if not file_path or UploadedFile.objects.filter(file_path=file_path).exists():
+        return
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    remove_artifacts(file_path)
+    logger.info(f"Removed leftovers of cancelled ingest at {file_path}")
+
+
+def revoke_ingest(db_file):
+    """
+    Revoke the queued ingest task of ``db_file``. A task that already started
+    stops at its next cancellation check once the record is deleted.
+    """
+    if not db_file.task_id:
+        return
+    from celery import current_app
+    try:
+        current_app.control.revoke(db_file.task_id)
+        logger.info(f"Revoked ingest task {db_file.task_id} of {db_file.id}")
+    except Exception as e:
+        logger.warning(f"Could not revoke ingest task {db_file.task_id}: {e}")
+    release_ingest_bytes(db_file.id)
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .artifacts import artifact_path, list_artifacts
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A key index answers "which rows hold this value" for one column. Every
+# value is hashed to 64 bits as raw text (no type inference, so "007" and
+# "7" are different keys) and the index is a (2, n) uint64 array of hashes
+# and row numbers sorted by hash, searched with binary search on an mmap.
+# Rows are read back through the row index and compared to the value, which
+# also weeds out hash collisions.
+#
+# Pairs are sorted in memory up to CSV_KEY_INDEX_RUN_ROWS; beyond that each
+# batch is sorted and spilled as a run, and the runs are combined by a k-way
+# merge reading a block of every run at a time. Memory stays bounded on any
+# file size and any key distribution, a single value on every row included.
+
+
+def index_name(column: str) -> str:
+    return f"keyidx-{hashlib.blake2b(column.encode('utf-8'), digest_size=8).hexdigest()}"
+
+
+def key_index_path(file_path: str, column: str) -> str:
+    return artifact_path(file_path, f"{index_name(column)}.npy")
+
+
+def key_hashes(values) -> np.ndarray:
+    """
+    64-bit hashes of raw text values.
+    """
+    return pd.util.hash_array(np.asarray(values, dtype=object), categorize=False)
+
+
+def sort_pairs(pairs: np.ndarray) -> np.ndarray:
+    """
+    (hash, row) pairs ordered by hash, rows ascending within a hash.
+    """
+    return pairs[:, np.lexsort((pairs[1], pairs[0]))]
+
+
+def merge_runs(runs: list, output: np.ndarray, block: int):
+    """
+    Merge sorted (2, n) runs (arrays or mmaps) into ``output``, holding at
+    most about ``2 * block`` pairs of each run in memory.
+    
+    Every round emits the buffered pairs up to the smallest last buffered
+    pair of the runs not fully read yet; nothing after it in those runs can
+    sort before it, and the run that set it is drained and read further.
+    """
+    buffers = [np.asarray(run[:, :block]) for run in runs]
+    read = [buffer.shape[1] for buffer in buffers]
+    position = 0
+    while True:
+        open_runs = [i for i, run in enumerate(runs) if read[i] < run.shape[1]]
+        if open_runs:
+            bound = min((buffers[i][0, -1], buffers[i][1, -1]) for i in open_runs)
+        emitted = []
+        for i, buffer in enumerate(buffers):
+            if open_runs:
+                keys, rows = buffer
+                taken = int(((keys < bound[0]) | ((keys == bound[0]) & (rows <= bound[1]))).sum())
+            else:
+                taken = buffer.shape[1]
+            emitted.append(buffer[:, :taken])
+            buffers[i] = buffer[:, taken:]
+        pairs = sort_pairs(np.hstack(emitted))
+        output[:, position:position + pairs.shape[1]] = pairs
+        position += pairs.shape[1]
+        if not open_runs:
+            return
+        for i in open_runs:
+            if buffers[i].shape[1] < block:
+                more = np.asarray(runs[i][:, read[i]:read[i] + block])
+                buffers[i] = np.hstack([buffers[i], more])
+                read[i] += more.shape[1]
+
+
+class KeyIndexBuilder:
+    """
+    Collects (hash, row) pairs of ``column`` chunk by chunk and writes the
+    sorted index. Chunks must hold the column as raw strings; the first one
+    is row ``first_row``.
+    """
+
+    def __init__(self, column: str, spill_dir: str, run_rows: int = None, first_row: int = 0):
+        self.column = column
+        self.spill_dir = spill_dir
+        self.run_rows = run_rows or settings.CSV_KEY_INDEX_RUN_ROWS
+        self.first_row = first_row
+        self.rows = 0
+        self._pending = []
+        self._pending_rows = 0
+        self._runs = []
+
+    def update(self, chunk: pd.DataFrame):
+        keys = key_hashes(chunk[self.column].to_numpy())
+        first = self.first_row + self.rows
+        rows = np.arange(first, first + len(chunk), dtype=np.uint64)
+        self._pending.append(np.vstack([keys, rows]))
+        self.rows += len(chunk)
+        self._pending_rows += len(chunk)
+        if self._pending_rows >= self.run_rows:
+            self._spill()
+
+    def _take_pending(self) -> np.ndarray:
+        pairs = np.hstack(self._pending) if self._pending else np.empty((2, 0), dtype=np.uint64)
+        self._pending = []
+        self._pending_rows = 0
+        return pairs
+
+    def _spill(self):
+        pairs = sort_pairs(self._take_pending())
+        os.makedirs(self.spill_dir, exist_ok=True)
+        run_path = os.path.join(self.spill_dir, f"run-{len(self._runs):05d}.bin")
+        # Pairs interleaved, in index order
+        pairs.T.tofile(run_path)
+        self._runs.append(run_path)
+        logger.info(f"Key index of '{self.column}' spilled {pairs.shape[1]} pairs to {self.spill_dir}")
+
+    def discard(self):
+        """
+        Remove the spill files without writing an index.
+        """
+        self._pending = []
+        self._pending_rows = 0
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def write(self, path: str, base: str = None):
+        """
+        Write the sorted index to ``path`` (through a temporary name) and
+        remove the spill files. ``base`` is a built index merged in as one
+        more run, the index of the rows before ``first_row`` on append.
+        """
+        build_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if not self._runs and base is None:
+                with open(build_path, 'wb') as output:
+                    np.save(output, sort_pairs(self._take_pending()))
+            else:
+                if self._pending:
+                    self._spill()
+                runs = [np.memmap(run_path, dtype=np.uint64, mode='r').reshape(-1, 2).T for run_path in self._runs]
+                if base is not None:
+                    runs.append(np.load(base, mmap_mode='r'))
+                total = sum(run.shape[1] for run in runs)
+                index = np.lib.format.open_memmap(build_path, mode='w+', dtype=np.uint64, shape=(2, total))
+                merge_runs(runs, index, max(1, self.run_rows // len(runs)))
+                index.flush()
+                del index, runs
+            os.replace(build_path, path)
+        finally:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            if os.path.exists(build_path):
+                os.remove(build_path)
+
+
+class KeyIndex:
+    """
+    A built key index, memory-mapped.
+    """
+
+    def __init__(self, path: str):
+        self.entries = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return self.entries.shape[1]
+
+    def rows_for(self, value: str) -> np.ndarray:
+        """
+        Row numbers whose key hashes like ``value``, in ascending order.
+        """
+        key = key_hashes([value])[0]
+        keys = self.entries[0]
+        start = int(np.searchsorted(keys, key, side='left'))
+        end = int(np.searchsorted(keys, key, side='right'))
+        return np.asarray(self.entries[1, start:end], dtype=np.int64)
+
+
+def load_key_index(file_path: str, column: str):
+    """
+    The key index of ``column``, or None if it was not built.
+    """
+    path = key_index_path(file_path, column)
+    if not os.path.exists(path):
+        return None
+    return KeyIndex(path)
+
+
+def new_builder(file_path: str, column: str, first_row: int = 0) -> KeyIndexBuilder:
+    spill_dir = artifact_path(file_path, f"{index_name(column)}.{uuid.uuid4().hex}.spill")
+    return KeyIndexBuilder(column, spill_dir, first_row=first_row)
+
+
+def indexed_columns(file_path: str, columns: list) -> list:
+    """
+    Those of ``columns`` that have a key index.
+    """
+    built = set(list_artifacts(file_path, 'keyidx-*.npy'))
+    return [column for column in columns if key_index_path(file_path, column) in built]
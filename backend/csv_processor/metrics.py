@@ -0,0 +1,202 @@
+import os
+import time
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from celery import signals
+import logging
+
+logger = logging.getLogger(__name__)
+
+# When PROMETHEUS_MULTIPROC_DIR is set (gunicorn workers, Celery prefork pool)
+# prometheus_client writes every sample to mmapped files in that directory and
+# the /metrics view aggregates them with a MultiProcessCollector.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+INGEST_STAGE_SECONDS = Histogram(
+    'csv_ingest_stage_seconds',
+    'Duration of each ingest stage (upload_copy, analysis, stats_scan)',
+    ['stage'],
+    buckets=STAGE_BUCKETS,
+)
+INGEST_BYTES = Counter(
+    'csv_ingest_bytes_total',
+    'Bytes processed by each ingest stage, use rate() for bytes per second',
+    ['stage'],
+)
+INGEST_ROWS = Counter(
+    'csv_ingest_rows_total',
+    'Rows processed by each ingest stage, use rate() for rows per second',
+    ['stage'],
+)
+DATA_CHUNK_SECONDS = Histogram(
+    'csv_data_chunk_seconds',
+    'Latency of LargeCSVProcessor.get_data_chunk by starting row offset',
+    ['offset_bucket'],
+    buckets=LATENCY_BUCKETS,
+)
+SERIALIZATION_SECONDS = Histogram(
+    'csv_serialization_seconds',
+    'Time spent turning DataFrames into JSON-ready records',
+    ['endpoint'],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    'csv_http_request_seconds',
+    'HTTP request latency per endpoint',
+    ['endpoint', 'method', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+CELERY_QUEUE_WAIT_SECONDS = Histogram(
+    'csv_celery_queue_wait_seconds',
+    'Time between a task being published and a worker starting it',
+    ['task'],
+    buckets=STAGE_BUCKETS,
+)
+CELERY_TASK_SECONDS = Histogram(
+    'csv_celery_task_seconds',
+    'Celery task run time',
+    ['task', 'state'],
+    buckets=STAGE_BUCKETS,
+)
+EXECUTOR_WAIT_SECONDS = Histogram(
+    'csv_executor_wait_seconds',
+    'Time an offloaded request waited for an executor thread',
+    ['pool', 'endpoint'],
+    buckets=LATENCY_BUCKETS,
+)
+EXECUTOR_REJECTED = Counter(
+    'csv_executor_rejected_total',
+    'Requests answered with 503 because their executor was saturated',
+    ['pool', 'endpoint'],
+)
+SINGLE_FLIGHT_REQUESTS = Counter(
+    'csv_single_flight_requests_total',
+    'Single-flight calls by role: leader computed the result, coalesced_local '
+    'shared one computed in this process, waited_redis computed it after '
+    'another process finished',
+    ['flight', 'role'],
+)
+UPLOAD_FINALIZE = Counter(
+    'csv_upload_finalize_total',
+    'Uploads stored by method: rename, copy_file_range or sendfile of the '
+    'spooled file, or write of an in-memory upload',
+    ['method'],
+)
+INGEST_ADMISSION_DEFERRED = Counter(
+    'csv_ingest_admission_deferred_total',
+    'Ingest starts postponed because CSV_INGEST_MAX_BYTES were already in flight',
+    ['queue'],
+)
+INGEST_CANCELLED = Counter(
+    'csv_ingest_cancelled_total',
+    'Ingests stopped because their file was deleted',
+)
+STORAGE_FREED_BYTES = Counter(
+    'csv_storage_freed_bytes_total',
+    'Bytes removed from the upload directories by reason: deleted, orphan, '
+    'evicted_artifact or evicted_file (evicted files count as deleted too)',
+    ['reason'],
+)
+CHUNK_ROWS = Histogram(
+    'csv_chunk_rows',
+    'Rows per parsed chunk as chosen by the chunk sizer',
+    buckets=(100, 1000, 10000, 50000, 100000, 250000, 500000, 1000000),
+)
+CHUNK_BYTES = Histogram(
+    'csv_chunk_bytes',
+    'Estimated memory taken by each parsed chunk',
+    buckets=tuple(1024 ** 2 * size for size in (1, 8, 32, 64, 128, 256, 512, 1024, 4096)),
+)
+CHUNK_DECISIONS = Counter(
+    'csv_chunk_size_changes_total',
+    'Chunk size changes by what bounded the new size: initial, budget, '
+    'pressure (little memory available), min_rows or max_rows',
+    ['limit'],
+)
+CACHE_REQUESTS = Counter(
+    'csv_cache_requests_total',
+    'Cache lookups by cache name and result (hit or miss)',
+    ['cache', 'result'],
+)
+
+PUBLISHED_AT_HEADER = 'csv_published_at'
+
+
+def offset_bucket(offset: int) -> str:
+    """
+    Map a row offset to a coarse, low-cardinality label (0, <1e3 ... >=1e8).
+    """
+    if offset <= 0:
+        return '0'
+    for exponent in range(3, 9):
+        if offset < 10 ** exponent:
+            return f'<1e{exponent}'
+    return '>=1e8'
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def get_registry():
+    """
+    Return the registry to export: a multiprocess aggregate when
+    PROMETHEUS_MULTIPROC_DIR is configured, the default registry otherwise.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_latest():
+    """
+    Returns:
+        Tuple of (payload bytes, content type) in the Prometheus text format
+    """
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+
+# Celery instrumentation. The publish timestamp travels as a message header so
+# the worker can tell how long the task sat in the broker queue.
+_task_started_at = {}
+
+
+@signals.before_task_publish.connect
+def _stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
+
+
+@signals.task_prerun.connect
+def _observe_queue_wait(task_id=None, task=None, **kwargs):
+    _task_started_at[task_id] = time.perf_counter()
+    request = task.request
+    published_at = getattr(request, PUBLISHED_AT_HEADER, None)
+    if published_at is None and request.headers:
+        published_at = request.headers.get(PUBLISHED_AT_HEADER)
+    if published_at is not None:
+        CELERY_QUEUE_WAIT_SECONDS.labels(task=task.name).observe(max(0.0, time.time() - float(published_at)))
+
+
+@signals.task_postrun.connect
+def _observe_task_runtime(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started_at.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_SECONDS.labels(task=task.name, state=state or 'UNKNOWN').observe(time.perf_counter() - started)
+
+
+@signals.worker_process_shutdown.connect
+def _mark_worker_process_dead(pid=None, **kwargs):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,108 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.urls import Resolver404, resolve
+from .metrics import REQUEST_SECONDS
+from .profiling import profiled, requested_mode
+
+# Both middlewares support sync (WSGI) and async (ASGI) chains, so async
+# views are not pushed back onto a thread to run through them.
+
+
+class RequestMetricsMiddleware:
+    """
+    Record per-endpoint request latency, labelled by the resolved URL name
+    so high-cardinality paths (file ids, page numbers) stay out of the labels.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    def _observe(self, request, response, start):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.url_name if match and match.url_name else 'unmatched'
+        REQUEST_SECONDS.labels(
+            endpoint=endpoint,
+            method=request.method,
+            status=str(response.status_code),
+        ).observe(time.perf_counter() - start)
+
+
+class ProfilingMiddleware:
+    """
+    Profile a whole request, view and renderer included, when the client
+    sends ``X-CSV-Profile: cprofile`` (or ``sample``). Requests without the
+    header only pay for one META lookup. The header is ignored unless the
+    user is staff, or CSV_PROFILE_STAFF_ONLY is off: profiling slows the
+    request down and writes to disk.
+    
+    In an async chain the profiler would only see the event loop, so the
+    mode is left on the request for the executor, which profiles the
+    view on its worker thread (see executor.offloaded).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        mode = requested_mode(request)
+        if not mode or not self._allowed(request):
+            return self.get_response(request)
+
+        with profiled(self._label(request), mode) as profile:
+            response = self.get_response(request)
+        response['X-CSV-Profile-Id'] = profile.profile_id
+        return response
+
+    async def __acall__(self, request):
+        mode = requested_mode(request)
+        # The user is loaded from the session, which is sync only
+        if not mode or not await sync_to_async(self._allowed)(request):
+            return await self.get_response(request)
+
+        request.csv_profile = (self._label(request), mode)
+        response = await self.get_response(request)
+        profile_id = getattr(request, 'csv_profile_id', None)
+        if profile_id:
+            response['X-CSV-Profile-Id'] = profile_id
+        return response
+
+    def _allowed(self, request) -> bool:
+        if not settings.CSV_PROFILE_STAFF_ONLY:
+            return True
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_staff)
+
+    def _label(self, request) -> str:
+        try:
+            return resolve(request.path_info).url_name or 'request'
+        except Resolver404:
+            return 'request'
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 07:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_processor', '0002_alter_uploadedfile_file_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='statistics',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 07:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_processor', '0004_uploadedfile_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='column_distributions',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
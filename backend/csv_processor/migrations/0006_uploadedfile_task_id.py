@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_processor', '0005_uploadedfile_column_distributions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_processor', '0007_uploadedfile_readable_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='last_accessed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
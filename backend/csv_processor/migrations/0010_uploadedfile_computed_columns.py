@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('csv_processor', '0009_uploadedfile_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='computed_columns',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
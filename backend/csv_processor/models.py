@@ -1,6 +1,5 @@
-from django.db import models
+from django.db import models, transaction
 import uuid
-import os
 
 
 class UploadedFile(models.Model):
@@ -15,12 +14,23 @@ class UploadedFile(models.Model):
     filename = models.CharField(max_length=255)
     file_path = models.CharField(max_length=500, blank=True)  # Optional for memory-only processing
     file_size = models.BigIntegerField()
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)  # BLAKE2b of the file bytes
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
     total_rows = models.BigIntegerField(null=True, blank=True)
+    # While processing: rows (and bytes) already scanned, which can be paged
+    readable_rows = models.BigIntegerField(null=True, blank=True)
+    readable_bytes = models.BigIntegerField(null=True, blank=True)
     columns = models.JSONField(null=True, blank=True)
     dtypes = models.JSONField(null=True, blank=True)
+    statistics = models.JSONField(null=True, blank=True)  # Row/null counts gathered at ingest
+    column_distributions = models.JSONField(null=True, blank=True)  # Per-column histogram / top-K sketches
+    validation_rules = models.JSONField(null=True, blank=True)  # Per-column rules checked at ingest
+    validation = models.JSONField(null=True, blank=True)  # Bad-row counts by reason and column
+    computed_columns = models.JSONField(null=True, blank=True)  # [{name, expression}], evaluated per page
     processing_progress = models.FloatField(default=0.0)
     error_message = models.TextField(null=True, blank=True)
+    task_id = models.CharField(max_length=255, null=True, blank=True)  # Celery ingest task, revoked on delete
+    last_accessed_at = models.DateTimeField(null=True, blank=True, db_index=True)  # Last read, for eviction
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -28,7 +38,20 @@ class UploadedFile(models.Model):
         return f"{self.filename} ({self.status})"
     
     def delete(self, *args, **kwargs):
-        # Clean up the file when deleting the record (only if file exists on disk)
-        if self.file_path and os.path.exists(self.file_path):
-            os.remove(self.file_path)
-        super().delete(*args, **kwargs)
\ No newline at end of file
+        # Records with identical content share one file_path, which acts as the
+        # reference count: physical data goes with the last record using it.
+        # The records of the path are locked, as share_duplicate_content
+        # locks the original it points a new record at
+        with transaction.atomic():
+            sharing = list(
+                UploadedFile.objects.select_for_update().filter(file_path=self.file_path).order_by('created_at')
+            ) if self.file_path else []
+            shared = any(other.id != self.id for other in sharing)
+            
+            # Clean up the file when deleting the record (only if file exists on disk)
+            # along with its artifacts: row index, zone map, key indexes, ...
+            # Large files are only moved to the trash here, see storage.py
+            if not shared:
+                from .storage import discard_file
+                discard_file(self.file_path)
+            return super().delete(*args, **kwargs)
@@ -0,0 +1,227 @@
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_CSV_PROFILE'
+PROFILE_MODES = ('cprofile', 'sample')
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{14}-[a-z_]+-[0-9a-f]{8}\.(prof|collapsed)$')
+
+
+class ProfileSession:
+    """
+    Handle returned by ``profiled``; ``profile_id`` is known up front so
+    callers can report it (response header, log line) before the file lands.
+    """
+
+    def __init__(self, label: str, mode: str):
+        self.label = label
+        self.mode = mode
+        extension = 'prof' if mode == 'cprofile' else 'collapsed'
+        stamp = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        self.profile_id = f"{stamp}-{label}-{uuid.uuid4().hex[:8]}.{extension}"
+
+    @property
+    def path(self) -> str:
+        return os.path.join(settings.CSV_PROFILE_DIR, self.profile_id)
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample the call stack of one thread at a fixed interval and count
+    identical stacks, which is exactly the collapsed-stacks format.
+    """
+
+    def __init__(self, target_thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def requested_mode(request) -> str:
+    """
+    Read the profiling mode from the X-CSV-Profile request header.
+
+    Returns:
+        'cprofile', 'sample' or None when profiling is not requested
+    """
+    value = request.META.get(PROFILE_HEADER)
+    if not value:
+        return None
+    return normalize_mode(value)
+
+
+def normalize_mode(value) -> str:
+    if not value or not settings.CSV_PROFILING_ENABLED:
+        return None
+    if value is True or str(value).lower() in ('1', 'true', 'yes'):
+        return 'cprofile'
+    value = str(value).lower()
+    return value if value in PROFILE_MODES else None
+
+
+@contextmanager
+def profiled(label: str, mode: str = None):
+    """
+    Profile the enclosed block when ``mode`` is set; otherwise a no-op.
+
+    Yields:
+        ProfileSession, or None when profiling is off
+    """
+    if not mode:
+        yield None
+        return
+
+    session = ProfileSession(label, mode)
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield session
+        finally:
+            profiler.disable()
+            _store(session, lambda path: profiler.dump_stats(path))
+    else:
+        sampler = StackSampler(threading.get_ident(), settings.CSV_PROFILE_SAMPLE_INTERVAL)
+        sampler.start()
+        try:
+            yield session
+        finally:
+            sampler.stop()
+            _store(session, lambda path: _write_collapsed(path, sampler.stacks))
+
+
+def _store(session: ProfileSession, writer):
+    try:
+        os.makedirs(settings.CSV_PROFILE_DIR, exist_ok=True)
+        writer(session.path)
+        logger.info(f"Stored {session.mode} profile {session.profile_id}")
+        enforce_retention()
+    except Exception as e:
+        logger.error(f"Failed to store profile {session.profile_id}: {e}")
+
+
+def _write_collapsed(path: str, stacks: Counter):
+    with open(path, 'w') as output:
+        for stack, count in stacks.most_common():
+            output.write(f"{stack} {count}\n")
+
+
+def enforce_retention():
+    """
+    Keep only the newest CSV_PROFILE_RETENTION profiles.
+    """
+    profiles = list_profiles()
+    for profile in profiles[settings.CSV_PROFILE_RETENTION:]:
+        try:
+            os.remove(os.path.join(settings.CSV_PROFILE_DIR, profile['profile_id']))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles() -> list:
+    """
+    List stored profiles, newest first.
+    """
+    profile_dir = settings.CSV_PROFILE_DIR
+    if not os.path.isdir(profile_dir):
+        return []
+
+    profiles = []
+    for name in os.listdir(profile_dir):
+        if not PROFILE_ID_PATTERN.match(name):
+            continue
+        stat = os.stat(os.path.join(profile_dir, name))
+        profiles.append({
+            'profile_id': name,
+            'label': name.split('-')[1],
+            'mode': 'cprofile' if name.endswith('.prof') else 'sample',
+            'size': stat.st_size,
+            'created_at': stat.st_mtime,
+        })
+    profiles.sort(key=lambda profile: (profile['created_at'], profile['profile_id']), reverse=True)
+    return profiles
+
+
+def profile_path(profile_id: str) -> str:
+    """
+    Resolve a profile id to its path, rejecting anything that is not a
+    profile file name (no path traversal through the admin endpoint).
+    """
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        raise FileNotFoundError(profile_id)
+    path = os.path.join(settings.CSV_PROFILE_DIR, profile_id)
+    if not os.path.exists(path):
+        raise FileNotFoundError(profile_id)
+    return path
+
+
+def pstats_to_collapsed(path: str, max_depth: int = 64) -> str:
+    """
+    Convert a cProfile dump to collapsed stacks.
+
+    cProfile only records caller/callee edges, so stacks are rebuilt by
+    walking from the roots and splitting each function's time across its
+    callers in proportion to the cumulative time of each edge.
+    """
+    stats = pstats.Stats(path).stats
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    def frame_name(func):
+        filename, _, name = func
+        return f"{os.path.basename(filename)}:{name}"
+
+    lines = Counter()
+
+    def walk(func, stack, fraction):
+        _, _, tottime, _, _ = stats[func]
+        stack = stack + [frame_name(func)]
+        weight = int(tottime * fraction * 1_000_000)
+        if weight > 0:
+            lines[';'.join(stack)] += weight
+        if len(stack) >= max_depth:
+            return
+        for callee, edge in callees[func].items():
+            callee_cumtime = stats[callee][3]
+            if not callee_cumtime or frame_name(callee) in stack:
+                continue
+            share = fraction * edge[3] / callee_cumtime
+            if share * callee_cumtime * 1_000_000 >= 1:
+                walk(callee, stack, share)
+
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(func, [], 1.0)
+
+    return ''.join(f"{stack} {weight}\n" for stack, weight in lines.most_common())
@@ -0,0 +1,40 @@
+import threading
+import time
+import redis
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Shared Redis connection for request-path coordination (locks, shared
+# results). Redis is an optimisation there, never a requirement: after a
+# connection error callers get None for CSV_REDIS_RETRY_SECONDS and fall back
+# to process-local behaviour.
+
+_client = None
+_retry_at = 0.0
+_lock = threading.Lock()
+
+
+def get_redis():
+    """
+    The shared Redis client, or None when Redis is disabled or was
+    recently unreachable.
+    """
+    global _client
+    url = getattr(settings, 'CSV_REDIS_URL', None)
+    if not url or time.monotonic() < _retry_at:
+        return None
+    with _lock:
+        if _client is None:
+            _client = redis.Redis.from_url(url, socket_connect_timeout=0.2, socket_timeout=2)
+        return _client
+
+
+def mark_unavailable(error: Exception):
+    """
+    Stop using Redis for a while after ``error``.
+    """
+    global _retry_at
+    _retry_at = time.monotonic() + settings.CSV_REDIS_RETRY_SECONDS
+    logger.warning(f"Redis unavailable, using process-local fallbacks for {settings.CSV_REDIS_RETRY_SECONDS}s: {error}")
@@ -0,0 +1,21 @@
+import json
+from rest_framework.renderers import BaseRenderer
+
+
+class RawCSVRenderer(BaseRenderer):
+    """
+    Renderer selected by ?format=raw or Accept: text/csv on data endpoints.
+    Views answer with a streaming response of the original CSV bytes; error
+    responses still go through here and are rendered as JSON text.
+    """
+
+    media_type = 'text/csv'
+    format = 'raw'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, bytes):
+            return data
+        return json.dumps(data).encode('utf-8')
@@ -0,0 +1,410 @@
+import io
+import mmap
+import os
+import numpy as np
+from .artifacts import artifact_path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The row index is a sparse map from data row numbers to the byte offset
+# where that row's record starts, stored as an (n, 2) int64 array of
+# [row, offset] pairs sorted by row. Checkpoints do not have to be evenly
+# spaced, so index segments built over separate byte ranges can simply be
+# concatenated once their row numbers are shifted.
+
+ROW_INDEX_ARTIFACT = 'rowidx.npy'
+
+QUOTE = ord('"')
+NEWLINE = ord('\n')
+COMMA = ord(',')
+CARRIAGE_RETURN = ord('\r')
+
+
+class IrregularQuotes(ValueError):
+    """
+    A quote character the byte scanner cannot place, e.g. inside an
+    unquoted field; the file must be counted with the parser.
+    """
+
+class ByteRangeReader(io.RawIOBase):
+    """
+    Raw reader exposing only bytes [start, end) of a file, after the bytes
+    of ``prefix``.
+    """
+
+    def __init__(self, file_path: str, start: int, end: int = None, prefix: bytes = b''):
+        self._file = open(file_path, 'rb')
+        self._file.seek(start)
+        self._remaining = (end - start) if end is not None else None
+        self._prefix = memoryview(prefix)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self._prefix):
+            count = min(len(buffer), len(self._prefix))
+            memoryview(buffer)[:count] = self._prefix[:count]
+            self._prefix = self._prefix[count:]
+            return count
+        if self._remaining is not None:
+            if self._remaining <= 0:
+                return 0
+            buffer = memoryview(buffer)[:self._remaining]
+        count = self._file.readinto(buffer)
+        if self._remaining is not None:
+            self._remaining -= count
+        return count
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_byte_range(file_path: str, start: int, end: int = None, buffer_size: int = 1024 * 1024):
+    """
+    Open bytes [start, end) of a file as a buffered binary stream that
+    pandas and line iteration can consume directly.
+    """
+    return io.BufferedReader(ByteRangeReader(file_path, start, end), buffer_size=buffer_size)
+
+
+def open_records(file_path: str, start: int, end: int = None, buffer_size: int = 1024 * 1024):
+    """
+    Open bytes [start, end) of a file behind its header record, so pandas
+    parses the records with the header's columns and width: with usecols
+    limited to the header's columns, records with too many fields lose the
+    extra ones and short records get nulls, wherever the range starts.
+    """
+    with open(file_path, 'rb') as source:
+        header = source.read(header_end(file_path))
+    return io.BufferedReader(ByteRangeReader(file_path, start, end, prefix=header), buffer_size=buffer_size)
+
+
+def record_lines(stream):
+    """
+    Yield (record_start_relative, record_length, is_blank) for each CSV
+    record, joining physical lines while a quoted field is still open.
+    """
+    position = 0
+    record_start = 0
+    blank = False
+    in_quotes = False
+    for line in stream:
+        if not in_quotes:
+            record_start = position
+            blank = line.strip(b'\r\n') == b''
+        if line.count(b'"') % 2:
+            in_quotes = not in_quotes
+        position += len(line)
+        if not in_quotes:
+            yield record_start, position - record_start, blank
+
+
+def header_end(file_path: str) -> int:
+    """
+    Byte offset just past the header record.
+    """
+    with open_byte_range(file_path, 0) as stream:
+        for record_start, length, _ in record_lines(stream):
+            return record_start + length
+    return 0
+
+
+def _outside_commas(data: np.ndarray, quotes: np.ndarray, open_at_start: bool, positions: np.ndarray) -> np.ndarray:
+    """
+    Number of commas outside quoted fields before each of ``positions`` in
+    ``data``. Quoted regions are bounded by the quote positions and may be
+    open at either end of the buffer.
+    """
+    commas = np.flatnonzero(data == COMMA)
+    bounds = quotes
+    if open_at_start:
+        bounds = np.concatenate(([0], bounds))
+    if len(bounds) % 2:
+        bounds = np.concatenate((bounds, [len(data)]))
+    opens, closes = bounds[0::2], bounds[1::2]
+    inside = np.searchsorted(commas, closes) - np.searchsorted(commas, opens)
+    inside_before = np.concatenate(([0], np.cumsum(inside)))
+    return np.searchsorted(commas, positions) - inside_before[np.searchsorted(closes, positions, side='right')]
+
+
+def _irregular_quote(mapped, data: np.ndarray, quotes: np.ndarray, quotes_seen: int,
+                     buffer_start: int, start: int, end: int):
+    """
+    Offset of the first quote of the buffer that is not where the parity
+    scan assumes it is, or None: an opening quote must start a field and a
+    closing quote end it, or be followed by a quote (doubling it). A stray
+    quote in an unquoted field like ``5" tv`` would otherwise flip the state
+    of every record after it.
+    """
+    if not len(quotes):
+        return None
+    # The bytes around the scanned range act as record boundaries
+    before = mapped[buffer_start - 1] if buffer_start > start else NEWLINE
+    after = mapped[buffer_start + len(data)] if buffer_start + len(data) < end else NEWLINE
+    previous = np.where(quotes > 0, data[quotes - 1], before)
+    following = np.where(quotes < len(data) - 1, data[np.minimum(quotes + 1, len(data) - 1)], after)
+    opening = (quotes_seen + np.arange(len(quotes))) % 2 == 0
+    valid = np.where(
+        opening,
+        np.isin(previous, (COMMA, NEWLINE, QUOTE)),
+        np.isin(following, (COMMA, NEWLINE, CARRIAGE_RETURN, QUOTE)),
+    )
+    if valid.all():
+        return None
+    return buffer_start + int(quotes[np.argmin(valid)])
+
+
+def _record_starts(mapped, start: int, end: int, buffer_size: int, count_fields: bool = False):
+    """
+    Yield (record_starts, bytes_scanned, field_counts) buffer by buffer,
+    where record_starts holds the absolute start offsets of the non-blank
+    records found in bytes [start, end) of ``mapped`` and field_counts the
+    number of fields of each (None unless ``count_fields``).
+    
+    A newline ends a record only when an even number of quote characters
+    precedes it, carried across buffers. Doubled quotes inside a quoted
+    field toggle the state twice, so they need no special handling. Fields
+    are counted from the commas outside quotes, by binary search of the
+    record ends in the comma positions rather than per comma.
+    
+    Raises:
+        IrregularQuotes: A quote is not at a field boundary (see
+            _irregular_quote); the records yielded before it are correct
+    """
+    quotes_seen = 0
+    record_start = start
+    commas_carried = 0
+    for buffer_start in range(start, end, buffer_size):
+        buffer_end = min(buffer_start + buffer_size, end)
+        data = np.frombuffer(mapped, dtype=np.uint8, count=buffer_end - buffer_start, offset=buffer_start)
+        
+        quotes = np.flatnonzero(data == QUOTE)
+        irregular = _irregular_quote(mapped, data, quotes, quotes_seen, buffer_start, start, end)
+        if irregular is not None:
+            # Without views of the mapping alive, so the caller can close it
+            del data
+            raise IrregularQuotes(f"Quote at byte {irregular} is not at a field boundary")
+        newlines = np.flatnonzero(data == NEWLINE)
+        quotes_before = quotes_seen + np.searchsorted(quotes, newlines)
+        terminators = newlines[quotes_before % 2 == 0]
+        fields = None
+        if count_fields:
+            commas = np.diff(
+                _outside_commas(data, quotes, quotes_seen % 2 == 1, np.append(terminators, len(data))), prepend=0
+            )
+            commas[0] += commas_carried
+            commas_carried = int(commas[-1])
+            fields = commas[:-1] + 1
+        terminators = terminators + buffer_start
+        quotes_seen += len(quotes)
+        del data
+        
+        starts = np.empty(len(terminators), dtype=np.int64)
+        if len(terminators):
+            starts[0] = record_start
+            starts[1:] = terminators[:-1] + 1
+            lengths = terminators - starts
+            carriage = np.zeros(len(starts), dtype=bool)
+            single = lengths == 1
+            if single.any():
+                carriage[single] = [mapped[position] == CARRIAGE_RETURN for position in starts[single]]
+            kept = (lengths > 0) & ~carriage
+            starts = starts[kept]
+            if fields is not None:
+                fields = fields[kept]
+            record_start = int(terminators[-1]) + 1
+        yield starts, buffer_end - start, fields
+    
+    # Last record without a trailing newline
+    if record_start < end and mapped[record_start:end].strip(b'\r\n'):
+        fields = np.array([commas_carried + 1]) if count_fields else None
+        yield np.array([record_start], dtype=np.int64), end - start, fields
+
+
+def scan_records(file_path: str, start: int, end: int = None, stride: int = 1024,
+                 buffer_size: int = 64 * 1024 * 1024, progress=None, field_counts=None):
+    """
+    Count the data records in bytes [start, end) and collect a checkpoint
+    for every ``stride``-th record. Blank lines are skipped like pandas does.
+    
+    The file is mmapped and scanned in large buffers with vectorized byte
+    comparisons (see _record_starts).
+    
+    Args:
+        progress: Optional callable receiving (rows_so_far, bytes_scanned)
+            after each buffer
+        field_counts: Optional callable receiving (rows, fields) arrays with
+            the number of fields of each record, after each buffer
+    
+    Returns:
+        Tuple of (row_count, checkpoints) where checkpoints is a list of
+        [row, absolute_offset] pairs with rows numbered from 0 in the range
+    
+    Raises:
+        IrregularQuotes: The range has quotes the scanner cannot place
+    """
+    if end is None:
+        end = os.path.getsize(file_path)
+    if end <= start:
+        return 0, []
+    
+    rows = 0
+    checkpoints = []
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for starts, scanned, fields in _record_starts(mapped, start, end, buffer_size, field_counts is not None):
+            ordinals = rows + np.arange(len(starts))
+            if field_counts is not None and len(starts):
+                field_counts(ordinals, fields)
+            picked = ordinals % stride == 0
+            checkpoints.extend(zip(ordinals[picked].tolist(), starts[picked].tolist()))
+            rows += len(starts)
+            if progress:
+                progress(rows, scanned)
+    
+    return rows, [list(checkpoint) for checkpoint in checkpoints]
+
+
+def find_row_span(file_path: str, index: np.ndarray, first_row: int, count: int,
+                  buffer_size: int = 1024 * 1024, mapped=None):
+    """
+    Byte range holding data rows [first_row, first_row + count), found by
+    scanning forward from the nearest row index checkpoint. ``mapped`` is
+    an already open mapping of the file, if the caller keeps one.
+    
+    Returns:
+        Tuple of (start, end) byte offsets, or None if first_row is past
+        the last row
+    """
+    checkpoint_row, offset = locate_row(index, first_row)
+    skip = first_row - checkpoint_row
+    file_size = len(mapped) if mapped is not None else os.path.getsize(file_path)
+    if offset >= file_size:
+        return None
+    
+    if mapped is None:
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return find_row_span(file_path, index, first_row, count, buffer_size, mapped)
+    
+    found = []
+    needed = skip + count + 1
+    for starts, _, _ in _record_starts(mapped, offset, file_size, buffer_size):
+        found.extend(starts.tolist())
+        if len(found) >= needed:
+            break
+    
+    if len(found) <= skip:
+        return None
+    end = found[skip + count] if len(found) > skip + count else file_size
+    return found[skip], end
+
+
+def iter_byte_ranges(file_path: str, ranges: list, block_size: int = 1024 * 1024):
+    """
+    Yield the bytes of each (start, end) range of the file in blocks, sliced
+    straight from an mmap of the file.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start, end in ranges:
+                for block_start in range(start, end, block_size):
+                    yield mapped[block_start:min(block_start + block_size, end)]
+
+
+def needs_parser_count(file_path: str, sample_size: int = 1024 * 1024) -> bool:
+    """
+    Detect dialects the byte scanner cannot count: bare carriage-return line
+    endings and backslash-escaped quotes.
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(sample_size)
+    if b'\r' in sample and b'\n' not in sample:
+        return True
+    return b'\\"' in sample
+
+
+def find_record_ranges(file_path: str, parts: int, buffer_size: int = 64 * 1024 * 1024) -> list:
+    """
+    Split the data section of a CSV into ``parts`` byte ranges that start and
+    end on record boundaries.
+
+    Split points are moved forward to the next record start found by the
+    quote-aware scan from the start of the data (see _record_starts), so a
+    quoted field with embedded newlines is never cut in two. The whole file
+    is scanned, which also rejects files the scanner cannot count.
+
+    Returns:
+        List of (start, end) byte offsets covering the whole data section
+
+    Raises:
+        IrregularQuotes: The file has quotes the scanner cannot place
+    """
+    data_start = header_end(file_path)
+    file_size = os.path.getsize(file_path)
+    if parts <= 1 or file_size - data_start <= parts:
+        return [(data_start, file_size)]
+
+    step = (file_size - data_start) // parts
+    targets = [data_start + step * i for i in range(1, parts)]
+    boundaries = [data_start]
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for starts, _, _ in _record_starts(mapped, data_start, file_size, buffer_size):
+            while targets and len(starts) and starts[-1] >= targets[0]:
+                position = int(starts[np.searchsorted(starts, targets.pop(0))])
+                if position > boundaries[-1]:
+                    boundaries.append(position)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def merge_segments(segments: list) -> np.ndarray:
+    """
+    Merge per-range checkpoint segments into one row index.
+
+    Args:
+        segments: List of (row_count, checkpoints) in byte order
+
+    Returns:
+        (n, 2) int64 array of [row, offset] pairs with global row numbers
+    """
+    merged = []
+    row_base = 0
+    for row_count, checkpoints in segments:
+        for row, offset in checkpoints:
+            merged.append((row_base + row, offset))
+        row_base += row_count
+    return np.array(merged, dtype=np.int64).reshape(-1, 2)
+
+
+def save_row_index(file_path: str, index: np.ndarray):
+    path = artifact_path(file_path, ROW_INDEX_ARTIFACT)
+    with open(path + '.tmp', 'wb') as output:
+        np.save(output, index)
+    os.replace(path + '.tmp', path)
+
+
+def load_row_index(file_path: str):
+    """
+    Load the row index of ``file_path``, or None if it was not built.
+    """
+    path = artifact_path(file_path, ROW_INDEX_ARTIFACT)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def locate_row(index: np.ndarray, row: int):
+    """
+    Find the closest checkpoint at or before ``row``.
+
+    Returns:
+        Tuple of (checkpoint_row, byte_offset)
+    """
+    position = int(np.searchsorted(index[:, 0], row, side='right')) - 1
+    if position < 0:
+        raise ValueError(f"Row {row} is before the first checkpoint")
+    return int(index[position, 0]), int(index[position, 1])
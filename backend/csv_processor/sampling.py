@@ -0,0 +1,152 @@
+import os
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .artifacts import artifact_path
+import logging
+
+logger = logging.getLogger(__name__)
+
+RESERVOIR_ARTIFACT = 'reservoir.pkl'
+
+
+class ReservoirSampler:
+    """
+    Ingest collector keeping a uniform random sample of ``size`` rows
+    (Algorithm R, vectorized per chunk). Row numbers are kept in the index
+    and the number of rows seen in ``seen``, so reservoirs of different
+    parts of a file can be merged.
+    """
+
+    def __init__(self, size: int = None, seed: int = 0, row_base: int = 0):
+        self.size = size or settings.CSV_RESERVOIR_SIZE
+        self.rng = np.random.default_rng(seed)
+        self.row_base = row_base
+        self.seen = 0
+        self.sample = None
+
+    def update(self, chunk: pd.DataFrame):
+        rows = np.arange(self.seen, self.seen + len(chunk))
+        chunk = chunk.set_axis(rows + self.row_base, axis=0)
+
+        fill = max(0, min(self.size - self.seen, len(chunk)))
+        if fill:
+            head = chunk.iloc[:fill]
+            self.sample = head if self.sample is None else pd.concat([self.sample, head])
+
+        if fill < len(chunk):
+            rest = rows[fill:]
+            slots = self.rng.integers(0, rest + 1)
+            accepted = slots < self.size
+            if accepted.any():
+                # Later rows win when several land on the same slot, as in
+                # the sequential algorithm
+                replacements = pd.Series(np.flatnonzero(accepted) + fill, index=slots[accepted])
+                replacements = replacements[~replacements.index.duplicated(keep='last')]
+                values = self.sample.to_numpy(dtype=object, copy=True)
+                index = self.sample.index.to_numpy(copy=True)
+                values[replacements.index] = chunk.iloc[replacements.to_numpy()].to_numpy(dtype=object)
+                index[replacements.index] = chunk.index.to_numpy()[replacements.to_numpy()]
+                self.sample = pd.DataFrame(values, index=index, columns=chunk.columns).infer_objects()
+
+        self.seen += len(chunk)
+
+    def merge(self, other: 'ReservoirSampler'):
+        """
+        Combine with the reservoir of another, disjoint part of the file.
+        The share taken from each side follows a hypergeometric draw, which
+        keeps the merged reservoir uniform over both parts.
+        """
+        if other.sample is None:
+            return
+        if self.sample is None:
+            self.sample, self.seen = other.sample, other.seen
+            return
+        total = self.seen + other.seen
+        size = min(self.size, len(self.sample) + len(other.sample))
+        from_self = self.rng.hypergeometric(self.seen, other.seen, size) if total > size else len(self.sample)
+        from_self = min(from_self, len(self.sample))
+        from_other = min(size - from_self, len(other.sample))
+        picked_self = self.rng.choice(len(self.sample), from_self, replace=False)
+        picked_other = self.rng.choice(len(other.sample), from_other, replace=False)
+        self.sample = pd.concat([self.sample.iloc[np.sort(picked_self)], other.sample.iloc[np.sort(picked_other)]])
+        self.seen = total
+
+    def save(self, path: str):
+        sample = self.sample if self.sample is not None else pd.DataFrame()
+        sample = sample.sort_index()
+        sample.attrs['seen'] = self.seen
+        sample.to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str, size: int = None, seed: int = 0) -> 'ReservoirSampler':
+        sampler = cls(size=size, seed=seed)
+        sampler.sample = pd.read_pickle(path)
+        sampler.seen = sampler.sample.attrs.get('seen', len(sampler.sample))
+        return sampler
+
+
+def reservoir_path(file_path: str) -> str:
+    return artifact_path(file_path, RESERVOIR_ARTIFACT)
+
+
+def load_reservoir(file_path: str):
+    """
+    The ingest-time reservoir of ``file_path`` as a DataFrame indexed by row
+    number, or None if it was not built.
+    """
+    path = reservoir_path(file_path)
+    if not os.path.exists(path):
+        return None
+    return pd.read_pickle(path)
+
+
+def uniform_rows(total_rows: int, n: int, seed: int) -> np.ndarray:
+    """
+    ``n`` distinct row numbers drawn uniformly from ``total_rows``, sorted.
+    """
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(total_rows, size=min(n, total_rows), replace=False))
+
+
+def sample_frame(frame: pd.DataFrame, n: int, seed: int) -> pd.DataFrame:
+    """
+    Uniform sample of ``n`` rows of ``frame`` (itself a uniform sample).
+    """
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(frame), size=min(n, len(frame)), replace=False)
+    return frame.iloc[np.sort(picked)]
+
+
+def stratified_sample(frame: pd.DataFrame, column: str, n: int, seed: int) -> pd.DataFrame:
+    """
+    Stratified sample with proportional allocation (largest remainder), at
+    least one row per stratum when ``n`` allows it.
+    """
+    rng = np.random.default_rng(seed)
+    n = min(n, len(frame))
+    keys = frame[column].astype(object).where(frame[column].notna(), '<null>')
+    groups = keys.groupby(keys, sort=False).indices
+    sizes = pd.Series({key: len(positions) for key, positions in groups.items()})
+    quotas = sizes / sizes.sum() * n
+    allocation = np.floor(quotas).astype(int)
+    if n >= len(sizes):
+        allocation = allocation.clip(lower=1)
+    remainder = n - allocation.sum()
+    if remainder > 0:
+        order = (quotas - np.floor(quotas)).sort_values(ascending=False, kind='stable').index
+        for key in order[:remainder]:
+            allocation[key] += 1
+    elif remainder < 0:
+        for key in allocation.sort_values(ascending=False, kind='stable').index[:-remainder]:
+            allocation[key] -= 1
+    allocation = allocation.clip(upper=sizes)
+
+    picked = []
+    for key, positions in groups.items():
+        count = int(allocation[key])
+        if count:
+            picked.append(rng.choice(positions, size=count, replace=False))
+    positions = np.sort(np.concatenate(picked)) if picked else np.array([], dtype=int)
+    return frame.iloc[positions]
@@ -0,0 +1,116 @@
+import threading
+import time
+import uuid
+import redis
+from django.conf import settings
+from .metrics import SINGLE_FLIGHT_REQUESTS
+from .redis_client import get_redis, mark_unavailable
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Compare-and-delete, so a leader whose lock expired never removes the lock
+# of the next leader
+RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical computations. Within a process, callers
+    with the same key wait for the one in-flight call and share its result.
+    Across processes the leader holds a Redis lock while it computes; other
+    processes wait for the lock to go away and then compute the result
+    themselves, against a warm page cache, instead of all parsing at once.
+    Results never travel through Redis. Without Redis only the in-process
+    layer applies.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key: str, compute, share=None, across_processes: bool = True):
+        """
+        Return compute() for ``key``, computing it once for all concurrent
+        callers.
+
+        Args:
+            key: Identifies the computation (include everything the result depends on)
+            compute: Callable producing the result
+            share: Optional callable applied to the result handed to callers
+                that did not compute it (e.g. a defensive copy)
+            across_processes: False when the computation is cheap enough
+                that a Redis round trip would cost more than it saves
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            SINGLE_FLIGHT_REQUESTS.labels(flight=self.name, role='coalesced_local').inc()
+            if flight.error is not None:
+                raise flight.error
+            return share(flight.result) if share else flight.result
+
+        try:
+            if across_processes:
+                flight.result = self._across_processes(key, compute)
+            else:
+                SINGLE_FLIGHT_REQUESTS.labels(flight=self.name, role='leader').inc()
+                flight.result = compute()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def _across_processes(self, key: str, compute):
+        client = get_redis()
+        if client is None:
+            SINGLE_FLIGHT_REQUESTS.labels(flight=self.name, role='leader').inc()
+            return compute()
+
+        lock_key = f"csv:singleflight:{self.name}:{key}:lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + settings.CSV_SINGLE_FLIGHT_WAIT_SECONDS
+        try:
+            # Uncontended, this SET and the release below are the only round trips
+            locked = client.set(lock_key, token, nx=True, px=int(settings.CSV_SINGLE_FLIGHT_WAIT_SECONDS * 1000))
+            if not locked:
+                while client.exists(lock_key):
+                    if time.monotonic() > deadline:
+                        logger.warning(f"Single-flight {self.name}: gave up waiting for {key}, computing locally")
+                        break
+                    time.sleep(settings.CSV_SINGLE_FLIGHT_POLL_SECONDS)
+                SINGLE_FLIGHT_REQUESTS.labels(flight=self.name, role='waited_redis').inc()
+                return compute()
+        except redis.RedisError as e:
+            mark_unavailable(e)
+            SINGLE_FLIGHT_REQUESTS.labels(flight=self.name, role='leader').inc()
+            return compute()
+
+        SINGLE_FLIGHT_REQUESTS.labels(flight=self.name, role='leader').inc()
+        try:
+            return compute()
+        finally:
+            try:
+                client.eval(RELEASE_SCRIPT, 1, lock_key, token)
+            except redis.RedisError as e:
+                mark_unavailable(e)
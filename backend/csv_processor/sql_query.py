@@ -0,0 +1,244 @@
+import csv
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+import uuid
+from django.conf import settings
+from .artifacts import artifact_path
+from .aggregation import file_version
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Read-only SQL over uploaded files. Every file is bulk-loaded once into its
+# own SQLite database next to the CSV (table "data"); a query opens an
+# in-memory connection, attaches the databases of the files it references
+# read-only and exposes each one as a view named file_<uuid hex>. Results
+# are written to CSV under CSV_SQL_RESULT_DIR and paginated from there.
+
+SQL_DATABASE_ARTIFACT = 'sqlite'
+TABLE_PATTERN = re.compile(r'\bfile_([0-9a-f]{32})\b', re.IGNORECASE)
+QUERY_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# Authorizer actions a query may perform; everything else (writes, DDL,
+# ATTACH, PRAGMA, transactions) is denied
+ALLOWED_ACTIONS = {
+    sqlite3.SQLITE_SELECT,
+    sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_FUNCTION,
+    sqlite3.SQLITE_RECURSIVE,
+}
+
+
+class QueryError(ValueError):
+    pass
+
+
+class QueryCancelled(QueryError):
+    pass
+
+
+def table_name(file_id) -> str:
+    return f"file_{uuid.UUID(str(file_id)).hex}"
+
+
+def referenced_file_ids(sql: str) -> list:
+    """
+    UUIDs of the files a query refers to through file_<hex> table names.
+    """
+    return list(dict.fromkeys(str(uuid.UUID(match.lower())) for match in TABLE_PATTERN.findall(sql)))
+
+
+def database_path(file_path: str) -> str:
+    return artifact_path(file_path, SQL_DATABASE_ARTIFACT)
+
+
+def database_is_current(db_file) -> bool:
+    path = database_path(db_file.file_path)
+    if not os.path.exists(path):
+        return False
+    try:
+        with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as connection:
+            row = connection.execute("SELECT version FROM _meta").fetchone()
+    except sqlite3.Error:
+        return False
+    return row is not None and row[0] == file_version(db_file)
+
+
+def new_query_id() -> str:
+    return uuid.uuid4().hex
+
+
+def result_paths(query_id: str) -> dict:
+    if not QUERY_ID_PATTERN.match(query_id or ''):
+        raise QueryError('Invalid query id')
+    base = os.path.join(settings.CSV_SQL_RESULT_DIR, query_id)
+    return {'data': base + '.csv', 'meta': base + '.json', 'cancel': base + '.cancel'}
+
+
+def load_result_meta(query_id: str):
+    path = result_paths(query_id)['meta']
+    if not os.path.exists(path):
+        return None
+    with open(path) as meta:
+        return json.load(meta)
+
+
+def store_result_meta(query_id: str, meta: dict):
+    path = result_paths(query_id)['meta']
+    os.makedirs(settings.CSV_SQL_RESULT_DIR, exist_ok=True)
+    with open(path + '.tmp', 'w') as output:
+        json.dump(meta, output)
+    os.replace(path + '.tmp', path)
+
+
+def request_cancel(query_id: str):
+    os.makedirs(settings.CSV_SQL_RESULT_DIR, exist_ok=True)
+    open(result_paths(query_id)['cancel'], 'w').close()
+
+
+def remove_result(query_id: str):
+    for path in result_paths(query_id).values():
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def expire_results():
+    """
+    Remove query results older than CSV_SQL_RESULT_TTL seconds.
+    """
+    cutoff = time.time() - settings.CSV_SQL_RESULT_TTL
+    for path in glob.glob(os.path.join(settings.CSV_SQL_RESULT_DIR, '*')):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _authorize(action, arg1, arg2, database, trigger):
+    return sqlite3.SQLITE_OK if action in ALLOWED_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def open_query_connection(tables: dict) -> sqlite3.Connection:
+    """
+    In-memory connection with each file database attached read-only.
+
+    Args:
+        tables: {table_name: database_path}
+    """
+    connection = sqlite3.connect('file::memory:', uri=True, check_same_thread=False)
+    for position, (name, path) in enumerate(tables.items()):
+        schema = f"s{position}"
+        connection.execute("ATTACH DATABASE ? AS " + schema, (f"file:{path}?mode=ro",))
+        connection.execute(f'CREATE TEMP VIEW "{name}" AS SELECT * FROM {schema}.data')
+    connection.execute(f"PRAGMA cache_size = -{settings.CSV_SQL_CACHE_KB}")
+    connection.execute("PRAGMA query_only = ON")
+    connection.set_authorizer(_authorize)
+    return connection
+
+
+class heap_limit:
+    """
+    Cap SQLite heap usage for the duration of a query. The limit is
+    process-wide, which is per query in a prefork Celery worker.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, limit_bytes: int):
+        self.connection = connection
+        self.limit_bytes = limit_bytes
+        self.previous = 0
+
+    def __enter__(self):
+        self.connection.set_authorizer(None)
+        self.previous = self.connection.execute("PRAGMA hard_heap_limit").fetchone()[0]
+        self.connection.execute(f"PRAGMA hard_heap_limit = {int(self.limit_bytes)}")
+        self.connection.set_authorizer(_authorize)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.set_authorizer(None)
+        self.connection.execute(f"PRAGMA hard_heap_limit = {int(self.previous)}")
+        self.connection.set_authorizer(_authorize)
+
+
+def execute_query(connection: sqlite3.Connection, sql: str, query_id: str, timeout: float,
+                  max_rows: int, progress=None) -> dict:
+    """
+    Run ``sql`` and stream its rows to the result CSV of ``query_id``.
+
+    The query is interrupted when ``timeout`` seconds pass or a cancel
+    marker appears (checked from SQLite's progress handler), and output
+    stops after ``max_rows`` rows.
+
+    Args:
+        progress: Optional callable receiving the number of rows written
+
+    Returns:
+        Result metadata (columns, total_rows, truncated, elapsed_seconds)
+    """
+    paths = result_paths(query_id)
+    os.makedirs(settings.CSV_SQL_RESULT_DIR, exist_ok=True)
+    started = time.monotonic()
+    deadline = started + timeout
+    state = {'reason': None, 'checked': started}
+
+    def check():
+        now = time.monotonic()
+        if now > deadline:
+            state['reason'] = 'timeout'
+            return 1
+        if now - state['checked'] > 0.2:
+            state['checked'] = now
+            if os.path.exists(paths['cancel']):
+                state['reason'] = 'cancelled'
+                return 1
+        return 0
+
+    connection.set_progress_handler(check, 10000)
+    rows = 0
+    truncated = False
+    finished = False
+    try:
+        cursor = connection.execute(sql)
+        columns = [description[0] for description in cursor.description or []]
+        with open(paths['data'] + '.tmp', 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(columns)
+            while True:
+                batch = cursor.fetchmany(settings.CSV_SQL_FETCH_ROWS)
+                if not batch:
+                    break
+                if rows + len(batch) > max_rows:
+                    batch = batch[:max_rows - rows]
+                    truncated = True
+                writer.writerows(batch)
+                rows += len(batch)
+                if progress:
+                    progress(rows)
+                if truncated:
+                    break
+        finished = True
+    except sqlite3.OperationalError as e:
+        if state['reason'] == 'cancelled':
+            raise QueryCancelled('Query was cancelled')
+        if state['reason'] == 'timeout':
+            raise QueryError(f'Query exceeded the {timeout:g}s time limit')
+        raise QueryError(str(e))
+    except sqlite3.DatabaseError as e:
+        raise QueryError(str(e))
+    finally:
+        connection.set_progress_handler(None, 0)
+        if not finished and os.path.exists(paths['data'] + '.tmp'):
+            os.remove(paths['data'] + '.tmp')
+
+    os.replace(paths['data'] + '.tmp', paths['data'])
+    return {
+        'columns': columns,
+        'total_rows': rows,
+        'truncated': truncated,
+        'elapsed_seconds': round(time.monotonic() - started, 3),
+    }
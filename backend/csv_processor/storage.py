@@ -0,0 +1,391 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .artifacts import list_artifacts
+from . import file_cache
+from .metrics import STORAGE_FREED_BYTES
+from .models import UploadedFile
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Storage manager for the upload directories (CSV_STORAGE_DIRS):
+#
+# - Deleting a large file only renames it (and its artifacts) into the
+#   directory's .trash; the purge_deleted_files beat task unlinks it later,
+#   so a request never waits for a 40GB unlink and the trash survives
+#   crashes and broker outages.
+# - reconcile_storage removes entries no UploadedFile refers to (abandoned
+#   uploads, leftovers of crashed ingests) once they are older than
+#   CSV_STORAGE_ORPHAN_GRACE_SECONDS, and fails records whose file is gone.
+# - enforce_storage_limits evicts by last access once the disk, or the
+#   CSV_STORAGE_QUOTA_BYTES of the upload directories, is fuller than
+#   CSV_STORAGE_HIGH_WATERMARK, down to CSV_STORAGE_LOW_WATERMARK: derived
+#   artifacts that are rebuilt on demand first, then whole files.
+
+TRASH_DIR = '.trash'
+# Rebuilt on demand when missing; the row index, zone map and reservoir are
+# not and stay with their file
+REBUILDABLE_ARTIFACTS = ('agg-*', 'sqlite*', 'keyidx-*', 'diff-*')
+
+
+class StorageFull(Exception):
+    """
+    Raised when an upload would not fit in the remaining storage.
+    """
+
+    def __init__(self, needed: int, available: int):
+        super().__init__(
+            f"Not enough storage for this upload: it needs about {needed} bytes "
+            f"and {max(0, available)} bytes are available"
+        )
+        self.needed = needed
+        self.available = available
+
+
+def _managed_dir(path: str):
+    """
+    The storage directory holding ``path``, or None if it is not managed.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    for managed in settings.CSV_STORAGE_DIRS:
+        if directory == os.path.abspath(managed):
+            return managed
+    return None
+
+
+def entry_bytes(path: str) -> int:
+    """
+    Size of a file, or of everything below a directory.
+    """
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+    except OSError:
+        return 0
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _remove_entry(path: str):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def discard_file(file_path: str):
+    """
+    Remove a stored file and all its artifacts. Large files in a storage
+    directory are moved to its trash (one rename each) and unlinked by
+    purge_deleted_files; anything else is removed right away.
+    """
+    if not file_path:
+        return
+    paths = list_artifacts(file_path)
+    if os.path.exists(file_path):
+        paths.append(file_path)
+    managed = _managed_dir(file_path)
+    size = sum(entry_bytes(path) for path in paths)
+    if managed is None or size < settings.CSV_STORAGE_DEFERRED_DELETE_BYTES:
+        for path in paths:
+            try:
+                _remove_entry(path)
+            except OSError as e:
+                logger.error(f"Could not remove {path}: {e}")
+        STORAGE_FREED_BYTES.labels(reason='deleted').inc(size)
+        return
+
+    trash = os.path.join(managed, TRASH_DIR, uuid.uuid4().hex)
+    os.makedirs(trash)
+    for path in paths:
+        try:
+            os.rename(path, os.path.join(trash, os.path.basename(path)))
+        except FileNotFoundError:
+            pass
+    logger.info(f"Moved {file_path} ({size} bytes with artifacts) to {trash} for deletion")
+
+
+def purge_trash() -> int:
+    """
+    Unlink everything in the trash of every storage directory.
+
+    Returns:
+        Number of bytes freed
+    """
+    freed = 0
+    for managed in settings.CSV_STORAGE_DIRS:
+        trash_root = os.path.join(managed, TRASH_DIR)
+        if not os.path.isdir(trash_root):
+            continue
+        for entry in os.scandir(trash_root):
+            size = entry_bytes(entry.path)
+            try:
+                _remove_entry(entry.path)
+            except OSError as e:
+                logger.error(f"Could not purge {entry.path}: {e}")
+                continue
+            freed += size
+    if freed:
+        STORAGE_FREED_BYTES.labels(reason='deleted').inc(freed)
+        logger.info(f"Purged {freed} bytes of deleted files")
+    return freed
+
+
+def _stored_entries():
+    """
+    Yield the os.DirEntry of every file and artifact in the storage
+    directories, the trash excluded.
+    """
+    for managed in settings.CSV_STORAGE_DIRS:
+        if not os.path.isdir(managed):
+            continue
+        for entry in os.scandir(managed):
+            if entry.name != TRASH_DIR:
+                yield entry
+
+
+def _is_referenced(path: str, referenced: set) -> bool:
+    # "<file_path>.<artifact>": every prefix ending before a dot may be the file
+    if path in referenced:
+        return True
+    position = path.find('.', len(os.path.dirname(path)) + 1)
+    while position != -1:
+        if path[:position] in referenced:
+            return True
+        position = path.find('.', position + 1)
+    return False
+
+
+def reconcile() -> dict:
+    """
+    Bring disk contents and UploadedFile records back in line: remove
+    unreferenced entries older than CSV_STORAGE_ORPHAN_GRACE_SECONDS (spool
+    files of queued ingests have no record yet, hence the grace period) and
+    mark completed records whose file is missing as failed.
+
+    Returns:
+        Dictionary with orphans_removed, bytes_freed and missing_files
+    """
+    referenced = {
+        os.path.abspath(path)
+        for path in UploadedFile.objects.exclude(file_path='').values_list('file_path', flat=True)
+    }
+    cutoff = time.time() - settings.CSV_STORAGE_ORPHAN_GRACE_SECONDS
+    removed, freed = 0, 0
+    for entry in _stored_entries():
+        path = os.path.abspath(entry.path)
+        try:
+            if _is_referenced(path, referenced) or entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                continue
+            size = entry_bytes(path)
+            _remove_entry(path)
+        except OSError as e:
+            logger.error(f"Could not remove orphan {path}: {e}")
+            continue
+        removed += 1
+        freed += size
+        logger.info(f"Removed orphan {path} ({size} bytes)")
+    STORAGE_FREED_BYTES.labels(reason='orphan').inc(freed)
+
+    missing = 0
+    for db_file in UploadedFile.objects.filter(status='completed').exclude(file_path=''):
+        if not os.path.exists(db_file.file_path):
+            UploadedFile.objects.filter(id=db_file.id, status='completed').update(
+                status='failed', error_message='The stored file is missing'
+            )
+            file_cache.invalidate(db_file.id, db_file.file_path)
+            missing += 1
+            logger.warning(f"Stored file of {db_file.id} is missing: {db_file.file_path}")
+    return {'orphans_removed': removed, 'bytes_freed': freed, 'missing_files': missing}
+
+
+def _storage_root() -> str:
+    root = settings.CSV_STORAGE_DIRS[0]
+    os.makedirs(root, exist_ok=True)
+    return root
+
+
+_managed_lock = threading.Lock()
+# (storage dirs, bytes, monotonic time measured) of the last directory walk
+_managed_measured = None
+
+
+def _managed_bytes(max_age: float = 0) -> int:
+    global _managed_measured
+    directories = tuple(settings.CSV_STORAGE_DIRS)
+    with _managed_lock:
+        measured = _managed_measured
+    if measured and measured[0] == directories and time.monotonic() - measured[2] < max_age:
+        return measured[1]
+    managed = 0
+    for directory in directories:
+        if os.path.isdir(directory):
+            managed += sum(entry_bytes(entry.path) for entry in os.scandir(directory))
+    with _managed_lock:
+        _managed_measured = (directories, managed, time.monotonic())
+    return managed
+
+
+def storage_usage(max_age: float = 0) -> dict:
+    """
+    Disk usage of the filesystem holding the uploads and the bytes taken
+    by the storage directories (trash included).
+    
+    Args:
+        max_age: Seconds a previous walk of the storage directories may be
+            reused for managed_bytes; disk figures are always current
+    """
+    disk = shutil.disk_usage(_storage_root())
+    managed = _managed_bytes(max_age)
+    return {
+        'disk_total': disk.total,
+        'disk_free': disk.free,
+        'managed_bytes': managed,
+        'quota_bytes': settings.CSV_STORAGE_QUOTA_BYTES,
+    }
+
+
+def _excess(used: int, capacity: int) -> int:
+    if used <= capacity * settings.CSV_STORAGE_HIGH_WATERMARK:
+        return 0
+    return int(used - capacity * settings.CSV_STORAGE_LOW_WATERMARK)
+
+
+def bytes_to_free(usage: dict = None) -> int:
+    """
+    Bytes eviction should free: nothing until the disk or the quota is
+    filled beyond the high watermark, then down to the low watermark.
+    """
+    usage = usage or storage_usage()
+    needed = _excess(usage['disk_total'] - usage['disk_free'], usage['disk_total'])
+    if usage['quota_bytes']:
+        needed = max(needed, _excess(usage['managed_bytes'], usage['quota_bytes']))
+    return needed
+
+
+def check_upload_space(content_length):
+    """
+    Fail fast before an upload of ``content_length`` bytes is read when it
+    would not fit: its projected footprint (CSV_STORAGE_UPLOAD_OVERHEAD
+    times its size, for the file and its artifacts) must leave
+    CSV_STORAGE_MIN_FREE_BYTES free and stay within the quota. Uploads
+    without a length are let through.
+
+    Raises:
+        StorageFull: The upload would not fit
+    """
+    try:
+        size = int(content_length)
+    except (TypeError, ValueError):
+        return
+    needed = int(size * settings.CSV_STORAGE_UPLOAD_OVERHEAD)
+    # Walking the directories is O(files); the quota check may lag a little
+    usage = storage_usage(max_age=settings.CSV_STORAGE_USAGE_MAX_AGE)
+    available = usage['disk_free'] - settings.CSV_STORAGE_MIN_FREE_BYTES
+    if usage['quota_bytes']:
+        available = min(available, usage['quota_bytes'] - usage['managed_bytes'])
+    if needed > available:
+        raise StorageFull(needed, available)
+
+
+def touch(db_file):
+    """
+    Record an access to ``db_file`` for eviction, at most once per
+    CSV_STORAGE_ACCESS_RESOLUTION_SECONDS so reads rarely write.
+    """
+    now = timezone.now()
+    resolution = timedelta(seconds=settings.CSV_STORAGE_ACCESS_RESOLUTION_SECONDS)
+    if db_file.last_accessed_at and now - db_file.last_accessed_at < resolution:
+        return
+    UploadedFile.objects.filter(id=db_file.id).filter(
+        Q(last_accessed_at__isnull=True) | Q(last_accessed_at__lt=now - resolution)
+    ).update(last_accessed_at=now)
+    db_file.last_accessed_at = now
+
+
+def _eviction_order() -> list:
+    """
+    Stored paths that may be evicted, least recently used first. Records
+    sharing a path count as one, used when the latest of them was; paths
+    with an ingest in flight or used within CSV_STORAGE_MIN_IDLE_SECONDS
+    are left alone.
+    """
+    last_used, busy = {}, set()
+    records = UploadedFile.objects.exclude(file_path='').values_list(
+        'file_path', 'status', 'last_accessed_at', 'created_at'
+    )
+    for file_path, file_status, accessed_at, created_at in records:
+        used_at = accessed_at or created_at
+        last_used[file_path] = max(used_at, last_used.get(file_path, used_at))
+        if file_status in ('uploading', 'processing'):
+            busy.add(file_path)
+    idle_since = timezone.now() - timedelta(seconds=settings.CSV_STORAGE_MIN_IDLE_SECONDS)
+    candidates = [path for path, used_at in last_used.items() if path not in busy and used_at < idle_since]
+    return sorted(candidates, key=last_used.get)
+
+
+def evict(target: int = None) -> dict:
+    """
+    Free ``target`` bytes (by default what bytes_to_free asks for): first
+    the rebuildable artifacts of the least recently used files, then, with
+    CSV_STORAGE_EVICT_FILES, the files themselves with their records.
+
+    Returns:
+        Dictionary with bytes_freed, artifacts_evicted and files_evicted
+    """
+    target = bytes_to_free() if target is None else target
+    result = {'bytes_freed': 0, 'artifacts_evicted': 0, 'files_evicted': 0}
+    if target <= 0:
+        return result
+    order = _eviction_order()
+    cutoff = time.time() - settings.CSV_STORAGE_MIN_IDLE_SECONDS
+
+    for file_path in order:
+        for pattern in REBUILDABLE_ARTIFACTS:
+            for path in list_artifacts(file_path, pattern):
+                try:
+                    # Skip artifacts still being written (key index spills, running diffs)
+                    if os.path.getmtime(path) > cutoff:
+                        continue
+                    size = entry_bytes(path)
+                    _remove_entry(path)
+                except OSError as e:
+                    logger.error(f"Could not evict {path}: {e}")
+                    continue
+                result['bytes_freed'] += size
+                result['artifacts_evicted'] += 1
+                STORAGE_FREED_BYTES.labels(reason='evicted_artifact').inc(size)
+        if result['bytes_freed'] >= target:
+            break
+
+    if result['bytes_freed'] < target and settings.CSV_STORAGE_EVICT_FILES:
+        for file_path in order:
+            size = entry_bytes(file_path) + sum(entry_bytes(path) for path in list_artifacts(file_path))
+            for db_file in UploadedFile.objects.filter(file_path=file_path):
+                logger.info(f"Evicting {db_file.filename} ({db_file.id}), last used {db_file.last_accessed_at}")
+                db_file.delete()
+            result['bytes_freed'] += size
+            result['files_evicted'] += 1
+            STORAGE_FREED_BYTES.labels(reason='evicted_file').inc(size)
+            if result['bytes_freed'] >= target:
+                break
+        purge_trash()
+
+    logger.info(f"Storage eviction freed {result['bytes_freed']} of {target} bytes: {result}")
+    return result
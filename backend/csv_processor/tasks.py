@@ -1,37 +1,142 @@
-from celery import shared_task
+import os
+import uuid
+from celery import chord, shared_task
+from django.conf import settings
+from .artifacts import artifact_path
 from .file_processor import LargeCSVProcessor
+from .ingest_control import (
+    CancellationCheck,
+    IngestCancelled,
+    discard_cancelled_ingest,
+    ingest_queue,
+    needs_admission,
+    release_ingest_bytes,
+    reserve_ingest_bytes,
+)
+from .metrics import INGEST_ADMISSION_DEFERRED, INGEST_CANCELLED
+from .models import UploadedFile
+from .uploads import spool_base64
+from .profiling import normalize_mode, profiled
+from . import aggregation, diffing, key_index, sql_query, storage
 import logging 
-import base64
 
 logger = logging.getLogger(__name__)
 
-@shared_task
-def process_large_csv(file_id, move_from_temp=False, file_content_b64=None):
+# States of a run that is still on its way. With CELERY_TASK_TRACK_STARTED a
+# run is STARTED once a worker takes it; dispatch_once records SENT while it
+# waits in the queue, which Celery would report as PENDING like an unknown id
+ACTIVE_STATES = ('SENT', 'STARTED', 'PROGRESS', 'RETRY')
+
+
+def dispatch_once(task, task_id: str, args: list, **options):
+    """
+    Queue ``task`` under ``task_id`` unless a run with that id is queued or
+    running, for endpoints that start a job on first request and are then
+    polled. A failed run is returned once for the caller to report and then
+    forgotten, so the next request queues it again (as diffs do); a run that
+    succeeded or was revoked is queued again, as the caller only asks when
+    its output is gone.
+    
+    Returns:
+        AsyncResult of the new or existing run
+    """
+    result = task.AsyncResult(task_id)
+    if result.state in ACTIVE_STATES:
+        return result
+    if result.state == 'FAILURE':
+        # The AsyncResult keeps the meta of a finished run, so it still
+        # reports the failure once the backend has dropped it
+        task.backend.forget(task_id)
+        logger.info(f"Reporting failed run {task_id} of {task.name}, the next request queues it again")
+        return result
+    task.backend.store_result(task_id, None, 'SENT')
+    return task.apply_async(args=args, task_id=task_id, **options)
+
+
+def queue_ingest(db_file, **kwargs):
+    """
+    Queue process_large_csv for ``db_file`` on the queue matching its size.
+    The task id is stored on the record first, so deleting the file can
+    revoke the ingest at any point.
+    
+    Args:
+        kwargs: Passed on to process_large_csv
+    """
+    task_id = str(uuid.uuid4())
+    db_file.task_id = task_id
+    UploadedFile.objects.filter(id=db_file.id).update(task_id=task_id)
+    queue = ingest_queue(db_file.file_size)
+    logger.info(f"Queueing ingest of {db_file.id} ({db_file.file_size} bytes) on {queue}")
+    return process_large_csv.apply_async(args=[str(db_file.id)], kwargs=kwargs, queue=queue, task_id=task_id)
+
+
+@shared_task(bind=True)
+def process_large_csv(self, file_id, move_from_temp=False, file_content_b64=None, profile=None, distributed=None,
+                      spool_path=None, index_columns=None):
     """
     Celery task to process large CSV files asynchronously.
     
+    Large ingests first reserve their size from the shared ingest budget and
+    retry later when it is used up. The ingest stops between chunks once the
+    file is deleted.
+    
     Args:
         file_id: UUID of the UploadedFile record
         move_from_temp: If True, move file from temp to permanent location first
-        file_content_b64: For large files, base64 encoded file content for serialization
+        file_content_b64: Deprecated, base64 encoded content from older producers;
+            decoded block by block into a spool file and ingested like spool_path
+        profile: Profiling mode ('cprofile', 'sample' or True) to capture a profile of the run
+        distributed: Force (True) or disable (False) distributed ingest; by default
+            files at or above CSV_DISTRIBUTED_INGEST_THRESHOLD are distributed
+        spool_path: File on shared storage holding the content of a record
+            created without file_path; content never travels in the message
+        index_columns: Columns to build key indexes on once the ingest completes
     """
     logger.info(f"CELERY TASK STARTED: {file_id}")
     logger.info(f"Move from temp: {move_from_temp}")
-    logger.info(f"File content provided: {file_content_b64 is not None}")
+    logger.info(f"Spool path: {spool_path}, base64 content provided: {file_content_b64 is not None}")
+    
+    file_size = UploadedFile.objects.filter(id=file_id).values_list('file_size', flat=True).first()
+    if file_size is None:
+        logger.info(f"CELERY TASK SKIPPED, file was deleted: {file_id}")
+        return
+    reserved = needs_admission(file_size)
+    if reserved and not reserve_ingest_bytes(file_id, file_size):
+        queue = (self.request.delivery_info or {}).get('routing_key') or ingest_queue(file_size)
+        INGEST_ADMISSION_DEFERRED.labels(queue=queue).inc()
+        logger.info(f"CELERY TASK DEFERRED, ingest budget in use: {file_id}")
+        raise self.retry(countdown=settings.CSV_INGEST_ADMISSION_RETRY_SECONDS, max_retries=None)
     
     try:
-        # Decode file content if provided
-        file_content = None
         if file_content_b64:
-            logger.info(f"Decoding base64 content, size: {len(file_content_b64)}")
-            file_content = base64.b64decode(file_content_b64)
-            logger.info(f"Decoded file content size: {len(file_content)} bytes")
+            logger.info(f"Spooling base64 content, size: {len(file_content_b64)}")
+            spool_path = spool_base64(file_content_b64, '/tmp/csv_temp_uploads')
+            file_content_b64 = None
+        
+        if spool_path is None and not move_from_temp and distributed is not False:
+            db_file = UploadedFile.objects.get(id=file_id)
+            if (distributed or db_file.file_size >= settings.CSV_DISTRIBUTED_INGEST_THRESHOLD) \
+                    and start_distributed_ingest(file_id, index_columns) is not None:
+                # The reservation is released by the chord callbacks
+                reserved = False
+                logger.info(f"CELERY TASK DISPATCHED DISTRIBUTED INGEST: {file_id}")
+                return
         
         logger.info(f"Starting file processor for {file_id}")
         processor = LargeCSVProcessor()
-        processor.process_file_async(file_id, move_from_temp, file_content)
+        with profiled('process_large_csv', normalize_mode(profile)) as session:
+            if session:
+                logger.info(f"Profiling {file_id} into {session.profile_id}")
+            processor.process_file_async(file_id, move_from_temp, spool_path=spool_path)
         
         logger.info(f"CELERY TASK COMPLETED SUCCESSFULLY: {file_id}")
+        if index_columns:
+            queue_key_indexes_for(file_id, index_columns)
+        
+    except IngestCancelled as e:
+        logger.info(f"CELERY TASK CANCELLED: {file_id}")
+        INGEST_CANCELLED.inc()
+        discard_cancelled_ingest(e.file_path)
         
     except Exception as e:
         logger.error(f"CELERY TASK FAILED: {file_id} - Error: {str(e)}")
@@ -39,7 +144,6 @@ def process_large_csv(file_id, move_from_temp=False, file_content_b64=None):
         
         # Update database record to failed status
         try:
-            from .models import UploadedFile
             db_file = UploadedFile.objects.get(id=file_id)
             db_file.status = 'failed'
             db_file.error_message = str(e)
@@ -48,4 +152,395 @@ def process_large_csv(file_id, move_from_temp=False, file_content_b64=None):
         except Exception as db_error:
             logger.error(f"Failed to update database status: {db_error}")
         
-        raise
\ No newline at end of file
+        raise
+    
+    finally:
+        if reserved:
+            release_ingest_bytes(file_id)
+
+
+def start_distributed_ingest(file_id, index_columns=None):
+    """
+    Split a stored file into record-aligned byte ranges and process them as a
+    chord: one process_csv_range task per range, merged by merge_csv_ranges.
+    
+    Ranges that already finished keep their partial result on disk, so calling
+    this again after a failure only recomputes the ranges that failed.
+    
+    Args:
+        index_columns: Columns to build key indexes on after the merge
+    
+    Returns:
+        The chord result, or None if the file cannot be split (see
+        LargeCSVProcessor.prepare_distributed_ingest)
+    """
+    processor = LargeCSVProcessor()
+    ranges = processor.prepare_distributed_ingest(file_id)
+    if ranges is None:
+        return None
+    header = [
+        process_csv_range.s(file_id, range_index, start, end, len(ranges))
+        for range_index, (start, end) in enumerate(ranges)
+    ]
+    callback = merge_csv_ranges.s(file_id, index_columns=index_columns).on_error(mark_ingest_failed.s(file_id=file_id))
+    return chord(header)(callback)
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(OSError,),
+    retry_backoff=True,
+    max_retries=settings.CSV_DISTRIBUTED_RANGE_RETRIES,
+)
+def process_csv_range(self, file_id, range_index, start, end, range_count):
+    """
+    Celery task computing the partial statistics of one byte range. Runs on any
+    worker that can see the shared storage path.
+    """
+    logger.info(f"RANGE TASK STARTED: {file_id} range {range_index} [{start}, {end})")
+    processor = LargeCSVProcessor()
+    try:
+        return processor.analyze_byte_range(file_id, range_index, start, end, range_count)
+    except IngestCancelled as e:
+        # Fails the chord, so the remaining ranges are not merged
+        logger.info(f"RANGE TASK CANCELLED: {file_id} range {range_index}")
+        discard_cancelled_ingest(e.file_path)
+        raise
+
+
+@shared_task
+def merge_csv_ranges(results, file_id, index_columns=None):
+    """
+    Chord callback merging range results into the UploadedFile record.
+    """
+    logger.info(f"MERGE TASK STARTED: {file_id}, {len(results)} ranges")
+    processor = LargeCSVProcessor()
+    try:
+        processor.merge_range_results(file_id, results)
+    finally:
+        release_ingest_bytes(file_id)
+    logger.info(f"MERGE TASK COMPLETED: {file_id}")
+    if index_columns:
+        queue_key_indexes_for(file_id, index_columns)
+
+
+@shared_task
+def mark_ingest_failed(request, exc, traceback, file_id=None):
+    """
+    Chord error callback. Finished ranges keep their results, so retrying
+    the ingest (see retry_ingest) only redoes the others.
+    """
+    logger.error(f"DISTRIBUTED INGEST FAILED: {file_id} - Error: {exc}")
+    release_ingest_bytes(file_id)
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        db_file.status = 'failed'
+        db_file.error_message = str(exc)
+        db_file.save()
+    except UploadedFile.DoesNotExist:
+        logger.error(f"File {file_id} no longer exists")
+
+
+def retry_ingest(db_file):
+    """
+    Queue a failed ingest of ``db_file`` again. A distributed ingest that
+    left range results behind is distributed again, so only the ranges that
+    never finished are redone; like any ingest it goes through the ingest
+    budget and falls back to one worker if the file cannot be split.
+    """
+    distributed = True if os.path.isdir(artifact_path(db_file.file_path, 'ranges')) else None
+    logger.info(f"RETRYING INGEST: {db_file.id}, resuming finished ranges: {bool(distributed)}")
+    return queue_ingest(db_file, distributed=distributed)
+
+
+@shared_task(bind=True)
+def aggregate_csv(self, file_id, group_by, metrics):
+    """
+    Celery task computing a group-by aggregation and caching the result next
+    to the file, keyed by file version and query.
+    
+    Args:
+        file_id: UUID of the UploadedFile record
+        group_by: List of key columns
+        metrics: List of [function, column] pairs, column None for count()
+    """
+    db_file = UploadedFile.objects.get(id=file_id)
+    metrics = [tuple(metric) for metric in metrics]
+    key = aggregation.query_key(db_file, group_by, metrics)
+    cached = aggregation.load_cached_result(db_file.file_path, key)
+    if cached:
+        return cached
+    
+    logger.info(f"AGGREGATE TASK STARTED: {file_id} group_by={group_by} metrics={metrics}")
+    total_rows = db_file.total_rows or 0
+    
+    def report(rows):
+        progress = min(99.0, 100.0 * rows / total_rows) if total_rows else None
+        self.update_state(state='PROGRESS', meta={'rows_processed': rows, 'progress': progress})
+    
+    processor = LargeCSVProcessor()
+    aggregator = aggregation.new_aggregator(db_file.file_path, key, group_by, metrics)
+    result = processor.aggregate_file(db_file.file_path, aggregator, report)
+    
+    meta = {
+        'key': key,
+        'group_by': group_by,
+        'metrics': [aggregation.metric_name(func, column) for func, column in metrics],
+        'total_groups': len(result),
+    }
+    aggregation.store_result(db_file.file_path, key, result, meta)
+    logger.info(f"AGGREGATE TASK COMPLETED: {file_id}, {len(result)} groups")
+    return meta
+
+
+@shared_task
+def diff_csv(file_a, file_b, key_columns):
+    """
+    Celery task starting the diff of two files (see diffing): plans it and
+    dispatches one partitioning task per byte range of either file, followed
+    by one diff task per hash partition. Does nothing when the diff is done
+    or already running.
+    
+    Args:
+        file_a: UUID of the old version
+        file_b: UUID of the new version
+        key_columns: Columns identifying a row; empty to compare whole rows
+    """
+    db_a = UploadedFile.objects.get(id=file_a)
+    db_b = UploadedFile.objects.get(id=file_b)
+    key = diffing.diff_key(db_a, db_b, key_columns)
+    if diffing.load_result(db_a.file_path, key):
+        return key
+    
+    plan = diffing.plan_diff(db_a, db_b, key_columns)
+    if not diffing.claim_plan(plan):
+        return key
+    logger.info(
+        f"DIFF STARTED: {file_a} -> {file_b} key={key_columns}, {plan['partitions']} partitions, "
+        f"{len(plan['ranges']['a'])} + {len(plan['ranges']['b'])} ranges"
+    )
+    header = [
+        partition_diff_range.s(plan, side, range_index, start, end)
+        for side in ('a', 'b')
+        for range_index, (start, end) in enumerate(plan['ranges'][side])
+    ]
+    callback = start_diff_partitions.s(plan).on_error(mark_diff_failed.s(plan=plan))
+    chord(header)(callback)
+    return key
+
+
+@shared_task(
+    autoretry_for=(OSError,),
+    retry_backoff=True,
+    max_retries=settings.CSV_DISTRIBUTED_RANGE_RETRIES,
+)
+def partition_diff_range(plan, side, range_index, start, end):
+    """
+    Celery task spilling one byte range of a diff input to hash partitions.
+    """
+    return LargeCSVProcessor().partition_for_diff(plan, side, range_index, start, end)
+
+
+@shared_task
+def start_diff_partitions(results, plan):
+    """
+    Chord callback of the partitioning phase: diff all hash partitions in
+    parallel, then assemble the result.
+    """
+    logger.info(f"DIFF PARTITIONED: {plan['key']}, {sum(results)} rows")
+    header = [diff_partition.s(plan, partition) for partition in range(plan['partitions'])]
+    callback = finish_diff.s(plan).on_error(mark_diff_failed.s(plan=plan))
+    return chord(header)(callback).id
+
+
+@shared_task(
+    autoretry_for=(OSError,),
+    retry_backoff=True,
+    max_retries=settings.CSV_DISTRIBUTED_RANGE_RETRIES,
+)
+def diff_partition(plan, partition):
+    return diffing.diff_partition(plan, partition)
+
+
+@shared_task
+def finish_diff(counts, plan):
+    meta = diffing.finish_diff(plan, counts)
+    logger.info(
+        f"DIFF COMPLETED: {plan['key']}, {meta['added']} added, {meta['removed']} removed, "
+        f"{meta['modified']} modified"
+    )
+    return meta
+
+
+@shared_task
+def mark_diff_failed(request, exc, traceback, plan=None):
+    """
+    Chord error callback recording the failure as the diff result.
+    """
+    logger.error(f"DIFF FAILED: {plan['key']} - Error: {exc}")
+    diffing.store_failure(plan, str(exc))
+
+
+def key_index_task_id(db_file, column: str) -> str:
+    return f"{key_index.index_name(column)}-{db_file.id}"
+
+
+def queue_key_indexes(db_file, columns: list) -> dict:
+    """
+    Queue build_key_index for those of ``columns`` that exist in the file
+    and have no key index yet, on the ingest queue matching the file size.
+    A build already queued or running for a column is not queued again;
+    one that failed is returned once and then queued again (see
+    dispatch_once).
+    
+    Returns:
+        {column: AsyncResult} of the builds queued, running or failed
+    """
+    builds = {}
+    for column in columns:
+        if column not in (db_file.columns or []):
+            logger.warning(f"Not indexing unknown column '{column}' of {db_file.id}")
+            continue
+        if key_index.load_key_index(db_file.file_path, column) is not None:
+            continue
+        builds[column] = dispatch_once(
+            build_key_index, key_index_task_id(db_file, column), [str(db_file.id), column],
+            queue=ingest_queue(db_file.file_size or 0)
+        )
+    return builds
+
+
+def queue_key_indexes_for(file_id, columns: list):
+    """
+    queue_key_indexes after an ingest, unless the file was deleted meanwhile.
+    """
+    db_file = UploadedFile.objects.filter(id=file_id).first()
+    if db_file is not None:
+        queue_key_indexes(db_file, columns)
+
+
+@shared_task(bind=True)
+def build_key_index(self, file_id, column):
+    """
+    Celery task building the key index of one column for point lookups.
+    Stops once the file is deleted.
+    
+    Args:
+        file_id: UUID of the UploadedFile record
+        column: Column to index
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+    except UploadedFile.DoesNotExist:
+        logger.info(f"KEY INDEX TASK SKIPPED, file was deleted: {file_id}")
+        return None
+    if key_index.load_key_index(db_file.file_path, column) is not None:
+        return {'column': column}
+    
+    logger.info(f"KEY INDEX TASK STARTED: {file_id} column={column}")
+    total_rows = db_file.total_rows or 0
+    cancel = CancellationCheck(file_id, db_file.file_path)
+    
+    def report(rows):
+        cancel.check()
+        progress = min(99.0, 100.0 * rows / total_rows) if total_rows else None
+        self.update_state(state='PROGRESS', meta={'rows_processed': rows, 'progress': progress})
+    
+    processor = LargeCSVProcessor()
+    try:
+        rows = processor.build_key_index(db_file.file_path, column, report)
+    except IngestCancelled as e:
+        logger.info(f"KEY INDEX TASK CANCELLED: {file_id}")
+        discard_cancelled_ingest(e.file_path)
+        return None
+    logger.info(f"KEY INDEX TASK COMPLETED: {file_id} column={column}, {rows} rows")
+    return {'column': column, 'rows': rows}
+
+
+@shared_task(bind=True)
+def run_sql_query(self, query_id, sql, file_ids):
+    """
+    Celery task running a read-only SQL query over uploaded files. The SQLite
+    database of each referenced file is (re)built first when missing or
+    stale; rows are streamed to the result CSV of the query.
+    
+    Args:
+        query_id: Query id, also used as the task id
+        sql: The SELECT statement
+        file_ids: UUIDs of the referenced UploadedFile records
+    """
+    logger.info(f"SQL QUERY STARTED: {query_id} over {len(file_ids)} files")
+    processor = LargeCSVProcessor()
+    meta = {'query_id': query_id, 'sql': sql, 'status': 'running'}
+    
+    try:
+        tables = {}
+        for file_id in file_ids:
+            db_file = UploadedFile.objects.get(id=file_id)
+            if not sql_query.database_is_current(db_file):
+                self.update_state(state='PROGRESS', meta={'stage': 'loading', 'file_id': file_id})
+                processor.build_sql_database(db_file.file_path, aggregation.file_version(db_file), db_file.columns)
+            tables[sql_query.table_name(file_id)] = sql_query.database_path(db_file.file_path)
+        
+        def report(rows):
+            self.update_state(state='PROGRESS', meta={'stage': 'running', 'rows_written': rows})
+        
+        connection = sql_query.open_query_connection(tables)
+        try:
+            with sql_query.heap_limit(connection, settings.CSV_SQL_MEMORY_LIMIT):
+                meta.update(sql_query.execute_query(
+                    connection, sql, query_id,
+                    timeout=settings.CSV_SQL_TIMEOUT_SECONDS,
+                    max_rows=settings.CSV_SQL_MAX_RESULT_ROWS,
+                    progress=report,
+                ))
+        finally:
+            connection.close()
+        meta['status'] = 'completed'
+        logger.info(f"SQL QUERY COMPLETED: {query_id}, {meta['total_rows']} rows in {meta['elapsed_seconds']}s")
+    except sql_query.QueryCancelled as e:
+        meta.update(status='cancelled', error=str(e))
+        logger.info(f"SQL QUERY CANCELLED: {query_id}")
+    except (sql_query.QueryError, UploadedFile.DoesNotExist) as e:
+        meta.update(status='failed', error=str(e))
+        logger.info(f"SQL QUERY FAILED: {query_id}: {e}")
+    except Exception as e:
+        # Loading a database can fail on the file itself (parse errors, I/O);
+        # the client polls the meta file, so the failure must land there too
+        meta.update(status='failed', error=f'Query failed: {e}')
+        logger.exception(f"SQL QUERY FAILED: {query_id}: {e}")
+    
+    sql_query.store_result_meta(query_id, meta)
+    return meta
+
+
+@shared_task
+def purge_deleted_files():
+    """
+    Unlink the files and artifacts that deletes moved to the trash (beat).
+    """
+    return {'bytes_freed': storage.purge_trash()}
+
+
+@shared_task
+def reconcile_storage():
+    """
+    Remove orphaned files from the upload directories and fail records
+    whose file is gone (beat).
+    """
+    result = storage.reconcile()
+    logger.info(f"STORAGE RECONCILED: {result}")
+    return result
+
+
+@shared_task
+def enforce_storage_limits():
+    """
+    Evict least recently used artifacts and files once storage is above its
+    high watermark (beat).
+    """
+    target = storage.bytes_to_free()
+    if target <= 0:
+        return {'bytes_freed': 0}
+    logger.info(f"STORAGE ABOVE HIGH WATERMARK: evicting {target} bytes")
+    return storage.evict(target)
@@ -1,8 +1,13 @@
+import json
 import os
 import tempfile
+import threading
+import time
+import uuid
 import pytest
 from unittest.mock import Mock, patch
 from django.core.files.uploadedfile import SimpleUploadedFile
+import numpy as np
 import pandas as pd
 
 from .file_processor import LargeCSVProcessor
@@ -301,4 +306,2051 @@ class TestLargeCSVProcessorIntegration:
         assert estimated_rows > 0
         assert isinstance(estimated_rows, int)
         
-        db_file.delete()
\ No newline at end of file
+        db_file.delete()
+
+@pytest.mark.django_db
+class TestMetrics:
+
+    def test_offset_bucket(self):
+        from .metrics import offset_bucket
+
+        assert offset_bucket(0) == '0'
+        assert offset_bucket(999) == '<1e3'
+        assert offset_bucket(1000) == '<1e4'
+        assert offset_bucket(10 ** 9) == '>=1e8'
+
+    def test_get_data_chunk_records_latency(self, processor, temp_csv_file):
+        from .metrics import DATA_CHUNK_SECONDS
+
+        before = DATA_CHUNK_SECONDS.labels(offset_bucket='<1e3')._sum.get()
+        processor.get_data_chunk(temp_csv_file, 2, 2)
+        after = DATA_CHUNK_SECONDS.labels(offset_bucket='<1e3')._sum.get()
+        assert after > before
+
+    def test_metrics_endpoint(self, client, temp_csv_file):
+        LargeCSVProcessor().get_file_statistics(temp_csv_file)
+
+        response = client.get('/metrics')
+
+        assert response.status_code == 200
+        body = response.content.decode()
+        assert 'csv_ingest_stage_seconds' in body
+        assert 'csv_ingest_rows_total{stage="stats_scan"}' in body
+
+
+@pytest.mark.django_db
+class TestProfiling:
+
+    @pytest.fixture(autouse=True)
+    def profile_dir(self, settings, tmp_path):
+        settings.CSV_PROFILE_DIR = str(tmp_path)
+        settings.CSV_PROFILE_RETENTION = 2
+        return tmp_path
+
+    def test_profiled_is_noop_without_mode(self, profile_dir):
+        from .profiling import profiled
+
+        with profiled('get_file_data', None) as session:
+            assert session is None
+        assert os.listdir(profile_dir) == []
+
+    def test_cprofile_session_can_be_collapsed(self, processor, temp_csv_file):
+        from .profiling import profiled, profile_path, pstats_to_collapsed
+
+        with profiled('get_file_stats', 'cprofile') as session:
+            processor.get_file_statistics(temp_csv_file)
+
+        collapsed = pstats_to_collapsed(profile_path(session.profile_id))
+        assert 'get_file_statistics' in collapsed
+        for line in collapsed.splitlines():
+            stack, weight = line.rsplit(' ', 1)
+            assert int(weight) > 0
+
+    def test_retention_limit(self, profile_dir):
+        from .profiling import list_profiles, profiled
+
+        for _ in range(4):
+            with profiled('get_file_data', 'cprofile'):
+                sum(range(1000))
+
+        assert len(list_profiles()) == 2
+
+    def test_profile_header_adds_profile_id(self, admin_client):
+        response = admin_client.get('/api/health/', HTTP_X_CSV_PROFILE='cprofile')
+
+        assert response.status_code == 200
+        assert response['X-CSV-Profile-Id'].startswith(tuple('0123456789'))
+        assert '-health_check-' in response['X-CSV-Profile-Id']
+
+    def test_profile_header_ignored_for_anonymous_clients(self, client, settings, profile_dir):
+        response = client.get('/api/health/', HTTP_X_CSV_PROFILE='cprofile')
+
+        assert response.status_code == 200
+        assert 'X-CSV-Profile-Id' not in response
+        assert os.listdir(profile_dir) == []
+
+        settings.CSV_PROFILE_STAFF_ONLY = False
+        assert 'X-CSV-Profile-Id' in client.get('/api/health/', HTTP_X_CSV_PROFILE='cprofile')
+
+    def test_profile_path_rejects_traversal(self):
+        from .profiling import profile_path
+
+        with pytest.raises(FileNotFoundError):
+            profile_path('../../etc/passwd')
+
+
+@pytest.mark.django_db
+class TestDistributedIngest:
+
+    @pytest.fixture
+    def quoted_csv_file(self):
+        content = 'id,note,value\n1,"multi\nline",10\n2,plain,\n\n3,"a ""quoted"" word",30\n4,x,40\n'
+        temp_file = tempfile.NamedTemporaryFile(mode='w+', suffix='.csv', delete=False)
+        temp_file.write(content)
+        temp_file.close()
+        yield temp_file.name
+        os.unlink(temp_file.name)
+
+    def test_scan_records_is_quote_aware(self, quoted_csv_file):
+        from . import row_index
+
+        start = row_index.header_end(quoted_csv_file)
+        rows, checkpoints = row_index.scan_records(quoted_csv_file, start, stride=2)
+
+        assert rows == 4
+        assert [row for row, _ in checkpoints] == [0, 2]
+        with open(quoted_csv_file, 'rb') as f:
+            f.seek(checkpoints[1][1])
+            assert f.readline().startswith(b'3,')
+
+    def test_find_record_ranges_cover_data(self, temp_csv_file):
+        from . import row_index
+
+        ranges = row_index.find_record_ranges(temp_csv_file, 3)
+
+        assert ranges[0][0] == row_index.header_end(temp_csv_file)
+        assert ranges[-1][1] == os.path.getsize(temp_csv_file)
+        for (_, end), (next_start, _) in zip(ranges, ranges[1:]):
+            assert end == next_start
+        total = sum(row_index.scan_records(temp_csv_file, start, end)[0] for start, end in ranges)
+        assert total == 5
+
+    def test_find_record_ranges_keep_multiline_fields_whole(self, tmp_path):
+        from . import row_index
+
+        path = tmp_path / 'multiline.csv'
+        rows = [f'{i},"first line\nsecond line\nthird line {i}",{i}' for i in range(200)]
+        path.write_bytes(('id,note,value\n' + '\n'.join(rows) + '\n').encode('utf-8'))
+
+        ranges = row_index.find_record_ranges(str(path), 7, buffer_size=100)
+
+        assert len(ranges) == 7
+        assert sum(row_index.scan_records(str(path), start, end)[0] for start, end in ranges) == 200
+        with open(path, 'rb') as f:
+            for start, _ in ranges:
+                f.seek(start)
+                assert f.readline().split(b',')[0].isdigit()
+
+    def test_stray_quotes_are_not_distributed(self, settings, processor):
+        settings.CSV_DISTRIBUTED_RANGE_BYTES = 20
+        uploaded_file = SimpleUploadedFile("inches.csv", b'id,size\n1,5" tv\n2,7" tv\n3,9" tv\n4,x\n')
+        db_file = processor.save_uploaded_file(uploaded_file, "inches.csv")
+
+        assert processor.prepare_distributed_ingest(str(db_file.id)) is None
+
+    def test_ranges_merge_into_record(self, settings, processor):
+        from . import row_index
+
+        settings.CSV_DISTRIBUTED_RANGE_BYTES = 40
+        settings.CSV_ROW_INDEX_STRIDE = 3
+        csv_content = "id,name,value\n" + "\n".join(f"{i},n{i},{'' if i % 4 == 0 else i * 1.5}" for i in range(20))
+        uploaded_file = SimpleUploadedFile("ranges.csv", csv_content.encode('utf-8'))
+        db_file = processor.save_uploaded_file(uploaded_file, "ranges.csv")
+
+        ranges = processor.prepare_distributed_ingest(str(db_file.id))
+        assert len(ranges) > 1
+        results = [
+            processor.analyze_byte_range(str(db_file.id), i, start, end, len(ranges))
+            for i, (start, end) in enumerate(ranges)
+        ]
+        processor.merge_range_results(str(db_file.id), list(reversed(results)))
+
+        db_file.refresh_from_db()
+        expected = processor.get_file_statistics(db_file.file_path)
+        assert db_file.status == 'completed'
+        assert db_file.total_rows == 20
+        assert db_file.statistics['null_counts'] == expected['null_counts']
+        assert db_file.dtypes['value'] == 'float64'
+
+        index = row_index.load_row_index(db_file.file_path)
+        checkpoint_row, offset = row_index.locate_row(index, 13)
+        with open(db_file.file_path, 'rb') as f:
+            f.seek(offset)
+            assert f.readline().startswith(f"{checkpoint_row},".encode())
+
+    def test_retry_resumes_failed_distributed_ingest(self, client, settings, processor):
+        from .tasks import mark_ingest_failed, process_large_csv
+
+        settings.CSV_DISTRIBUTED_RANGE_BYTES = 40
+        csv_content = "id,name,value\n" + "\n".join(f"{i},n{i},{i}" for i in range(20))
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("ranges.csv", csv_content.encode('utf-8')), "ranges.csv")
+        ranges = processor.prepare_distributed_ingest(str(db_file.id))
+        processor.analyze_byte_range(str(db_file.id), 0, *ranges[0], len(ranges))
+        mark_ingest_failed.run(None, OSError('worker lost'), None, file_id=str(db_file.id))
+        url = f'/api/files/{db_file.id}/retry/'
+
+        with patch.object(process_large_csv, 'apply_async', side_effect=lambda **options: Mock(id=options['task_id'])) as apply_async:
+            response = client.post(url)
+            again = client.post(url)
+        db_file.refresh_from_db()
+
+        assert response.status_code == 202 and again.status_code == 400
+        assert apply_async.call_count == 1
+        assert apply_async.call_args.kwargs['kwargs'] == {'distributed': True}
+        assert apply_async.call_args.kwargs['task_id'] == db_file.task_id == response.json()['task_id']
+        assert (db_file.status, db_file.error_message) == ('processing', None)
+
+    def test_merge_dtype(self):
+        from .file_processor import merge_dtype
+
+        assert merge_dtype(None, 'int64') == 'int64'
+        assert merge_dtype('int64', 'float64') == 'float64'
+        assert merge_dtype('int64', 'object') == 'object'
+
+
+@pytest.mark.django_db
+class TestContentDeduplication:
+
+    def _complete(self, processor, db_file):
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        return db_file
+
+    def test_identical_upload_shares_file(self, processor, test_csv_bytes):
+        from .artifacts import artifact_path
+
+        first = processor.save_uploaded_file(SimpleUploadedFile("a.csv", test_csv_bytes), "a.csv")
+        assert not processor.share_duplicate_content(first)
+        first = self._complete(processor, first)
+        sidecar = artifact_path(first.file_path, 'sidecar')
+        open(sidecar, 'w').close()
+
+        second = processor.save_uploaded_file(SimpleUploadedFile("b.csv", test_csv_bytes), "b.csv")
+        second_copy = second.file_path
+
+        assert processor.share_duplicate_content(second)
+        assert second.content_hash == first.content_hash
+        assert second.file_path == first.file_path
+        assert second.status == 'completed'
+        assert second.total_rows == first.total_rows == 5
+        assert not os.path.exists(second_copy)
+
+        first.delete()
+        assert os.path.exists(second.file_path)
+        assert os.path.exists(sidecar)
+
+        second.delete()
+        assert not os.path.exists(second.file_path)
+        assert not os.path.exists(sidecar)
+
+    def test_different_content_is_not_shared(self, processor, test_csv_bytes):
+        first = processor.save_uploaded_file(SimpleUploadedFile("a.csv", test_csv_bytes), "a.csv")
+        self._complete(processor, first)
+
+        other = processor.save_uploaded_file(SimpleUploadedFile("c.csv", test_csv_bytes + b"\nZed,40,Austin"), "c.csv")
+
+        assert not processor.share_duplicate_content(other)
+        assert other.file_path != first.file_path
+
+    def test_sharing_and_delete_lock_the_original(self, processor, test_csv_bytes):
+        from django.db.models import QuerySet
+
+        first = self._complete(processor, processor.save_uploaded_file(SimpleUploadedFile("a.csv", test_csv_bytes), "a.csv"))
+        second = processor.save_uploaded_file(SimpleUploadedFile("b.csv", test_csv_bytes), "b.csv")
+        lock = QuerySet.select_for_update
+        locked = []
+
+        def select_for_update(queryset, *args, **kwargs):
+            locked.append(queryset.model)
+            return lock(queryset, *args, **kwargs)
+
+        with patch.object(QuerySet, 'select_for_update', autospec=True, side_effect=select_for_update):
+            assert processor.share_duplicate_content(second)
+            first.delete()
+
+        assert locked == [UploadedFile, UploadedFile]
+        assert os.path.exists(second.file_path)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAggregation:
+
+    @pytest.fixture
+    def sales_frame(self):
+        return pd.DataFrame({
+            'region': ['north', 'south', 'north', 'east', 'south', 'north', None, 'east'] * 5,
+            'amount': [10, 20, 30, 40, 50, 60, 70, 80] * 5,
+            'price': [1.5, 2.5, None, 4.0, 5.0, 6.0, 7.0, 8.0] * 5,
+        })
+
+    @pytest.fixture
+    def sales_file(self, sales_frame, tmp_path):
+        path = tmp_path / 'sales.csv'
+        sales_frame.to_csv(path, index=False)
+        return str(path)
+
+    def test_parse_metrics(self):
+        from .aggregation import AggregationError, parse_metrics
+
+        assert parse_metrics('sum(amount), count(),mean(price)') == [
+            ('sum', 'amount'), ('count', None), ('mean', 'price')
+        ]
+        with pytest.raises(AggregationError):
+            parse_metrics('median(amount)')
+        with pytest.raises(AggregationError):
+            parse_metrics('sum()')
+
+    @pytest.mark.parametrize('max_groups', [1000, 2])
+    def test_partial_aggregation_matches_pandas(self, processor, sales_frame, sales_file, tmp_path, max_groups):
+        from .aggregation import PartialAggregator, parse_metrics
+
+        metrics = parse_metrics('sum(amount),count(),count(price),mean(price),min(price),max(amount)')
+        aggregator = PartialAggregator(['region'], metrics, str(tmp_path / 'spill'), max_groups, partitions=3)
+
+        result = processor.aggregate_file(sales_file, aggregator).set_index('region').sort_index()
+
+        expected = sales_frame.groupby('region', dropna=False).agg(
+            amount_sum=('amount', 'sum'), price_mean=('price', 'mean'), price_count=('price', 'count'),
+            price_min=('price', 'min'), amount_max=('amount', 'max')
+        ).sort_index()
+        assert list(result.index.fillna('<null>')) == list(expected.index.fillna('<null>'))
+        assert list(result['sum(amount)']) == list(expected['amount_sum'])
+        assert list(result['count()']) == list(sales_frame.groupby('region', dropna=False).size().sort_index())
+        assert list(result['count(price)']) == list(expected['price_count'])
+        assert list(result['mean(price)']) == pytest.approx(list(expected['price_mean']))
+        assert list(result['min(price)']) == list(expected['price_min'])
+        assert list(result['max(amount)']) == list(expected['amount_max'])
+
+    def test_endpoint_serves_cached_result(self, client, processor, sales_file):
+        from . import aggregation
+
+        db_file = UploadedFile.objects.create(
+            filename='sales.csv', file_path=sales_file, file_size=os.path.getsize(sales_file),
+            status='completed', columns=['region', 'amount', 'price'], total_rows=40
+        )
+        metrics = aggregation.parse_metrics('sum(amount)')
+        key = aggregation.query_key(db_file, ['region'], metrics)
+        aggregator = aggregation.new_aggregator(sales_file, key, ['region'], metrics)
+        result = processor.aggregate_file(sales_file, aggregator)
+        aggregation.store_result(sales_file, key, result, {
+            'key': key, 'group_by': ['region'], 'metrics': ['sum(amount)'], 'total_groups': len(result)
+        })
+
+        response = client.get(f'/api/files/{db_file.id}/aggregate/', {
+            'group_by': 'region', 'metrics': 'sum(amount)', 'page_size': 2
+        })
+
+        assert response.status_code == 200
+        body = response.json()
+        assert body['total_groups'] == 4
+        assert len(body['data']) == 2
+        assert body['has_next'] is True
+
+    def test_endpoint_rejects_unknown_column(self, client, sales_file):
+        db_file = UploadedFile.objects.create(
+            filename='sales.csv', file_path=sales_file, file_size=1,
+            status='completed', columns=['region', 'amount', 'price']
+        )
+
+        response = client.get(f'/api/files/{db_file.id}/aggregate/', {'group_by': 'nope', 'metrics': 'count()'})
+
+        assert response.status_code == 400
+
+    def test_polls_queue_one_run_and_report_failure(self, client, sales_file):
+        from .tasks import aggregate_csv
+
+        db_file = UploadedFile.objects.create(
+            filename='sales.csv', file_path=sales_file, file_size=os.path.getsize(sales_file),
+            status='completed', columns=['region', 'amount', 'price'], total_rows=40
+        )
+        url, params = f'/api/files/{db_file.id}/aggregate/', {'group_by': 'region', 'metrics': 'sum(amount)'}
+        states = {}
+
+        def async_result(task_id):
+            return Mock(state=states.get(task_id, 'PENDING'), result=MemoryError('out of memory'), info=None)
+
+        with patch.object(aggregate_csv, 'AsyncResult', side_effect=async_result), \
+                patch.object(type(aggregate_csv.backend), 'store_result', side_effect=lambda task_id, result, state: states.update({task_id: state})), \
+                patch.object(type(aggregate_csv.backend), 'forget', side_effect=lambda task_id: states.pop(task_id)), \
+                patch.object(aggregate_csv, 'apply_async') as apply_async:
+            queued = client.get(url, params)
+            polled = client.get(url, params)
+            states[queued.json()['task_id']] = 'FAILURE'
+            failed = client.get(url, params)
+            assert apply_async.call_count == 1
+            requeued = client.get(url, params)
+
+        assert queued.status_code == polled.status_code == requeued.status_code == 202
+        assert apply_async.call_count == 2
+        assert failed.status_code == 500 and failed.json()['error'] == 'out of memory'
+
+
+@pytest.mark.django_db(transaction=True)
+class TestColumnDistributions:
+
+    def test_histogram_grows_to_cover_new_values(self):
+        from .distributions import NumericHistogram
+
+        histogram = NumericHistogram(bins=8)
+        histogram.update(pd.Series([10, 11, 12, None]))
+        histogram.update(pd.Series([-50, 500]))
+
+        summary = histogram.describe()
+        assert summary['count'] == 5
+        assert summary['null_count'] == 1
+        assert sum(b['count'] for b in summary['bins']) == 5
+        assert summary['bins'][0]['start'] == -50
+        assert summary['bins'][-1]['end'] == 500
+
+    def test_histogram_merge_and_round_trip(self):
+        from .distributions import NumericHistogram
+
+        left, right = NumericHistogram(bins=16), NumericHistogram(bins=16)
+        left.update(pd.Series(range(0, 100)))
+        right.update(pd.Series(range(1000, 1100)))
+
+        merged = NumericHistogram.from_dict(left.to_dict())
+        merged.merge(right)
+
+        assert merged.count == 200
+        assert int(merged.counts.sum()) == 200
+        assert merged.minimum == 0 and merged.maximum == 1099
+
+    def test_top_k_sketch(self):
+        from .distributions import TopKSketch
+
+        sketch = TopKSketch(k=2, capacity=3)
+        sketch.update(pd.Series(['a'] * 50 + ['b'] * 30 + ['c', 'd', 'e', 'f']))
+        sketch.update(pd.Series(['a'] * 5 + ['g'] * 2 + [None]))
+
+        summary = sketch.describe()
+        assert [entry['value'] for entry in summary['top']] == ['a', 'b']
+        assert summary['top'][0]['count'] >= 55
+        assert summary['top'][0]['count'] - summary['top'][0]['max_error'] <= 55
+        assert summary['approximate'] is True
+        assert summary['null_count'] == 1
+
+    def test_text_in_numeric_column_and_mixed_kinds(self):
+        from .distributions import ColumnDistributionCollector, describe_column
+
+        numeric_first = ColumnDistributionCollector(bins=4, top_k=2)
+        numeric_first.update(pd.DataFrame({'code': [1, 2, 3]}))
+        numeric_first.update(pd.DataFrame({'code': ['4', 'n/a', None, 'x']}))
+        text_first = ColumnDistributionCollector(bins=4, top_k=2)
+        text_first.update(pd.DataFrame({'code': ['x', None, '7']}))
+
+        numeric = describe_column(numeric_first.to_dict()['code'])
+        assert (numeric['kind'], numeric['count'], numeric['coerced'], numeric['null_count']) == ('numeric', 4, 2, 1)
+        assert numeric_first.merge(text_first) == ['code']
+        assert describe_column(numeric_first.to_dict()['code']) == {'kind': 'mixed', 'count': 8, 'null_count': 2}
+
+    def test_distribution_endpoint_after_ingest(self, client, processor, test_csv_bytes):
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("dist.csv", test_csv_bytes), "dist.csv")
+        processor.process_file_async(str(db_file.id))
+
+        age = client.get(f'/api/files/{db_file.id}/columns/age/distribution/').json()['distribution']
+        city = client.get(f'/api/files/{db_file.id}/columns/city/distribution/').json()['distribution']
+        missing = client.get(f'/api/files/{db_file.id}/columns/nope/distribution/')
+
+        assert age['kind'] == 'numeric'
+        assert age['min'] == 25 and age['max'] == 35
+        assert sum(b['count'] for b in age['bins']) == 5
+        assert city['kind'] == 'categorical'
+        assert {entry['value'] for entry in city['top']} == {'NYC', 'LA', 'Chicago', 'Boston', 'Seattle'}
+        assert missing.status_code == 404
+
+
+@pytest.mark.django_db
+class TestRowCounting:
+
+    @pytest.mark.parametrize('content', [
+        'a,b\n1,2\n3,4\n',
+        'a,b\n1,2\n3,4',
+        'a,b\r\n1,2\r\n\r\n3,4\r\n',
+        'a,b\n"x\ny",2\n"he said ""hi""\n",4\n\n5,6\n',
+        'a,b\n',
+        'a,b\n1,"a,b\n\nc"\n',
+        'a,b\n"",""""\n"x""",y\n',
+    ])
+    def test_count_matches_pandas(self, processor, tmp_path, content):
+        path = tmp_path / 'count.csv'
+        path.write_bytes(content.encode('utf-8'))
+
+        assert processor.count_rows(str(path)) == len(pd.read_csv(path))
+
+    def test_small_buffers_carry_quote_state(self, tmp_path):
+        from . import row_index
+
+        rows = [f'{i},"line one\nline ""two"" {i}"' for i in range(50)]
+        path = tmp_path / 'quoted.csv'
+        path.write_bytes(('id,text\n' + '\n'.join(rows) + '\n').encode('utf-8'))
+        start = row_index.header_end(str(path))
+
+        count, checkpoints = row_index.scan_records(str(path), start, stride=7, buffer_size=5)
+
+        assert count == 50
+        with open(path, 'rb') as f:
+            for row, offset in checkpoints:
+                f.seek(offset)
+                assert f.readline().startswith(f'{row},'.encode())
+
+    def test_escaped_quotes_fall_back_to_parser(self, processor, tmp_path):
+        path = tmp_path / 'escaped.csv'
+        path.write_bytes(b'a,b\n1,"x \\" y"\n2,z\n')
+
+        from . import row_index
+        assert row_index.needs_parser_count(str(path))
+        assert processor.count_rows(str(path)) == 2
+
+    def test_stray_quotes_fall_back_to_parser(self, processor, tmp_path):
+        from . import row_index
+
+        path = tmp_path / 'inches.csv'
+        path.write_bytes(b'id,size,price\n1,5" tv,10\n2,7" tv,20\n3,9" tv,30\n4,x,40\n')
+
+        assert processor.count_rows(str(path)) == 4
+        assert row_index.load_row_index(str(path)) is None
+        page = processor.get_data_chunk(str(path), 1, 1)
+        assert page['id'].tolist() == [2]
+        assert page['size'].tolist() == ['7" tv']
+
+
+@pytest.mark.django_db(transaction=True)
+class TestSampling:
+
+    @pytest.fixture
+    def numbered_frame(self):
+        return pd.DataFrame({
+            'id': range(5000),
+            'group': ['a'] * 4000 + ['b'] * 900 + ['c'] * 100,
+        })
+
+    def test_reservoir_keeps_size_rows_with_row_numbers(self, numbered_frame):
+        from .sampling import ReservoirSampler
+
+        reservoir = ReservoirSampler(size=200, seed=1)
+        for start in range(0, 5000, 700):
+            reservoir.update(numbered_frame.iloc[start:start + 700].reset_index(drop=True))
+
+        assert reservoir.seen == 5000
+        assert len(reservoir.sample) == 200
+        assert reservoir.sample.index.is_unique
+        assert (reservoir.sample['id'] == reservoir.sample.index).all()
+        # Rows past the first chunk must be able to enter the reservoir
+        assert reservoir.sample['id'].max() > 2500
+
+    def test_merged_reservoir_covers_both_parts(self, numbered_frame):
+        from .sampling import ReservoirSampler
+
+        left, right = ReservoirSampler(size=100, seed=1), ReservoirSampler(size=100, seed=2)
+        left.update(numbered_frame.iloc[:2500].reset_index(drop=True))
+        right.update(numbered_frame.iloc[2500:].reset_index(drop=True))
+        right.sample.index = right.sample.index + 2500
+        left.merge(right)
+
+        assert left.seen == 5000
+        assert len(left.sample) == 100
+        assert (left.sample['id'] == left.sample.index).all()
+        assert (left.sample['id'] < 2500).any() and (left.sample['id'] >= 2500).any()
+
+    def test_stratified_allocation(self, numbered_frame):
+        from .sampling import stratified_sample
+
+        sample = stratified_sample(numbered_frame, 'group', 100, seed=3)
+
+        assert sample['group'].value_counts().to_dict() == {'a': 80, 'b': 18, 'c': 2}
+        assert sample.equals(stratified_sample(numbered_frame, 'group', 100, seed=3))
+
+    def test_read_rows_through_row_index(self, processor, numbered_frame, tmp_path, settings):
+        settings.CSV_ROW_INDEX_STRIDE = 64
+        path = tmp_path / 'numbered.csv'
+        numbered_frame.to_csv(path, index=False)
+
+        rows = processor.read_rows(str(path), ['id', 'group'], [4999, 0, 65, 1234, 65])
+
+        assert rows.index.tolist() == [0, 65, 1234, 4999]
+        assert rows['id'].tolist() == [0, 65, 1234, 4999]
+
+    def test_sample_endpoint(self, client, processor, numbered_frame, settings):
+        settings.CSV_RESERVOIR_SIZE = 500
+        db_file = processor.save_uploaded_file(
+            SimpleUploadedFile("sample.csv", numbered_frame.to_csv(index=False).encode('utf-8')), "sample.csv"
+        )
+        processor.process_file_async(str(db_file.id))
+        url = f'/api/files/{db_file.id}/sample/'
+
+        first = client.get(url, {'n': 50, 'seed': 7}).json()
+        again = client.get(url, {'n': 50, 'seed': 7}).json()
+        large = client.get(url, {'n': 1000, 'seed': 7}).json()
+        stratified = client.get(url, {'n': 50, 'stratify': 'group'}).json()
+
+        assert first['method'] == 'reservoir' and first['n'] == 50
+        assert first['row_numbers'] == again['row_numbers']
+        assert [row['id'] for row in first['data']] == first['row_numbers']
+        assert large['method'] == 'row_index' and large['n'] == 1000
+        assert [row['id'] for row in large['data']] == large['row_numbers']
+        assert stratified['method'] == 'stratified' and 'seed' in stratified
+        assert {row['group'] for row in stratified['data']} == {'a', 'b', 'c'}
+        assert client.get(url, {'n': 0}).status_code == 400
+
+
+@pytest.mark.django_db(transaction=True)
+class TestSqlQuery:
+
+    @pytest.fixture(autouse=True)
+    def result_dir(self, settings, tmp_path):
+        settings.CSV_SQL_RESULT_DIR = str(tmp_path / 'results')
+        return tmp_path / 'results'
+
+    @pytest.fixture
+    def files(self, tmp_path):
+        frames = {
+            'orders': pd.DataFrame({'customer': [1, 2, 1, 3, 2, 1], 'amount': [10.0, 20.0, 5.0, 7.5, 1.0, 2.0]}),
+            'customers': pd.DataFrame({'customer': [1, 2, 3], 'name': ['ann', 'bob', 'cy']}),
+        }
+        records = {}
+        for name, frame in frames.items():
+            path = tmp_path / f'{name}.csv'
+            frame.to_csv(path, index=False)
+            records[name] = UploadedFile.objects.create(
+                filename=f'{name}.csv', file_path=str(path), file_size=os.path.getsize(path),
+                status='completed', columns=list(frame.columns), total_rows=len(frame)
+            )
+        return records
+
+    def run(self, client, sql):
+        from .tasks import run_sql_query
+
+        with patch.object(run_sql_query, 'update_state'), \
+                patch.object(run_sql_query, 'apply_async', side_effect=lambda args, task_id: run_sql_query.run(*args)):
+            response = client.post('/api/query/sql/', {'sql': sql}, content_type='application/json')
+        return response
+
+    def test_join_across_files_with_pagination(self, client, files):
+        from .sql_query import table_name
+
+        orders, customers = table_name(files['orders'].id), table_name(files['customers'].id)
+        response = self.run(client, f"""
+            SELECT c.name, sum(o.amount) AS total
+            FROM {orders} o JOIN {customers} c USING (customer)
+            GROUP BY c.name ORDER BY c.name
+        """)
+        assert response.status_code == 202
+        query_id = response.json()['query_id']
+
+        first = client.get(f'/api/query/sql/{query_id}/', {'page_size': 2}).json()
+        second = client.get(f'/api/query/sql/{query_id}/', {'page_size': 2, 'page': 2}).json()
+
+        assert first['status'] == 'completed'
+        assert first['columns'] == ['name', 'total']
+        assert first['total_rows'] == 3
+        assert first['data'] == [{'name': 'ann', 'total': 17.0}, {'name': 'bob', 'total': 21.0}]
+        assert second['data'] == [{'name': 'cy', 'total': 7.5}]
+        assert client.delete(f'/api/query/sql/{query_id}/').json()['status'] == 'deleted'
+
+    @pytest.mark.parametrize('sql', [
+        "DELETE FROM {orders}",
+        "CREATE TABLE t (x)",
+        "ATTACH DATABASE '/tmp/x.db' AS x",
+        "PRAGMA query_only = OFF",
+        "SELECT 1; DROP VIEW {orders}",
+    ])
+    def test_statements_other_than_select_fail(self, client, files, sql):
+        from .sql_query import table_name
+
+        response = self.run(client, sql.format(orders=table_name(files['orders'].id)))
+        result = client.get(f"/api/query/sql/{response.json()['query_id']}/").json()
+
+        assert result['status'] == 'failed'
+        assert pd.read_csv(files['orders'].file_path).shape == (6, 2)
+
+    def test_rows_with_too_many_fields(self, client, processor):
+        from .sql_query import table_name
+
+        db_file = processor.save_uploaded_file(
+            SimpleUploadedFile("over.csv", b'a,b,c\n1,2,3\n4,5,6,7\n8,9,10\n'), "over.csv"
+        )
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        assert db_file.status == 'completed'
+
+        response = self.run(client, f"SELECT sum(c) AS total FROM {table_name(db_file.id)}")
+        result = client.get(f"/api/query/sql/{response.json()['query_id']}/").json()
+        UploadedFile.objects.filter(id=db_file.id).update(statistics=None)
+        stats = client.get(f'/api/files/{db_file.id}/stats/').json()['statistics']
+
+        assert result['status'] == 'completed' and result['data'] == [{'total': 19}]
+        assert stats['columns'] == ['a', 'b', 'c'] and stats['total_rows'] == 3
+
+    def test_unexpected_errors_are_reported_as_failed(self, client, files):
+        from .sql_query import new_query_id, table_name
+
+        with patch.object(LargeCSVProcessor, 'build_sql_database', side_effect=OSError('disk gone')):
+            response = self.run(client, f"SELECT * FROM {table_name(files['orders'].id)}")
+        result = client.get(f"/api/query/sql/{response.json()['query_id']}/").json()
+
+        crashed = Mock(state='FAILURE', result=MemoryError('worker lost'))
+        with patch('csv_processor.views.AsyncResult', return_value=crashed):
+            lost = client.get(f"/api/query/sql/{new_query_id()}/")
+
+        assert result['status'] == 'failed' and 'disk gone' in result['error']
+        assert lost.status_code == 200
+        assert lost.json()['status'] == 'failed' and lost.json()['error'] == 'worker lost'
+
+    def test_unknown_table_is_rejected(self, client, files):
+        response = client.post(
+            '/api/query/sql/', {'sql': f'SELECT * FROM file_{"0" * 32}'}, content_type='application/json'
+        )
+
+        assert response.status_code == 400
+
+    def test_timeout_and_cancel_interrupt_query(self, client, files, settings):
+        from . import sql_query
+
+        endless = "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT count(*) FROM n"
+        settings.CSV_SQL_TIMEOUT_SECONDS = 0.3
+        timed_out = client.get(f"/api/query/sql/{self.run(client, endless).json()['query_id']}/").json()
+
+        settings.CSV_SQL_TIMEOUT_SECONDS = 30
+        query_id = sql_query.new_query_id()
+        sql_query.request_cancel(query_id)
+        connection = sql_query.open_query_connection({})
+        with pytest.raises(sql_query.QueryCancelled):
+            sql_query.execute_query(connection, endless, query_id, timeout=30, max_rows=10)
+
+        assert timed_out['status'] == 'failed'
+        assert 'time limit' in timed_out['error']
+
+
+@pytest.mark.django_db(transaction=True)
+class TestRawPages:
+
+    @pytest.fixture
+    def raw_file(self, tmp_path, settings):
+        settings.CSV_ROW_INDEX_STRIDE = 4
+        lines = ['id,text'] + [f'{i},"row {i}\nsecond ""line"""' if i % 3 == 0 else f'{i},plain {i}' for i in range(25)]
+        path = tmp_path / 'raw.csv'
+        path.write_bytes(('\r\n'.join(lines[:10]) + '\r\n\r\n' + '\n'.join(lines[10:]) + '\n').encode('utf-8'))
+        return UploadedFile.objects.create(
+            filename='raw.csv', file_path=str(path), file_size=os.path.getsize(path),
+            status='completed', columns=['id', 'text'], total_rows=25
+        )
+
+    def raw_page(self, client, db_file, **params):
+        response = client.get(f'/api/files/{db_file.id}/data/', {'format': 'raw', **params})
+        return response, b''.join(response.streaming_content)
+
+    @pytest.mark.parametrize('page', [1, 2, 3, 4])
+    def test_raw_page_matches_parser(self, client, raw_file, page):
+        import io
+
+        response, body = self.raw_page(client, raw_file, page=page, page_size=7)
+        expected = pd.read_csv(raw_file.file_path).iloc[(page - 1) * 7:page * 7]
+
+        assert response['Content-Type'] == 'text/csv'
+        assert response['X-Total-Rows'] == '25'
+        assert int(response['Content-Length']) == len(body)
+        assert pd.read_csv(io.BytesIO(body)).to_dict('records') == expected.to_dict('records')
+
+    def test_raw_page_past_end_is_header_only(self, client, raw_file):
+        response, body = self.raw_page(client, raw_file, page=10, page_size=7)
+
+        assert body == b'id,text\r\n'
+        assert response['X-Has-Next'] == 'false'
+
+    @pytest.mark.parametrize('params', [{'page': 'abc'}, {'page_size': '1e3'}])
+    def test_non_integer_page_is_rejected(self, client, raw_file, params):
+        response = client.get(f'/api/files/{raw_file.id}/data/', params)
+
+        assert response.status_code == 400
+        assert response.json()['error'] == 'page and page_size must be integers'
+
+    def test_accept_header_selects_raw_mode(self, client, raw_file):
+        response = client.get(f'/api/files/{raw_file.id}/data/', {'page_size': 2}, HTTP_ACCEPT='text/csv')
+
+        assert b''.join(response.streaming_content) == b'id,text\r\n0,"row 0\nsecond ""line"""\r\n1,plain 1\r\n'
+
+    def test_unindexable_dialect_is_refused_without_counting(self, client, tmp_path):
+        path = tmp_path / 'escaped.csv'
+        path.write_bytes(b'id,text\n1,"say \\"hi\\""\n2,plain\n')
+        db_file = UploadedFile.objects.create(
+            filename='escaped.csv', file_path=str(path), file_size=os.path.getsize(path),
+            status='completed', columns=['id', 'text'], total_rows=2
+        )
+
+        with patch.object(LargeCSVProcessor, 'count_rows') as count_rows:
+            response = client.get(f'/api/files/{db_file.id}/data/', {'format': 'raw'})
+
+        assert response.status_code == 400
+        assert 'not available' in json.loads(response.content)['error']
+        count_rows.assert_not_called()
+
+
+@pytest.mark.django_db(transaction=True)
+class TestReadExecutor:
+
+    @pytest.fixture
+    def small_executor(self, settings):
+        from .executor import get_read_executor, reset_executors
+
+        settings.CSV_READ_EXECUTOR_WORKERS = 1
+        settings.CSV_READ_EXECUTOR_QUEUE = 0
+        reset_executors()
+        release = threading.Event()
+        get_read_executor().submit(release.wait)
+        yield get_read_executor()
+        release.set()
+        reset_executors()
+
+    def test_admission_limit(self):
+        from .executor import BoundedExecutor, ExecutorSaturated
+
+        executor = BoundedExecutor(workers=1, queue_size=1)
+        release = threading.Event()
+        running = executor.submit(release.wait)
+        queued = executor.submit(lambda: 'done')
+
+        with pytest.raises(ExecutorSaturated):
+            executor.submit(lambda: None)
+        release.set()
+
+        assert queued.result(timeout=5) == 'done' and running.result(timeout=5)
+        assert executor.in_flight == 0
+        executor.shutdown()
+
+    def test_saturated_executor_returns_503(self, client, small_executor):
+        response = client.get(f'/api/files/{uuid.uuid4()}/stats/')
+
+        assert response.status_code == 503
+        assert response['Retry-After'] == '2'
+        assert client.get('/api/health/').status_code == 200
+
+    def test_uploads_use_their_own_pool(self, client, settings, small_executor):
+        from .executor import get_executor
+
+        settings.CSV_WRITE_EXECUTOR_WORKERS = 1
+        settings.CSV_WRITE_EXECUTOR_QUEUE = 0
+        # The read pool is saturated, uploads still run
+        assert client.post('/api/upload-large-csv/', {}).status_code == 400
+
+        release = threading.Event()
+        get_executor('write').submit(release.wait)
+        try:
+            upload = client.post('/api/upload-large-csv/', {})
+            append = client.post(f'/api/files/{uuid.uuid4()}/append/', {})
+        finally:
+            release.set()
+
+        assert upload.status_code == append.status_code == 503
+        assert client.get(f'/api/files/{uuid.uuid4()}/sample/').status_code == 503
+
+    def test_disconnect_drops_queued_request(self, settings, small_executor):
+        import asyncio
+        from .handlers import DisconnectAwareASGIHandler
+
+        small_executor.limit = 2
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}, {'type': 'http.disconnect'}]
+        sent = []
+
+        async def receive():
+            if len(messages) == 1:
+                await asyncio.sleep(0.1)
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': f'/api/files/{uuid.uuid4()}/stats/',
+            'query_string': b'', 'headers': [], 'root_path': '', 'server': ('testserver', 80),
+        }
+        asyncio.run(DisconnectAwareASGIHandler()(scope, receive, send))
+
+        assert sent == []
+        assert small_executor.in_flight == 1
+
+    def upload_over_asgi(self, body: bytes, content_type: str):
+        import asyncio
+        from django.core.handlers.asgi import ASGIHandler
+        from .handlers import DisconnectAwareASGIHandler
+
+        messages = [
+            {'type': 'http.request', 'body': body[i:i + 100], 'more_body': i + 100 < len(body)}
+            for i in range(0, len(body), 100)
+        ]
+        received, sent = [], []
+
+        async def receive():
+            message = messages.pop(0)
+            received.append(message)
+            return message
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http', 'method': 'POST', 'path': '/api/upload-large-csv/', 'query_string': b'',
+            'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+            'root_path': '', 'server': ('testserver', 80),
+        }
+        with patch.object(ASGIHandler, 'read_body', side_effect=AssertionError('body spooled by the handler')), \
+                patch('csv_processor.views.queue_ingest'):
+            asyncio.run(DisconnectAwareASGIHandler()(scope, receive, send))
+        return sent[0]['status'], json.loads(sent[1]['body']), len(received)
+
+    def test_upload_body_streams_to_the_view(self, settings, tmp_path):
+        from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+        from prometheus_client import REGISTRY
+        from .uploads import HashingTemporaryFileUploadHandler
+
+        settings.FILE_UPLOAD_MAX_MEMORY_SIZE = 0
+        content = b'a,b\n' + b'1,2\n' * 200
+        body = encode_multipart(BOUNDARY, {'file': SimpleUploadedFile('s.csv', content)})
+        renames = lambda: REGISTRY.get_sample_value('csv_upload_finalize_total', {'method': 'rename'}) or 0
+        spooled = []
+        receive_chunk = HashingTemporaryFileUploadHandler.receive_data_chunk
+
+        def count_spooled(handler, raw_data, start):
+            spooled.append(len(raw_data))
+            return receive_chunk(handler, raw_data, start)
+
+        before = renames()
+        with patch.object(HashingTemporaryFileUploadHandler, 'receive_data_chunk', count_spooled):
+            created, payload, messages = self.upload_over_asgi(body, MULTIPART_CONTENT)
+
+        # The content is written to disk once, by the upload handler, and
+        # that spool file is renamed into place
+        assert sum(spooled) == len(content)
+        assert renames() == before + 1
+        settings.CSV_STORAGE_QUOTA_BYTES = 100
+        refused, _, unread = self.upload_over_asgi(body, MULTIPART_CONTENT)
+
+        assert created == 201 and messages > 1
+        with open(UploadedFile.objects.get(id=payload['file_id']).file_path, 'rb') as stored:
+            assert stored.read() == content
+        # Refused on the declared length, before any of the body was received
+        assert refused == 507 and unread == 0
+
+
+class FakeRedis:
+    """Just enough of the redis client for the single-flight protocol."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def eval(self, script, numkeys, key, token):
+        if self.data.get(key) == token:
+            del self.data[key]
+
+
+@pytest.mark.django_db
+class TestSingleFlight:
+
+    @pytest.fixture(autouse=True)
+    def no_redis(self, settings):
+        settings.CSV_REDIS_URL = None
+
+    def test_concurrent_calls_share_one_computation(self):
+        from .single_flight import SingleFlight
+
+        flight = SingleFlight('test')
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ['page']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('k', compute, share=list))) for _ in range(8)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while len(flight._flights['k'].done._cond._waiters) < 7 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(calls) == 1
+        assert results == [['page']] * 8
+        assert flight.in_flight() == 0
+
+    def test_error_reaches_waiting_callers(self):
+        from .single_flight import SingleFlight
+
+        flight = SingleFlight('test')
+        release = threading.Event()
+        errors = []
+
+        def compute():
+            release.wait(5)
+            raise ValueError('bad page')
+
+        def call():
+            try:
+                flight.do('k', compute)
+            except ValueError as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert errors == ['bad page'] * 3
+
+    def test_waits_for_lock_of_another_process(self, settings):
+        from . import single_flight
+
+        settings.CSV_SINGLE_FLIGHT_POLL_SECONDS = 0.005
+        fake = FakeRedis()
+        fake.data['csv:singleflight:test:k:lock'] = 'other-process'
+        timer = threading.Timer(0.05, lambda: fake.data.pop('csv:singleflight:test:k:lock'))
+        timer.start()
+        started = time.monotonic()
+
+        with patch.object(single_flight, 'get_redis', return_value=fake):
+            result = single_flight.SingleFlight('test').do('k', lambda: 'mine')
+            timer.join()
+            waited = time.monotonic() - started
+            leader_result = single_flight.SingleFlight('test').do('k', lambda: 'mine')
+
+        assert result == leader_result == 'mine'
+        assert waited >= 0.05
+        # Nothing but the lock is ever stored, and it is released
+        assert fake.data == {}
+
+    def test_pooled_pages_skip_redis(self, processor, test_csv_bytes):
+        from . import single_flight
+
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("pooled.csv", test_csv_bytes), "pooled.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        with patch.object(single_flight, 'get_redis') as get_redis:
+            page = processor.get_data_chunk(db_file.file_path, 0, 2)
+
+        assert len(page) == 2
+        get_redis.assert_not_called()
+
+    def test_data_chunk_column_selection(self, processor, test_csv_bytes, tmp_path):
+        path = tmp_path / 'columns.csv'
+        path.write_bytes(test_csv_bytes)
+
+        chunk = processor.get_data_chunk(str(path), 1, 2, columns=['name', 'city'])
+
+        assert list(chunk.columns) == ['name', 'city']
+        assert len(chunk) == 2
+
+
+@pytest.mark.django_db(transaction=True)
+class TestAppend:
+
+    @pytest.fixture
+    def ingested(self, processor, test_csv_bytes, settings):
+        settings.CSV_ROW_INDEX_STRIDE = 2
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("log.csv", test_csv_bytes), "log.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        return db_file
+
+    def test_append_updates_metadata_incrementally(self, processor, ingested):
+        from .artifacts import artifact_path
+        from .sampling import load_reservoir
+
+        open(artifact_path(ingested.file_path, 'agg-stale.csv'), 'w').close()
+        batch = b"name,age,city\nDana,41,\nEve,,Denver\n\nFrank,50,Austin\n"
+
+        result = processor.append_to_file(str(ingested.id), SimpleUploadedFile("batch.csv", batch))
+        ingested.refresh_from_db()
+        full = processor.get_file_statistics(ingested.file_path)
+
+        assert result == {'appended_rows': 3, 'total_rows': 8, 'file_size': os.path.getsize(ingested.file_path)}
+        assert ingested.total_rows == full['total_rows'] == 8
+        assert ingested.statistics['null_counts'] == full['null_counts']
+        assert ingested.dtypes['age'] == 'float64'
+        assert ingested.content_hash is None
+        assert ingested.column_distributions['age']['count'] == 7
+        assert len(load_reservoir(ingested.file_path)) == 8
+        assert not os.path.exists(artifact_path(ingested.file_path, 'agg-stale.csv'))
+        span = processor.get_raw_span(ingested.file_path, 4, 3)[1]
+        with open(ingested.file_path, 'rb') as f:
+            f.seek(span[0])
+            assert f.read(span[1] - span[0]).startswith(b'Charlie,32,Seattle\nDana,41,\nEve,,Denver\n')
+
+    def test_shared_file_is_copied_before_append(self, processor, ingested, test_csv_bytes):
+        twin = processor.save_uploaded_file(SimpleUploadedFile("twin.csv", test_csv_bytes), "twin.csv")
+        assert processor.share_duplicate_content(twin)
+
+        processor.append_to_file(str(twin.id), SimpleUploadedFile("batch.csv", b"name,age,city\nZed,40,Austin\n"))
+        twin.refresh_from_db()
+
+        assert twin.file_path != ingested.file_path
+        assert twin.total_rows == 6
+        with open(ingested.file_path, 'rb') as f:
+            assert f.read() == test_csv_bytes
+
+    def test_header_mismatch_is_rejected(self, client, ingested):
+        response = client.post(f'/api/files/{ingested.id}/append/', {
+            'file': SimpleUploadedFile("batch.csv", b"name,city\nZed,Austin\n")
+        })
+        ingested.refresh_from_db()
+
+        assert response.status_code == 400
+        assert ingested.total_rows == 5
+
+    def test_unparsable_batch_leaves_file_unchanged(self, client, processor, ingested, test_csv_bytes):
+        response = client.post(f'/api/files/{ingested.id}/append/', {
+            'file': SimpleUploadedFile("batch.csv", b'name,age,city\nC,"3\nD,4\n')
+        })
+        ingested.refresh_from_db()
+
+        assert response.status_code == 400
+        with open(ingested.file_path, 'rb') as f:
+            assert f.read() == test_csv_bytes
+        result = processor.append_to_file(str(ingested.id), SimpleUploadedFile("batch.csv", b"name,age,city\nDana,41,Austin\n"))
+        assert result['total_rows'] == 6
+        assert processor.get_data_chunk(ingested.file_path, 5, 1)['name'].tolist() == ['Dana']
+
+
+@pytest.mark.django_db
+class TestIngestScheduling:
+
+    def test_queue_follows_file_size(self, processor, test_csv_bytes, settings):
+        from .ingest_control import ingest_queue
+        from .tasks import process_large_csv, queue_ingest
+
+        settings.CSV_INGEST_QUEUES = [(100, 'ingest_small'), (None, 'ingest_large')]
+        assert ingest_queue(99) == 'ingest_small'
+        assert ingest_queue(100) == 'ingest_large'
+
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("test.csv", test_csv_bytes), "test.csv")
+        with patch.object(process_large_csv, 'apply_async') as apply_async:
+            queue_ingest(db_file)
+        db_file.refresh_from_db()
+
+        assert apply_async.call_args.kwargs['queue'] == 'ingest_small'
+        assert apply_async.call_args.kwargs['task_id'] == db_file.task_id
+
+    def test_large_ingest_waits_for_budget(self, processor, test_csv_bytes, settings):
+        from celery.exceptions import Retry
+        from .tasks import process_large_csv
+
+        settings.CSV_INGEST_ADMISSION_MIN_BYTES = 1
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("test.csv", test_csv_bytes), "test.csv")
+        with patch('csv_processor.tasks.reserve_ingest_bytes', return_value=False), \
+                patch.object(process_large_csv, 'retry', side_effect=Retry()) as retry:
+            with pytest.raises(Retry):
+                process_large_csv.run(str(db_file.id))
+        db_file.refresh_from_db()
+
+        assert retry.call_args.kwargs['countdown'] == settings.CSV_INGEST_ADMISSION_RETRY_SECONDS
+        assert db_file.status == 'uploading'
+
+        with patch('csv_processor.tasks.reserve_ingest_bytes', return_value=True), \
+                patch('csv_processor.tasks.release_ingest_bytes') as release:
+            process_large_csv.run(str(db_file.id), distributed=False)
+        db_file.refresh_from_db()
+
+        assert db_file.status == 'completed'
+        release.assert_called_once_with(str(db_file.id))
+
+    def test_delete_stops_running_ingest(self, client, processor, test_csv_bytes, settings):
+        from .artifacts import artifact_path
+        from .tasks import process_large_csv
+
+        settings.CSV_INGEST_CANCEL_CHECK_SECONDS = 0
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("test.csv", test_csv_bytes), "test.csv")
+        db_file.status = 'processing'
+        db_file.task_id = 'ingest-task'
+        db_file.save()
+        stream = LargeCSVProcessor.stream_csv_chunks
+
+        def delete_during_scan(self, file_path, *args, **kwargs):
+            for position, chunk in enumerate(stream(self, file_path, *args, **kwargs)):
+                if position == 1 and UploadedFile.objects.filter(id=db_file.id).exists():
+                    with patch('celery.current_app.control.revoke') as revoke:
+                        assert client.delete(f'/api/files/{db_file.id}/delete/').status_code == 200
+                    revoke.assert_called_once_with('ingest-task')
+                yield chunk
+
+        with patch.object(LargeCSVProcessor, 'stream_csv_chunks', delete_during_scan), \
+                patch('csv_processor.tasks.LargeCSVProcessor', lambda: LargeCSVProcessor(chunk_size=2)):
+            process_large_csv.run(str(db_file.id), distributed=False)
+
+        assert not UploadedFile.objects.filter(id=db_file.id).exists()
+        assert not os.path.exists(db_file.file_path)
+        assert not os.path.exists(artifact_path(db_file.file_path, 'rowidx.npy'))
+
+
+@pytest.mark.django_db
+class TestUploadFinalize:
+
+    @pytest.fixture
+    def spooled(self, test_csv_bytes):
+        from .uploads import HashingTemporaryFileUploadHandler
+
+        handler = HashingTemporaryFileUploadHandler()
+        handler.new_file('file', 'big.csv', 'text/csv', len(test_csv_bytes))
+        handler.receive_data_chunk(test_csv_bytes[:10], 0)
+        handler.receive_data_chunk(test_csv_bytes[10:], 10)
+        uploaded_file = handler.file_complete(len(test_csv_bytes))
+        yield uploaded_file
+        uploaded_file.close()
+
+    def test_spooled_upload_is_moved_not_copied(self, processor, spooled, test_csv_bytes):
+        spool_path = spooled.temporary_file_path()
+        inode = os.stat(spool_path).st_ino
+
+        db_file = processor.save_uploaded_file(spooled, 'big.csv')
+        in_memory = processor.save_uploaded_file(SimpleUploadedFile('small.csv', test_csv_bytes), 'small.csv')
+
+        assert not os.path.exists(spool_path)
+        assert os.stat(db_file.file_path).st_ino == inode
+        assert db_file.file_size == len(test_csv_bytes)
+        assert db_file.content_hash == in_memory.content_hash
+
+    def test_cross_filesystem_move_copies_in_kernel(self, tmp_path, test_csv_bytes):
+        import errno
+        from .uploads import move_file
+
+        source = tmp_path / 'spool.csv'
+        source.write_bytes(test_csv_bytes)
+        with patch('csv_processor.uploads.os.rename', side_effect=OSError(errno.EXDEV, 'cross-device')):
+            method = move_file(str(source), str(tmp_path / 'final.csv'))
+
+        assert method in ('copy_file_range', 'sendfile')
+        assert not source.exists()
+        assert (tmp_path / 'final.csv').read_bytes() == test_csv_bytes
+
+
+@pytest.mark.django_db(transaction=True)
+class TestReferenceHandoff:
+
+    def test_legacy_base64_message_is_spooled_and_viewable(self, client, processor, test_csv_bytes):
+        import base64
+        from .tasks import process_large_csv
+
+        db_file = processor.create_file_record_memory("memory.csv", len(test_csv_bytes))
+        payload = base64.b64encode(test_csv_bytes).decode('ascii')
+        with patch('csv_processor.uploads.BASE64_BLOCK_SIZE', 8):
+            process_large_csv.run(str(db_file.id), file_content_b64=payload)
+        db_file.refresh_from_db()
+
+        assert db_file.status == 'completed'
+        assert db_file.total_rows == 5
+        with open(db_file.file_path, 'rb') as stored:
+            assert stored.read() == test_csv_bytes
+
+        response = client.get(f'/api/files/{db_file.id}/data/', {'page_size': 2})
+        assert response.status_code == 200
+        assert [row['name'] for row in response.json()['data']] == ['John', 'Jane']
+
+    def test_spool_path_is_moved_into_place(self, processor, test_csv_bytes, tmp_path):
+        spool = tmp_path / 'spooled.csv'
+        spool.write_bytes(test_csv_bytes)
+        db_file = processor.create_file_record_memory("spooled.csv", len(test_csv_bytes))
+
+        processor.process_file_async(str(db_file.id), spool_path=str(spool))
+        db_file.refresh_from_db()
+
+        assert not spool.exists()
+        assert db_file.file_path.startswith('/tmp/csv_uploads/')
+        assert db_file.columns == ['name', 'age', 'city']
+
+
+@pytest.mark.django_db(transaction=True)
+class TestZoneMaps:
+
+    @pytest.fixture
+    def clustered(self, processor, settings):
+        settings.CSV_ZONE_MAP_BLOCK_ROWS = 4
+        settings.CSV_ROW_INDEX_STRIDE = 3
+        lines = ['id,ts,label'] + [
+            f'{i},2024-01-01T{i // 6:02d}:{i % 6 * 10:02d},{"" if i % 7 == 0 else f"label {i}"}' for i in range(40)
+        ]
+        upload = SimpleUploadedFile("events.csv", ('\n'.join(lines) + '\n').encode('utf-8'))
+        db_file = processor.save_uploaded_file(upload, "events.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        return db_file
+
+    def test_range_reads_only_overlapping_blocks(self, client, clustered):
+        response = client.get(f'/api/files/{clustered.id}/range/', {
+            'column': 'ts', 'from': '2024-01-01T02:00', 'to': '2024-01-01T02:59'
+        })
+        body = response.json()
+        expected = pd.read_csv(clustered.file_path)
+        expected = expected[(expected.ts >= '2024-01-01T02:00') & (expected.ts <= '2024-01-01T02:59')]
+
+        assert response.status_code == 200
+        assert body['row_numbers'] == expected.index.tolist() == list(range(12, 18))
+        assert [row['id'] for row in body['data']] == expected.id.tolist()
+        assert body['blocks_total'] == 10
+        assert body['blocks_scanned'] == 2
+
+        numeric = client.get(f'/api/files/{clustered.id}/range/', {'column': 'id', 'from': '37', 'limit': 2}).json()
+        assert numeric['row_numbers'] == [37, 38]
+        assert numeric['truncated'] is True
+        assert client.get(f'/api/files/{clustered.id}/range/', {'column': 'id', 'from': 'x'}).status_code == 400
+
+    def test_limit_reached_on_a_chunk_boundary(self, processor, clustered):
+        processor.fixed_chunk_size = 2
+
+        more = processor.find_in_range(clustered.file_path, clustered.columns, 'id', low=30, limit=4)
+        last = processor.find_in_range(clustered.file_path, clustered.columns, 'id', low=36, limit=4)
+
+        assert more['rows'].index.tolist() == more['rows'].id.tolist() == [30, 31, 32, 33]
+        assert more['truncated'] is True
+        assert last['rows'].index.tolist() == [36, 37, 38, 39]
+        assert last['truncated'] is False
+
+    def test_missing_row_index_is_a_conflict(self, client, clustered):
+        from .row_index import ROW_INDEX_ARTIFACT
+        from .artifacts import artifact_path
+
+        os.remove(artifact_path(clustered.file_path, ROW_INDEX_ARTIFACT))
+        response = client.get(f'/api/files/{clustered.id}/range/', {'column': 'id', 'from': '3'})
+
+        assert response.status_code == 409
+
+    def test_append_extends_zone_map(self, processor, clustered):
+        from .zone_map import load_zone_map
+
+        batch = b"id,ts,label\n40,2024-01-02T00:00,late\n41,2024-01-02T00:10,late\n"
+        processor.append_to_file(str(clustered.id), SimpleUploadedFile("batch.csv", batch))
+        result = processor.find_in_range(
+            clustered.file_path, clustered.columns, 'ts', low='2024-01-02T00:00', high=None
+        )
+
+        assert len(load_zone_map(clustered.file_path)) == 11
+        assert result['rows'].index.tolist() == [40, 41]
+        assert result['blocks_scanned'] == 1
+
+
+@pytest.mark.django_db(transaction=True)
+class TestKeyIndex:
+
+    @pytest.fixture
+    def orders(self, processor, settings):
+        settings.CSV_ROW_INDEX_STRIDE = 3
+        settings.CSV_KEY_INDEX_RUN_ROWS = 7
+        keys = ['007', '7', 'A-1', '', 'NA', 'B-2']
+        lines = ['key,amount'] + [f'{keys[i % len(keys)] if i % 5 else f"u{i}"},{i}' for i in range(40)]
+        upload = SimpleUploadedFile("orders.csv", ('\n'.join(lines) + '\n').encode('utf-8'))
+        db_file = processor.save_uploaded_file(upload, "orders.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        return db_file
+
+    def test_lookup_matches_raw_text(self, client, processor, orders):
+        from .key_index import load_key_index
+
+        assert processor.build_key_index(orders.file_path, 'key') == 40
+        index = load_key_index(orders.file_path, 'key')
+        expected = pd.read_csv(orders.file_path, dtype=str, keep_default_na=False)
+
+        assert len(index) == 40
+        assert (index.entries[0][1:] >= index.entries[0][:-1]).all()
+        for value in ['007', '7', 'NA', '', 'u15', 'missing']:
+            body = client.get(f'/api/files/{orders.id}/lookup/', {'column': 'key', 'value': value}).json()
+            assert body['row_numbers'] == expected.index[expected.key == value].tolist()
+        assert [row['amount'] for row in client.get(
+            f'/api/files/{orders.id}/lookup/', {'column': 'key', 'value': '007'}
+        ).json()['data']] == [6, 12, 18, 24, 36]
+
+        limited = client.get(f'/api/files/{orders.id}/lookup/', {'column': 'key', 'value': 'A-1', 'limit': 2}).json()
+        assert limited['row_numbers'] == [2, 8]
+        assert limited['truncated'] is True
+
+    def test_heavy_key_is_merged_from_sorted_runs(self, tmp_path):
+        from .key_index import KeyIndexBuilder, key_hashes, merge_runs
+
+        values = ['hot'] * 50 + [f'k{i % 9}' for i in range(23)] + ['hot'] * 20
+        builder = KeyIndexBuilder('key', str(tmp_path / 'spill'), run_rows=6)
+        for start in range(0, len(values), 4):
+            builder.update(pd.DataFrame({'key': values[start:start + 4]}))
+        path = str(tmp_path / 'index.npy')
+        with patch('csv_processor.key_index.merge_runs', wraps=merge_runs) as merge:
+            builder.write(path)
+        entries = np.load(path)
+        hot = key_hashes(['hot'])[0]
+
+        assert merge.call_count == 1 and len(merge.call_args.args[0]) == 12
+        assert (entries[0][1:] >= entries[0][:-1]).all()
+        assert entries[1][entries[0] == hot].tolist() == list(range(50)) + list(range(73, 93))
+        assert sorted(entries[1].tolist()) == list(range(len(values)))
+        assert not os.path.exists(tmp_path / 'spill')
+
+    def test_append_extends_index(self, client, processor, orders):
+        from .key_index import index_name, load_key_index
+
+        processor.build_key_index(orders.file_path, 'key')
+        # Shared with a second record, so the append works on a private copy
+        twin = UploadedFile.objects.get(id=orders.id)
+        twin.pk = None
+        twin.save()
+        batch = ['key,amount'] + [f'{"007" if i % 2 else "new"},{i}' for i in range(40, 55)]
+        with patch.object(processor, 'build_key_index') as rebuild:
+            processor.append_to_file(str(orders.id), SimpleUploadedFile("batch.csv", ('\n'.join(batch) + '\n').encode('utf-8')))
+        orders.refresh_from_db()
+        index = load_key_index(orders.file_path, 'key')
+        expected = pd.read_csv(orders.file_path, dtype=str, keep_default_na=False)
+
+        assert not rebuild.called and orders.file_path != twin.file_path
+        assert len(index) == 55 and len(load_key_index(twin.file_path, 'key')) == 40
+        assert (index.entries[0][1:] >= index.entries[0][:-1]).all()
+        for value in ['007', 'new', 'B-2']:
+            body = client.get(f'/api/files/{orders.id}/lookup/', {'column': 'key', 'value': value}).json()
+            assert body['row_numbers'] == expected.index[expected.key == value].tolist()
+        prefix = f"{os.path.basename(orders.file_path)}.{index_name('key')}"
+        assert [name for name in os.listdir(os.path.dirname(orders.file_path)) if name.startswith(prefix)] == [f"{prefix}.npy"]
+
+    def test_missing_index_is_built_by_task_and_removed_with_file(self, client, orders):
+        from .key_index import key_index_path
+        from .tasks import build_key_index
+
+        states = {}
+
+        def async_result(task_id):
+            return Mock(state=states.get(task_id, 'PENDING'), result=OSError('disk full'), info=None)
+
+        url, params = f'/api/files/{orders.id}/lookup/', {'column': 'key', 'value': 'B-2'}
+        with patch.object(build_key_index, 'AsyncResult', side_effect=async_result), \
+                patch.object(type(build_key_index.backend), 'store_result', side_effect=lambda task_id, result, state: states.update({task_id: state})), \
+                patch.object(type(build_key_index.backend), 'forget', side_effect=lambda task_id: states.pop(task_id)), \
+                patch.object(build_key_index, 'apply_async') as apply_async:
+            response = client.get(url, params)
+            assert client.get(url, params).status_code == 202
+            states[response.json()['task_id']] = 'FAILURE'
+            failed = client.get(url, params)
+            assert states == {} and client.get(url, params).status_code == 202
+            states.clear()
+        assert response.status_code == 202
+        assert apply_async.call_count == 2
+        assert apply_async.call_args.kwargs['task_id'] == response.json()['task_id']
+        assert failed.status_code == 500 and failed.json()['error'] == 'disk full'
+
+        with patch.object(build_key_index, 'update_state'):
+            assert build_key_index.run(str(orders.id), 'key') == {'column': 'key', 'rows': 40}
+        body = client.get(f'/api/files/{orders.id}/lookup/', {'column': 'key', 'value': 'B-2'}).json()
+        assert body['row_numbers'] == [11, 17, 23, 29]
+
+        path = key_index_path(orders.file_path, 'key')
+        assert os.path.exists(path)
+        UploadedFile.objects.get(id=orders.id).delete()
+        assert not os.path.exists(path)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestFileDiff:
+
+    @pytest.fixture
+    def versions(self, processor, settings):
+        settings.CSV_DISTRIBUTED_RANGE_BYTES = 64
+        settings.CSV_DIFF_PARTITION_BYTES = 100
+        old = ['id,name,amount'] + [f'{i},name {i},{i * 10}' for i in range(20)] + ['7,name 7,70']
+        new = (['id,name,amount'] + [f'{i},name {i},{i * 10}' for i in range(20) if i not in (3, 4)]
+               + ['7,name 7,70', '7,name 7,70', '20,name 20,200'])
+        new[new.index('5,name 5,50')] = '5,name 5,55'
+        records = []
+        for name, lines in (('old.csv', old), ('new.csv', new)):
+            upload = SimpleUploadedFile(name, ('\n'.join(lines) + '\n').encode('utf-8'))
+            db_file = processor.save_uploaded_file(upload, name)
+            processor.process_file_async(str(db_file.id))
+            db_file.refresh_from_db()
+            records.append(db_file)
+        return records
+
+    @staticmethod
+    def run_diff(processor, old, new, key_columns):
+        from . import diffing
+
+        plan = diffing.plan_diff(old, new, key_columns)
+        assert diffing.claim_plan(plan)
+        assert not diffing.claim_plan(plan)
+        assert len(plan['ranges']['a']) > 1 and plan['partitions'] > 4
+        for side in ('a', 'b'):
+            for range_index, (start, end) in enumerate(plan['ranges'][side]):
+                processor.partition_for_diff(plan, side, range_index, start, end)
+        counts = [diffing.diff_partition(plan, partition) for partition in range(plan['partitions'])]
+        return diffing.finish_diff(plan, counts)
+
+    def test_keyed_and_multiset_diff(self, processor, versions):
+        from . import diffing
+
+        old, new = versions
+        keyed = self.run_diff(processor, old, new, ['id'])
+        changes = pd.read_csv(diffing.result_paths(old.file_path, keyed['key'])['data'], dtype=str)
+
+        assert (keyed['added'], keyed['removed'], keyed['modified']) == (2, 2, 1)
+        assert sorted(changes[changes.change == 'removed'].id) == ['3', '4']
+        assert sorted(changes[changes.change == 'added'].id) == ['20', '7']
+        modified = changes[changes.change == 'modified'].iloc[0]
+        assert (modified.id, modified.amount, modified.changed_columns) == ('5', '55', 'amount')
+
+        rows = self.run_diff(processor, old, new, [])
+        changes = pd.read_csv(diffing.result_paths(old.file_path, rows['key'])['data'], dtype=str)
+        assert (rows['added'], rows['removed'], rows['modified']) == (3, 3, 0)
+        assert sorted(changes[changes.change == 'added'].amount) == ['200', '55', '70']
+
+    def test_multiline_fields_are_not_split(self, processor, settings):
+        settings.CSV_DISTRIBUTED_RANGE_BYTES = 64
+        settings.CSV_DIFF_PARTITION_BYTES = 100
+        records = []
+        for name, changed in (('old.csv', 'kept'), ('new.csv', 'changed')):
+            lines = ['id,note'] + [f'{i},"line one\nline two {changed if i == 9 else i}\nline three"' for i in range(30)]
+            db_file = processor.save_uploaded_file(SimpleUploadedFile(name, ('\n'.join(lines) + '\n').encode('utf-8')), name)
+            processor.process_file_async(str(db_file.id))
+            db_file.refresh_from_db()
+            records.append(db_file)
+
+        result = self.run_diff(processor, *records, ['id'])
+
+        assert (result['added'], result['removed'], result['modified']) == (0, 0, 1)
+
+    def test_endpoint_starts_job_then_pages_results(self, client, processor, versions):
+        from .tasks import diff_csv
+
+        old, new = versions
+        url = f'/api/files/{old.id}/diff/{new.id}/'
+        assert client.get(url, {'key': 'missing'}).status_code == 400
+        with patch.object(diff_csv, 'apply_async') as apply_async:
+            response = client.get(url, {'key': 'id'})
+        assert response.status_code == 202
+        assert apply_async.call_args.kwargs['args'] == [str(old.id), str(new.id), ['id']]
+
+        self.run_diff(processor, old, new, ['id'])
+        first = client.get(url, {'key': 'id', 'page_size': 3}).json()
+        second = client.get(url, {'key': 'id', 'page_size': 3, 'page': 2}).json()
+
+        assert first['status'] == 'completed'
+        assert first['total_changes'] == 5 and first['total_pages'] == 2
+        assert len(first['data']) == 3 and len(second['data']) == 2
+        assert sorted(row['change'] for row in first['data'] + second['data']) == [
+            'added', 'added', 'modified', 'removed', 'removed'
+        ]
+
+
+@pytest.mark.django_db
+class TestChunkSizing:
+
+    @pytest.fixture(autouse=True)
+    def small_budget(self, settings):
+        settings.CSV_CHUNK_MEMORY_BUDGET = 64 * 1024
+        settings.CSV_CHUNK_MIN_ROWS = 2
+        settings.CSV_CHUNK_MAX_ROWS = 5000
+
+    def test_rows_follow_row_width_and_memory_pressure(self):
+        from .chunking import ChunkSizer
+
+        wide = pd.DataFrame({f'c{i}': [f'value {i}'] * 10 for i in range(200)})
+        narrow = pd.DataFrame({'id': range(10)})
+        sizer = ChunkSizer()
+        sizer.observe(wide)
+        wide_rows = sizer.next_rows()
+        sizer.observe(narrow)
+
+        assert 2 <= wide_rows < 10
+        assert sizer.next_rows() == 5000
+        with patch('csv_processor.chunking.available_memory', return_value=64 * 1024):
+            assert sizer.next_rows() == int(16 * 1024 / sizer.bytes_per_row) < 5000
+        assert ChunkSizer(fixed_rows=7).next_rows() == 7
+
+    def test_adaptive_chunks_keep_row_numbers(self, settings):
+        settings.CSV_ZONE_MAP_BLOCK_ROWS = 50
+        lines = ['id,payload'] + [f'{i},{"x" * 2000}' for i in range(300)]
+        upload = SimpleUploadedFile("wide.csv", ('\n'.join(lines) + '\n').encode('utf-8'))
+        processor = LargeCSVProcessor()
+        db_file = processor.save_uploaded_file(upload, "wide.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+
+        chunks = list(processor.stream_csv_chunks(db_file.file_path))
+        result = processor.find_in_range(db_file.file_path, db_file.columns, 'id', low=140, high=260, limit=1000)
+
+        assert db_file.total_rows == 300
+        assert len(chunks) > 3 and sum(len(chunk) for chunk in chunks) == 300
+        assert result['rows'].index.tolist() == result['rows'].id.tolist() == list(range(140, 261))
+
+
+@pytest.mark.django_db(transaction=True)
+class TestReadableWatermark:
+
+    @pytest.fixture
+    def processing_file(self, tmp_path):
+        path = tmp_path / 'growing.csv'
+        path.write_text('id,name\n' + ''.join(f'{i},n{i}\n' for i in range(100)))
+        return UploadedFile.objects.create(
+            filename='growing.csv', file_path=str(path), file_size=os.path.getsize(path),
+            status='processing', columns=['id', 'name'], readable_rows=30, readable_bytes=200
+        )
+
+    def test_pages_below_watermark_served_while_processing(self, client, processing_file):
+        url = f'/api/files/{processing_file.id}/data/'
+
+        first = client.get(url, {'page': 1, 'page_size': 20}).json()
+        second = client.get(url, {'page': 2, 'page_size': 20}).json()
+        beyond = client.get(url, {'page': 3, 'page_size': 20}).json()
+        status_response = client.get(f'/api/files/{processing_file.id}/').json()
+
+        assert [row['id'] for row in first['data']] == list(range(20))
+        assert first['total_rows'] == 30 and first['total_rows_is_lower_bound'] and first['has_next']
+        assert [row['id'] for row in second['data']] == list(range(20, 30)) and not second['has_next']
+        assert beyond['data'] == []
+        assert status_response['readable_rows'] == 30 and status_response['total_rows_is_lower_bound']
+        assert client.get(url, {'format': 'raw'}).status_code == 400
+
+        processing_file.readable_rows = None
+        processing_file.save()
+        assert client.get(url).status_code == 400
+
+    def test_ingest_publishes_watermark_until_complete(self, processor):
+        from . import ingest_control
+
+        upload = SimpleUploadedFile("marks.csv", ('a,b\n' + ''.join(f'{i},{i}\n' for i in range(50))).encode('utf-8'))
+        db_file = processor.save_uploaded_file(upload, "marks.csv")
+        published = []
+
+        class RecordingWatermark(ingest_control.ReadableWatermark):
+            def __call__(self, rows, bytes_scanned=None):
+                super().__call__(rows, bytes_scanned)
+                published.append(
+                    UploadedFile.objects.values_list('status', 'readable_rows', 'readable_bytes').get(id=db_file.id)
+                )
+
+        with patch('csv_processor.file_processor.ReadableWatermark', RecordingWatermark):
+            processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+
+        assert published == [('processing', 50, db_file.file_size)]
+        assert db_file.status == 'completed' and db_file.readable_rows == db_file.total_rows == 50
+        # Only moves forward, and only while processing
+        assert not ingest_control.publish_watermark(db_file.id, 60, db_file.file_size)
+        UploadedFile.objects.filter(id=db_file.id).update(status='processing')
+        assert not ingest_control.publish_watermark(db_file.id, 10, 20)
+        assert ingest_control.publish_watermark(db_file.id, 60, db_file.file_size)
+
+    def test_distributed_watermark_covers_finished_prefix(self, settings, processor):
+        settings.CSV_DISTRIBUTED_RANGE_BYTES = 40
+        upload = SimpleUploadedFile("prefix.csv", ('id,v\n' + ''.join(f'{i},{i * 2}\n' for i in range(30))).encode('utf-8'))
+        db_file = processor.save_uploaded_file(upload, "prefix.csv")
+        ranges = processor.prepare_distributed_ingest(str(db_file.id))
+        assert len(ranges) > 2
+
+        later = [processor.analyze_byte_range(str(db_file.id), i, *ranges[i], len(ranges)) for i in (2, 1)]
+        db_file.refresh_from_db()
+        assert db_file.readable_rows is None
+
+        first = processor.analyze_byte_range(str(db_file.id), 0, *ranges[0], len(ranges))
+        db_file.refresh_from_db()
+        assert db_file.readable_rows == first['rows'] + sum(result['rows'] for result in later)
+        assert db_file.readable_bytes == ranges[2][1]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestStorageManager:
+
+    @pytest.fixture
+    def uploads(self, tmp_path, settings):
+        directory = tmp_path / 'uploads'
+        directory.mkdir()
+        settings.CSV_STORAGE_DIRS = [str(directory)]
+        settings.CSV_STORAGE_MIN_IDLE_SECONDS = 0
+        return directory
+
+    def stored(self, directory, name, size=100, **fields):
+        path = directory / name
+        path.write_bytes(b'a\n' + b'1\n' * (size // 2))
+        return UploadedFile.objects.create(
+            filename=name, file_path=str(path), file_size=os.path.getsize(path), status='completed', **fields
+        )
+
+    def test_large_deletes_go_through_trash(self, uploads, settings):
+        from .storage import TRASH_DIR
+        from .tasks import purge_deleted_files
+
+        settings.CSV_STORAGE_DEFERRED_DELETE_BYTES = 1000
+        large = self.stored(uploads, 'large.csv', size=5000)
+        (uploads / 'large.csv.rowidx.npy').write_bytes(b'index')
+        small = self.stored(uploads, 'small.csv')
+
+        large.delete()
+        small.delete()
+        trashed = list((uploads / TRASH_DIR).iterdir())
+
+        assert sorted(os.listdir(uploads)) == [TRASH_DIR]
+        assert len(trashed) == 1 and sorted(os.listdir(trashed[0])) == ['large.csv', 'large.csv.rowidx.npy']
+        assert purge_deleted_files.run()['bytes_freed'] > 5000
+        assert os.listdir(uploads / TRASH_DIR) == []
+
+    def test_reconcile_removes_old_orphans_and_fails_missing_files(self, uploads):
+        from .tasks import reconcile_storage
+
+        kept = self.stored(uploads, 'kept.csv')
+        (uploads / 'kept.csv.keyidx-ab.npy').write_bytes(b'index')
+        (uploads / 'abandoned.csv').write_bytes(b'x')
+        (uploads / 'abandoned.csv.rowidx.npy').write_bytes(b'x')
+        (uploads / 'spooled.csv').write_bytes(b'x')
+        old = time.time() - 2 * 24 * 60 * 60
+        for name in ('kept.csv', 'kept.csv.keyidx-ab.npy', 'abandoned.csv', 'abandoned.csv.rowidx.npy'):
+            os.utime(uploads / name, (old, old))
+        gone = UploadedFile.objects.create(
+            filename='gone.csv', file_path=str(uploads / 'gone.csv'), file_size=10, status='completed'
+        )
+
+        result = reconcile_storage.run()
+
+        assert sorted(os.listdir(uploads)) == ['kept.csv', 'kept.csv.keyidx-ab.npy', 'spooled.csv']
+        assert result == {'orphans_removed': 2, 'bytes_freed': 2, 'missing_files': 1}
+        assert UploadedFile.objects.get(id=gone.id).status == 'failed'
+        assert UploadedFile.objects.get(id=kept.id).status == 'completed'
+
+    def test_eviction_follows_last_access(self, uploads, settings, client):
+        from django.utils import timezone
+        from . import storage
+
+        stale = self.stored(uploads, 'stale.csv', last_accessed_at=timezone.now() - timezone.timedelta(days=3))
+        fresh = self.stored(uploads, 'fresh.csv')
+        for name in ('stale.csv.agg-1.csv', 'fresh.csv.agg-1.csv'):
+            (uploads / name).write_bytes(b'x' * 50)
+        client.get(f'/api/files/{fresh.id}/stats/')
+        assert UploadedFile.objects.get(id=fresh.id).last_accessed_at is not None
+
+        assert storage.evict(10) == {'bytes_freed': 50, 'artifacts_evicted': 1, 'files_evicted': 0}
+        assert sorted(os.listdir(uploads)) == ['fresh.csv', 'fresh.csv.agg-1.csv', 'stale.csv']
+
+        assert storage.evict(500)['files_evicted'] == 2
+        assert os.listdir(uploads) == [] and not UploadedFile.objects.exists()
+
+    def test_upload_refused_when_storage_is_short(self, uploads, settings, client):
+        settings.CSV_STORAGE_QUOTA_BYTES = 1000
+        upload = SimpleUploadedFile("big.csv", b'a\n' + b'1\n' * 1000)
+
+        response = client.post('/api/upload-large-csv/', {'file': upload})
+
+        assert response.status_code == 507
+        assert 'Not enough storage' in response.json()['error']
+        assert not UploadedFile.objects.exists()
+
+    def test_upload_check_reuses_recent_directory_walk(self, uploads, settings):
+        from . import storage
+
+        settings.CSV_STORAGE_QUOTA_BYTES = 10 ** 6
+        settings.CSV_STORAGE_USAGE_MAX_AGE = 60
+        storage.check_upload_space(10)
+        with patch('csv_processor.storage.os.scandir') as scandir:
+            storage.check_upload_space(10)
+            settings.CSV_STORAGE_USAGE_MAX_AGE = 0
+            storage.check_upload_space(10)
+
+        assert scandir.call_count == len(settings.CSV_STORAGE_DIRS)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestValidation:
+
+    RULES = {
+        'age': {'type': 'int', 'min': 0, 'max': 150, 'not_null': True},
+        'email': {'regex': '[^@]+@[^@]+'},
+        'state': {'enum': ['open', 'closed']},
+    }
+    CONTENT = (
+        'id,age,email,state\n'
+        '0,30,a@x.org,open\n'
+        '1,-4,b@x.org,closed\n'
+        '2,,nobody,open\n'
+        '3,40,c@x.org,open,extra\n'
+        '4,abc,d@x.org,pending\n'
+        '5,50\n'
+        '6,60,e@x.org,closed\n'
+    )
+
+    def test_malformed_records_do_not_fail_ingest(self, client, processor):
+        upload = SimpleUploadedFile("ragged.csv", self.CONTENT.encode('utf-8'))
+        db_file = processor.save_uploaded_file(upload, "ragged.csv")
+
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        response = client.get(f'/api/files/{db_file.id}/bad-rows/').json()
+
+        assert db_file.status == 'completed' and db_file.total_rows == 7
+        assert db_file.validation['violations'] == {'field_count': 2}
+        assert [(row['row'], row['record']) for row in response['data']] == [(3, '3,40,c@x.org,open,extra'), (5, '5,50')]
+        assert response['data'][0]['violations'] == [{'reason': 'field_count', 'column': None}]
+
+    def test_rows_read_around_malformed_records(self, settings, processor):
+        settings.CSV_ROW_INDEX_STRIDE = 5
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("ragged.csv", self.CONTENT.encode('utf-8')), "ragged.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+
+        rows = processor.read_rows(db_file.file_path, db_file.columns, [2, 3, 4, 5, 6])
+        in_range = processor.find_in_range(db_file.file_path, db_file.columns, 'id', 3, 6)
+
+        assert rows['id'].tolist() == [2, 3, 4, 5, 6]
+        assert rows.loc[3, 'state'] == 'open' and pd.isna(rows.loc[5, 'email'])
+        assert processor.read_rows(db_file.file_path, db_file.columns, [5])['age'].tolist() == [50]
+        assert in_range['rows']['id'].tolist() == [3, 4, 5, 6]
+
+    def test_rules_declared_at_upload(self, client, processor):
+        upload = SimpleUploadedFile("rules.csv", self.CONTENT.encode('utf-8'))
+        assert client.post(
+            '/api/upload-large-csv/', {'file': upload, 'validation_rules': '{"age": {"type": "decimal"}}'}
+        ).status_code == 400
+
+        upload = SimpleUploadedFile("rules.csv", self.CONTENT.encode('utf-8'))
+        with patch('csv_processor.views.queue_ingest'):
+            file_id = client.post(
+                '/api/upload-large-csv/', {'file': upload, 'validation_rules': json.dumps(self.RULES)}
+            ).json()['file_id']
+        processor.process_file_async(file_id)
+        db_file = UploadedFile.objects.get(id=file_id)
+        url = f'/api/files/{file_id}/bad-rows/'
+
+        assert db_file.status == 'completed'
+        assert db_file.validation['columns'] == {
+            'age': {'range': 1, 'not_null': 1, 'type': 1}, 'email': {'regex': 1}, 'state': {'enum': 1},
+        }
+        assert [row['row'] for row in client.get(url).json()['data']] == [1, 2, 3, 4, 5]
+        assert [row['row'] for row in client.get(url, {'column': 'age'}).json()['data']] == [1, 2, 4]
+        by_reason = client.get(url, {'reason': 'enum', 'page_size': 1}).json()
+        assert by_reason['total_rows'] == 1 and by_reason['data'][0]['record'] == '4,abc,d@x.org,pending'
+        assert {violation['reason'] for violation in by_reason['data'][0]['violations']} == {'type', 'enum'}
+        assert client.get(url, {'reason': 'spelling'}).status_code == 400
+
+    def test_distributed_ingest_matches_single_pass(self, settings, processor):
+        from . import validation
+
+        settings.CSV_DISTRIBUTED_RANGE_BYTES = 30
+        content = self.CONTENT + ''.join(f'{i},{i * 7 % 200},u{i}@x.org,open\n' for i in range(7, 40))
+        single = processor.save_uploaded_file(SimpleUploadedFile("a.csv", content.encode('utf-8')), "a.csv")
+        split = processor.save_uploaded_file(SimpleUploadedFile("b.csv", content.encode('utf-8')), "b.csv")
+        UploadedFile.objects.filter(id__in=[single.id, split.id]).update(validation_rules=self.RULES)
+
+        processor.process_file_async(str(single.id))
+        ranges = processor.prepare_distributed_ingest(str(split.id))
+        assert len(ranges) > 2
+        results = [
+            processor.analyze_byte_range(str(split.id), i, start, end, len(ranges))
+            for i, (start, end) in enumerate(ranges)
+        ]
+        processor.merge_range_results(str(split.id), results)
+        single.refresh_from_db()
+        split.refresh_from_db()
+
+        assert split.status == 'completed' and split.total_rows == single.total_rows == 40
+        assert split.validation == single.validation
+        assert split.validation['columns']['age']['range'] == 1 + sum(1 for i in range(7, 40) if i * 7 % 200 > 150)
+        assert np.array_equal(
+            validation.load_bad_rows(split.file_path, self.RULES), validation.load_bad_rows(single.file_path, self.RULES)
+        )
+
+
+@pytest.mark.django_db(transaction=True)
+class TestComputedColumns:
+
+    @pytest.fixture
+    def orders(self, processor):
+        content = 'id,price,cost,first,last,created\n' + ''.join(
+            f'{i},{10 + i},{i},n{i},s{i},2024-0{1 + i % 3}-1{i % 10}\n' for i in range(60)
+        )
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("orders.csv", content.encode('utf-8')), "orders.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        return db_file
+
+    def test_expressions_are_restricted_and_vectorized(self):
+        from .expressions import ExpressionError, parse
+
+        frame = pd.DataFrame({'a': [4, 9, None], 'b': [2, 0, 1], 'name': ['x', None, 'z'], 'when': ['2024-03-01', 'bad', None]})
+
+        assert parse('a / b').evaluate(frame).tolist()[:2] == [2.0, float('inf')]
+        assert parse('concat(name, "-", b)').evaluate(frame).tolist() == ['x-2', '-0', 'z-1']
+        assert parse('year(col("when"))').evaluate(frame).tolist()[0] == 2024
+        assert parse('where(a > 5 and not isnull(name), "big", "small")').evaluate(frame).tolist() == ['small', 'small', 'small']
+        assert parse('1 < b <= 2').mask(frame).tolist() == [True, False, False]
+        assert parse('concat(name, "-", b)').columns == ['name', 'b']
+        # Text is never repeated, it is converted to numbers
+        assert parse('name * 100000').evaluate(frame).isna().all()
+        # Powers are computed in floats, constant towers overflow at once
+        assert parse('a > 9 ** 9 ** 9').mask(frame).tolist() == [False, False, False]
+        assert parse('b ** -1').evaluate(frame).tolist() == [0.5, float('inf'), 1.0]
+        for unsafe in ('__import__("os").system("true")', 'a.real', 'lambda: 1', '[a]', 'a[0]', '"x" * 100000', 'open("x")'):
+            with pytest.raises(ExpressionError):
+                parse(unsafe).evaluate(frame)
+
+    def test_computed_columns_evaluated_per_page(self, client, orders):
+        from . import expressions
+
+        url = f'/api/files/{orders.id}/computed-columns/'
+        created = client.post(url, {'name': 'margin', 'expression': '(price - cost) / price'}, content_type='application/json')
+        client.post(url, {'name': 'label', 'expression': 'concat(first, " ", last)'}, content_type='application/json')
+        chained = client.post(url, {'name': 'big', 'expression': 'margin > 0.5'}, content_type='application/json')
+        assert created.status_code == 201 and created.json()['preview'][:2] == [1.0, 10 / 11]
+        assert chained.status_code == 201
+        assert client.post(url, {'name': 'bad', 'expression': 'year(price) + nope'}, content_type='application/json').status_code == 400
+        assert client.post(url, {'name': 'price', 'expression': '1'}, content_type='application/json').status_code == 400
+
+        evaluated = []
+        evaluate = expressions.Expression.evaluate
+
+        def recording(self, frame):
+            evaluated.append(len(frame))
+            return evaluate(self, frame)
+
+        with patch.object(expressions.Expression, 'evaluate', recording):
+            page = client.get(f'/api/files/{orders.id}/data/', {'page': 2, 'page_size': 10, 'columns': 'id,label,big'}).json()
+
+        assert page['columns'] == ['id', 'label', 'big']
+        assert page['data'][0] == {'id': 10, 'label': 'n10 s10', 'big': False}
+        assert evaluated == [10, 10, 10]  # margin, label, big on the page rows only
+        assert client.delete(f'{url}margin/').status_code == 400
+        assert client.delete(f'{url}big/').json()['computed_columns'] == [
+            {'name': 'margin', 'expression': '(price - cost) / price'}, {'name': 'label', 'expression': 'concat(first, " ", last)'},
+        ]
+
+    def test_filter_pages_through_matches(self, client, settings, orders):
+        settings.CSV_CHUNK_INITIAL_ROWS = settings.CSV_CHUNK_MIN_ROWS = settings.CSV_CHUNK_MAX_ROWS = 7
+        client.post(
+            f'/api/files/{orders.id}/computed-columns/', {'name': 'margin', 'expression': '(price - cost) / price'},
+            content_type='application/json'
+        )
+        url = f'/api/files/{orders.id}/data/'
+        where = 'margin < 0.5 and month(created) == 1'
+        expected = [i for i in range(60) if 10 / (10 + i) < 0.5 and i % 3 == 0]
+
+        first = client.get(url, {'where': where, 'page_size': 4, 'columns': 'id,margin'}).json()
+        last = client.get(url, {'where': where, 'page_size': 4, 'page': 4}).json()
+
+        assert [row['id'] for row in first['data']] == expected[:4] and first['row_numbers'] == expected[:4]
+        assert first['has_next'] and first['total_rows_is_lower_bound'] and first['scanned_rows'] < 60
+        assert [row['id'] for row in last['data']] == expected[12:16] and not last['has_next']
+        assert last['total_rows'] == len(expected)
+        assert client.get(url, {'where': 'os.system("x")'}).status_code == 400
+        assert client.get(url, {'where': 'missing > 1'}).status_code == 400
+        assert client.get(url, {'where': 'id > 1', 'format': 'raw'}).status_code == 400
+
+
+@pytest.mark.django_db(transaction=True)
+class TestFileCache:
+
+    @pytest.fixture
+    def completed_file(self, processor):
+        content = 'id,name,score\n' + ''.join(f'{i},n{i},{i * 0.5}\n' for i in range(50))
+        db_file = processor.save_uploaded_file(SimpleUploadedFile("hot.csv", content.encode('utf-8')), "hot.csv")
+        processor.process_file_async(str(db_file.id))
+        db_file.refresh_from_db()
+        return db_file
+
+    def test_completed_records_served_from_cache(self, client, settings, django_assert_num_queries, completed_file):
+        from . import file_cache
+
+        settings.CSV_REDIS_URL = None
+        url = f'/api/files/{completed_file.id}/data/'
+        client.get(url, {'page_size': 5})
+
+        with django_assert_num_queries(0):
+            cached = client.get(url, {'page': 2, 'page_size': 5}).json()
+        assert [row['id'] for row in cached['data']] == [5, 6, 7, 8, 9]
+
+        # Saves and deletes drop the cached record
+        client.post(
+            f'/api/files/{completed_file.id}/computed-columns/', {'name': 'double', 'expression': 'score * 2'},
+            content_type='application/json'
+        )
+        assert client.get(url, {'page_size': 2}).json()['columns'][-1] == 'double'
+        UploadedFile.objects.get(id=completed_file.id).delete()
+        assert file_cache.METADATA.get(str(completed_file.id)) is None
+        assert client.get(url).status_code == 404
+
+    def test_pages_sliced_from_pooled_mapping(self, settings, processor, completed_file):
+        from . import file_cache
+
+        settings.CSV_FILE_HANDLE_POOL_SIZE = 1
+        path = completed_file.file_path
+        expected = pd.read_csv(path)
+        for offset, limit, columns in ((0, 7, None), (13, 20, None), (45, 10, ['id', 'score']), (50, 5, None)):
+            page = processor.get_data_chunk(path, offset, limit, columns)
+            reference = expected.iloc[offset:offset + limit][columns or expected.columns].reset_index(drop=True)
+            pd.testing.assert_frame_equal(page, reference, check_dtype=False, check_index_type=False)
+        handles = file_cache.HANDLES.get(path)
+        assert handles is not None and file_cache.HANDLES.get(path) is handles
+
+        # A new version of the file gets a new mapping; the pool stays bounded
+        processor.append_to_file(str(completed_file.id), SimpleUploadedFile("more.csv", b'id,name,score\n50,n50,25.0\n'))
+        assert processor.get_data_chunk(path, 50, 5)['id'].tolist() == [50]
+        assert file_cache.HANDLES.get(path) is not handles
+        other = processor.save_uploaded_file(SimpleUploadedFile("other.csv", b'a\n1\n'), "other.csv")
+        processor.process_file_async(str(other.id))
+        assert file_cache.HANDLES.get(other.file_path) is not None and len(file_cache.HANDLES) == 1
+
+    def test_pooled_page_of_short_records(self, processor):
+        db_file = processor.save_uploaded_file(
+            SimpleUploadedFile("ragged.csv", b'a,b,c\n1,2,3\n4,5,6\n7,8,9,10,11\n12,13\n'), "ragged.csv"
+        )
+        processor.process_file_async(str(db_file.id))
+
+        page = processor.get_data_chunk(db_file.file_path, 3, 5)
+        wide = processor.get_data_chunk(db_file.file_path, 2, 1)
+
+        assert page.columns.tolist() == ['a', 'b', 'c']
+        assert page[['a', 'b']].values.tolist() == [[12, 13]] and page['c'].isna().all()
+        assert wide.values.tolist() == [[7, 8, 9]]
+
+    def test_invalidations_published_to_other_processes(self, settings, completed_file):
+        from . import file_cache
+
+        published = []
+        redis_client = Mock(publish=lambda channel, message: published.append((channel, json.loads(message))))
+        file_cache.METADATA.put(str(completed_file.id), completed_file, file_cache.METADATA.generation)
+
+        with patch.object(file_cache, 'get_redis', return_value=redis_client):
+            db_file = UploadedFile.objects.get(id=completed_file.id)
+            db_file.last_accessed_at = None
+            db_file.save(update_fields=['last_accessed_at'])
+            assert published == []
+            db_file.status = 'failed'
+            db_file.save()
+
+        assert published == [(settings.CSV_FILE_CACHE_CHANNEL, {'id': str(db_file.id), 'path': db_file.file_path})]
+        assert file_cache.METADATA.get(str(db_file.id)) is None
+
+        # A message from another process
+        file_cache.METADATA.put(str(db_file.id), db_file, file_cache.METADATA.generation)
+        file_cache.handle_message({'data': json.dumps(published[0][1]).encode('utf-8')})
+        assert file_cache.METADATA.get(str(db_file.id)) is None
+
+        # Not subscribed: nothing is cached
+        with patch.object(file_cache, '_listener', Mock(subscribed=threading.Event())):
+            file_cache.get_file(db_file.id)
+            assert not file_cache.cache_enabled() and file_cache.METADATA.get(str(db_file.id)) is None
@@ -0,0 +1,144 @@
+import base64
+import binascii
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from .metrics import UPLOAD_FINALIZE
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Uploads above FILE_UPLOAD_MAX_MEMORY_SIZE are spooled by Django to a
+# temporary file. Finalizing moves that file into place instead of copying
+# it again: a rename on the same filesystem, otherwise an in-kernel copy
+# (copy_file_range, or sendfile through shutil). The content hash is
+# computed by the upload handler while the request body streams in. Under
+# ASGI the body only streams in for the routes the handler does not spool
+# first (handlers.STREAMED_BODY_ROUTES); elsewhere it is written twice.
+
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+BASE64_BLOCK_SIZE = 4 * 1024 * 1024  # characters, a multiple of 4
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """
+    TemporaryFileUploadHandler that also computes the BLAKE2b content hash
+    of the spooled file, exposed as ``content_hash`` on the uploaded file.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.content_hash = hashlib.blake2b(digest_size=32)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.content_hash.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        uploaded_file.content_hash = self.content_hash.hexdigest()
+        return uploaded_file
+
+
+def _copy_in_kernel(source_path: str, destination_path: str) -> str:
+    """
+    Copy a file without passing its bytes through userspace.
+
+    Returns:
+        The method used, 'copy_file_range' or 'sendfile'
+    """
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        remaining = os.fstat(source.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(source.fileno(), destination.fileno(), min(remaining, COPY_BLOCK_SIZE))
+                if copied == 0:
+                    break
+                remaining -= copied
+            if remaining == 0:
+                return 'copy_file_range'
+        except (AttributeError, OSError) as e:
+            # Older kernels refuse cross-filesystem copy_file_range
+            logger.info(f"copy_file_range unavailable for {destination_path}: {e}")
+    # shutil uses sendfile on Linux
+    shutil.copyfile(source_path, destination_path)
+    return 'sendfile'
+
+
+def move_file(source_path: str, destination_path: str) -> str:
+    """
+    Move a file into place: rename when both paths share a filesystem,
+    otherwise copy in the kernel and remove the source.
+
+    Returns:
+        The method used ('rename', 'copy_file_range' or 'sendfile')
+    """
+    try:
+        os.rename(source_path, destination_path)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    method = _copy_in_kernel(source_path, destination_path)
+    os.remove(source_path)
+    return method
+
+
+def finalize_upload(uploaded_file, destination_path: str) -> str:
+    """
+    Store an uploaded file at ``destination_path``.
+
+    Spooled uploads are moved (see move_file), so their bytes are not
+    copied again; in-memory uploads are written out.
+
+    Returns:
+        BLAKE2b hex digest of the content
+    """
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        uploaded_file.file.flush()
+        method = move_file(uploaded_file.temporary_file_path(), destination_path)
+        os.chmod(destination_path, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+        content_hash = getattr(uploaded_file, 'content_hash', None)
+        if content_hash is None:
+            # Spooled by a handler that does not hash, read it back once
+            content_hash = hashlib.blake2b(digest_size=32)
+            with open(destination_path, 'rb') as stored:
+                for block in iter(lambda: stored.read(COPY_BLOCK_SIZE), b''):
+                    content_hash.update(block)
+            content_hash = content_hash.hexdigest()
+    else:
+        method = 'write'
+        content_hash = hashlib.blake2b(digest_size=32)
+        with open(destination_path, 'wb+') as destination:
+            for chunk in uploaded_file.chunks():
+                content_hash.update(chunk)
+                destination.write(chunk)
+        content_hash = content_hash.hexdigest()
+
+    UPLOAD_FINALIZE.labels(method=method).inc()
+    logger.info(f"Finalized upload at {destination_path} by {method}")
+    return content_hash
+
+
+def spool_base64(payload: str, spool_dir: str) -> str:
+    """
+    Decode base64 ``payload`` block by block into a new file in
+    ``spool_dir``, without holding a second, decoded copy in memory.
+
+    Returns:
+        Path of the spool file
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    spool_path = os.path.join(spool_dir, f"{uuid.uuid4()}.csv")
+    try:
+        with open(spool_path, 'wb') as spool:
+            for start in range(0, len(payload), BASE64_BLOCK_SIZE):
+                spool.write(base64.b64decode(payload[start:start + BASE64_BLOCK_SIZE], validate=True))
+    except (binascii.Error, ValueError):
+        os.remove(spool_path)
+        raise
+    return spool_path
@@ -9,6 +9,28 @@ urlpatterns = [
     path('files/<uuid:file_id>/data/', views.get_file_data, name='get_file_data'),
     path('files/<uuid:file_id>/stats/', views.get_file_stats, name='get_file_stats'),
     path('files/<uuid:file_id>/delete/', views.delete_file, name='delete_file'),
+    path('files/<uuid:file_id>/retry/', views.retry_file_ingest, name='retry_file_ingest'),
+    path('files/<uuid:file_id>/append/', views.append_to_file, name='append_to_file'),
+    path('files/<uuid:file_id>/aggregate/', views.aggregate_file, name='aggregate_file'),
+    path('files/<uuid:file_id>/sample/', views.sample_file, name='sample_file'),
+    path('files/<uuid:file_id>/range/', views.range_lookup, name='range_lookup'),
+    path('files/<uuid:file_id>/lookup/', views.key_lookup, name='key_lookup'),
+    path('files/<uuid:file_id>/bad-rows/', views.bad_rows, name='bad_rows'),
+    path('files/<uuid:file_id>/diff/<uuid:other_id>/', views.diff_files, name='diff_files'),
+    path('files/<uuid:file_id>/columns/<str:column>/distribution/', views.get_column_distribution, name='get_column_distribution'),
+    path('files/<uuid:file_id>/computed-columns/', views.computed_columns, name='computed_columns'),
+    path('files/<uuid:file_id>/computed-columns/<str:name>/', views.delete_computed_column, name='delete_computed_column'),
+    
+    # SQL over uploaded files
+    path('query/sql/', views.submit_sql_query, name='submit_sql_query'),
+    path('query/sql/<str:query_id>/', views.sql_query_result, name='sql_query_result'),
+    
+    # Background jobs
+    path('tasks/<str:task_id>/', views.get_task_status, name='get_task_status'),
+    
+    # Profiling (staff only)
+    path('admin/profiles/', views.list_profiles, name='list_profiles'),
+    path('admin/profiles/<str:profile_id>/', views.download_profile, name='download_profile'),
     
     # Health check
     path('health/', views.health_check, name='health_check'),
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .artifacts import artifact_path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Validation at ingest. Rules are declared per column:
+#
+#   {"age": {"type": "int", "min": 0, "max": 150, "not_null": true},
+#    "email": {"regex": "[^@]+@[^@]+"},
+#    "state": {"enum": ["open", "closed"]},
+#    "created": {"type": "date", "format": "%Y-%m-%d"}}
+#
+# and checked with vectorized operations on every chunk of the statistics
+# pass. The field count of every record is checked by the row counting scan
+# (see row_index._record_starts) on every ingest, rules or not: the parser
+# reads only the header's columns, so records with too many fields lose the
+# extra ones instead of failing the ingest, and keep their row numbers.
+# Violations go to a bad-row index next to the file, a numpy array of
+# (row, reason, column) sorted by row, with one entry per violated rule.
+
+REASONS = ('field_count', 'not_null', 'type', 'range', 'regex', 'enum')
+RULE_TYPES = ('int', 'float', 'date', 'str')
+RULE_KEYS = {'type', 'min', 'max', 'regex', 'not_null', 'enum', 'format'}
+BAD_ROW_DTYPE = np.dtype([('row', '<i8'), ('reason', '<i2'), ('column', '<i2')])
+NO_COLUMN = -1
+
+
+class RuleError(ValueError):
+    pass
+
+
+def parse_rules(rules) -> dict:
+    """
+    Check declared rules (a dict or its JSON text).
+
+    Raises:
+        RuleError: The rules are malformed
+    """
+    if isinstance(rules, str):
+        try:
+            rules = json.loads(rules)
+        except json.JSONDecodeError as e:
+            raise RuleError(f"Validation rules are not valid JSON: {e}")
+    if not isinstance(rules, dict):
+        raise RuleError('Validation rules must map column names to rules')
+    for column, rule in rules.items():
+        if not isinstance(rule, dict):
+            raise RuleError(f"Rule of '{column}' must be an object")
+        unknown = set(rule) - RULE_KEYS
+        if unknown:
+            raise RuleError(f"Unknown keys in rule of '{column}': {', '.join(sorted(unknown))}")
+        if rule.get('type', 'str') not in RULE_TYPES:
+            raise RuleError(f"Type of '{column}' must be one of {', '.join(RULE_TYPES)}")
+        if 'regex' in rule:
+            try:
+                re.compile(rule['regex'])
+            except (re.error, TypeError) as e:
+                raise RuleError(f"Invalid regex for '{column}': {e}")
+        if 'enum' in rule and not isinstance(rule['enum'], list):
+            raise RuleError(f"Enum of '{column}' must be a list")
+        for bound in ('min', 'max'):
+            if bound in rule:
+                try:
+                    _bound(rule, bound)
+                except (TypeError, ValueError) as e:
+                    raise RuleError(f"Invalid {bound} for '{column}': {e}")
+    return rules
+
+
+def _bound(rule: dict, name: str):
+    if rule.get('type') == 'date':
+        return pd.Timestamp(rule[name])
+    return float(rule[name])
+
+
+def rules_key(rules: dict) -> str:
+    payload = json.dumps(rules, sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def bad_rows_artifact(rules: dict) -> str:
+    # Per rule set: identical uploads share one file but may have other rules
+    return f"badrows-{rules_key(rules or {})}.npy"
+
+
+def bad_rows_path(file_path: str, rules: dict) -> str:
+    return artifact_path(file_path, bad_rows_artifact(rules))
+
+
+def _as_text(values: pd.Series) -> pd.Series:
+    """
+    Values as text for regex and enum rules. Integer columns with missing
+    values are parsed as floats, so integral floats drop their ".0".
+    """
+    if pd.api.types.is_float_dtype(values):
+        present = values.dropna()
+        if (present == np.floor(present)).all():
+            return values.astype('Int64').astype(str)
+    return values.astype(str)
+
+
+class FieldCountCheck:
+    """
+    field_counts callback of row_index.scan_records collecting the records
+    whose number of fields differs from the header's.
+    """
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self._rows = []
+
+    def __call__(self, rows: np.ndarray, fields: np.ndarray):
+        wrong = fields != self.expected
+        if wrong.any():
+            self._rows.append(rows[wrong])
+
+    def rows(self) -> np.ndarray:
+        return np.concatenate(self._rows) if self._rows else np.empty(0, dtype=np.int64)
+
+
+class ValidationCollector:
+    """
+    Ingest collector checking the rules on every chunk; the chunk index is
+    the data row number.
+    """
+
+    def __init__(self, rules: dict, columns: list, max_entries: int = None):
+        self.columns = list(columns)
+        # Anything but a dict of rules (e.g. a null JSONField) means no rules
+        self.declared = rules if isinstance(rules, dict) else {}
+        self.rules = {column: rule for column, rule in self.declared.items() if column in self.columns}
+        self.missing_columns = sorted(set(self.declared) - set(self.columns))
+        self.max_entries = max_entries or settings.CSV_VALIDATION_MAX_ENTRIES
+        self.counts = {}
+        self._entries = []
+        self._recorded = 0
+        self.truncated = False
+
+    def _add(self, rows: np.ndarray, reason: str, column: int):
+        if not len(rows):
+            return
+        key = (reason, self.columns[column] if column != NO_COLUMN else None)
+        self.counts[key] = self.counts.get(key, 0) + len(rows)
+        room = self.max_entries - self._recorded
+        if len(rows) > room:
+            # Counts stay exact, the index keeps the first entries
+            self.truncated = True
+            rows = rows[:room]
+            if not room:
+                return
+        entries = np.empty(len(rows), dtype=BAD_ROW_DTYPE)
+        entries['row'] = rows
+        entries['reason'] = REASONS.index(reason)
+        entries['column'] = column
+        self._entries.append(entries)
+        self._recorded += len(rows)
+
+    def add_field_counts(self, check: FieldCountCheck):
+        self._add(check.rows(), 'field_count', NO_COLUMN)
+
+    def update(self, chunk: pd.DataFrame):
+        if not self.rules:
+            return
+        rows = chunk.index.to_numpy(dtype=np.int64)
+        for column, rule in self.rules.items():
+            position = self.columns.index(column)
+            values = chunk[column]
+            missing = values.isna().to_numpy()
+            if rule.get('not_null'):
+                self._add(rows[missing], 'not_null', position)
+            kind = rule.get('type', 'str')
+            comparable = None
+            if kind in ('int', 'float'):
+                comparable = values if pd.api.types.is_numeric_dtype(values) else pd.to_numeric(values, errors='coerce')
+                wrong = comparable.isna().to_numpy() & ~missing
+                if kind == 'int':
+                    wrong |= (comparable.notna() & (comparable != np.floor(comparable))).to_numpy()
+                self._add(rows[wrong], 'type', position)
+            elif kind == 'date':
+                comparable = pd.to_datetime(values, format=rule.get('format'), errors='coerce')
+                self._add(rows[comparable.isna().to_numpy() & ~missing], 'type', position)
+            if comparable is not None and ('min' in rule or 'max' in rule):
+                out = np.zeros(len(values), dtype=bool)
+                if 'min' in rule:
+                    out |= (comparable < _bound(rule, 'min')).to_numpy()
+                if 'max' in rule:
+                    out |= (comparable > _bound(rule, 'max')).to_numpy()
+                self._add(rows[out], 'range', position)
+            if 'regex' in rule or 'enum' in rule:
+                text = _as_text(values)
+                if 'regex' in rule:
+                    matched = text.str.fullmatch(rule['regex']).fillna(False).to_numpy(dtype=bool)
+                    self._add(rows[~matched & ~missing], 'regex', position)
+                if 'enum' in rule:
+                    allowed = text.isin([str(value) for value in rule['enum']]).to_numpy()
+                    self._add(rows[~allowed & ~missing], 'enum', position)
+
+    def entries(self) -> np.ndarray:
+        entries = np.concatenate(self._entries) if self._entries else np.empty(0, dtype=BAD_ROW_DTYPE)
+        return entries[np.argsort(entries['row'], kind='stable')]
+
+    def save(self, path: str):
+        save_entries(path, self.entries())
+
+    def summary(self) -> dict:
+        entries = self.entries()
+        violations, by_column = {}, {}
+        for (reason, column), count in self.counts.items():
+            violations[reason] = violations.get(reason, 0) + count
+            if column is not None:
+                by_column.setdefault(column, {})[reason] = count
+        return {
+            'bad_rows': int(len(np.unique(entries['row']))),
+            'violations': violations,
+            'columns': by_column,
+            'missing_columns': self.missing_columns,
+            'truncated': self.truncated,
+        }
+
+
+def merge_summaries(summaries: list, entries: np.ndarray) -> dict:
+    """
+    Summary of several ranges, whose merged entries are ``entries``.
+    """
+    merged = {
+        'bad_rows': int(len(np.unique(entries['row']))),
+        'violations': {},
+        'columns': {},
+        'missing_columns': summaries[0]['missing_columns'] if summaries else [],
+        'truncated': any(summary['truncated'] for summary in summaries),
+    }
+    for summary in summaries:
+        for reason, count in summary['violations'].items():
+            merged['violations'][reason] = merged['violations'].get(reason, 0) + count
+        for column, reasons in summary['columns'].items():
+            for reason, count in reasons.items():
+                column_counts = merged['columns'].setdefault(column, {})
+                column_counts[reason] = column_counts.get(reason, 0) + count
+    return merged
+
+
+def save_entries(path: str, entries: np.ndarray):
+    with open(path + '.tmp', 'wb') as output:
+        np.save(output, entries)
+    os.replace(path + '.tmp', path)
+
+
+def load_bad_rows(file_path: str, rules: dict):
+    """
+    The bad-row index of the file under ``rules``, or None if none was built.
+    """
+    path = bad_rows_path(file_path, rules)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
@@ -1,27 +1,59 @@
+import numpy as np
 import pandas as pd
 import os
-import shutil
-from rest_framework.decorators import api_view, parser_classes
+from rest_framework.decorators import api_view, parser_classes, permission_classes, renderer_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework import status
-from django.http import JsonResponse, Http404
+from django.http import (
+    FileResponse, HttpResponse, HttpResponseNotAllowed, JsonResponse, Http404, StreamingHttpResponse
+)
 from django.core.paginator import Paginator
+from django.conf import settings
+from django.db import transaction
 from .models import UploadedFile
-from .file_processor import LargeCSVProcessor
-from .tasks import process_large_csv
+from .file_processor import AppendError, LargeCSVProcessor, RawRecordsUnavailable
+from celery.result import AsyncResult
+from .tasks import (
+    aggregate_csv, diff_csv, dispatch_once, key_index_task_id, queue_ingest, queue_key_indexes, retry_ingest, run_sql_query
+)
+from .metrics import SERIALIZATION_SECONDS, record_cache_lookup, render_latest
+from . import aggregation, diffing, expressions, file_cache, profiling, sql_query, storage, validation
+from .distributions import describe_column
+from .executor import offloaded
+from .ingest_control import revoke_ingest
+from .renderers import RawCSVRenderer
+from .row_index import iter_byte_ranges, load_row_index
+from .zone_map import load_zone_map
+from . import sampling
 import logging
 
 logger = logging.getLogger(__name__)
 
+@offloaded(pool='write')
 @api_view(['POST'])
 @parser_classes([MultiPartParser])
 def upload_large_csv(request):
     """
     Upload and process large CSV files.
-    Files are saved to disk and processed asynchronously.
+    Files are saved to disk and processed asynchronously. An optional
+    index_columns field (comma separated) asks for key indexes on those
+    columns once the ingest completes.
+    
+    Uploads that would not fit in the remaining storage are refused with
+    507 before their body is read.
     """
     try:
+        # Checked on the declared length: reading request.FILES would
+        # spool the whole body first
+        try:
+            storage.check_upload_space(request.META.get('CONTENT_LENGTH'))
+        except storage.StorageFull as e:
+            logger.warning(f"Refused upload: {e}")
+            return Response({'error': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+        
         if 'file' not in request.FILES:
             return Response(
                 {'error': 'No file provided'}, 
@@ -45,18 +77,37 @@ def upload_large_csv(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        index_columns = [
+            column.strip() for column in request.data.get('index_columns', '').split(',') if column.strip()
+        ]
+        validation_rules = None
+        if request.data.get('validation_rules'):
+            try:
+                validation_rules = validation.parse_rules(request.data['validation_rules'])
+            except validation.RuleError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         processor = LargeCSVProcessor()
         
-        # For files > 1GB, process directly from memory without disk copy
-        large_file_threshold = 1 * 1024 * 1024 * 1024  # 1GB
-  
-            # Small files: immediate copy, background analysis
-        logger.info(f"{uploaded_file.name} (small file) assigned to celery worker.")
+        # The file is stored (spooled uploads are moved, not copied) and the
+        # ingest task gets only the record id, never the content
+        logger.info(f"{uploaded_file.name} assigned to celery worker.")
         db_file = processor.save_uploaded_file(uploaded_file, uploaded_file.name)
-        process_large_csv.delay(str(db_file.id))
+        if validation_rules:
+            db_file.validation_rules = validation_rules
+            db_file.save(update_fields=['validation_rules'])
+        if processor.share_duplicate_content(db_file):
+            if index_columns:
+                queue_key_indexes(db_file, index_columns)
+            message = 'File uploaded successfully. Identical content was already processed.'
+        elif index_columns:
+            queue_ingest(db_file, index_columns=index_columns)
+            message = 'File uploaded successfully. Processing started.'
+        else:
+            queue_ingest(db_file)
+            message = 'File uploaded successfully. Processing started.'
     
         return Response({
-            'message': 'File uploaded successfully. Processing started.',
+            'message': message,
             'file_id': str(db_file.id),
             'filename': db_file.filename,
             'file_size': db_file.file_size,
@@ -78,15 +129,19 @@ def get_file_status(request, file_id):
     """
     try:
         db_file = UploadedFile.objects.get(id=file_id)
+        total_rows, lower_bound = _known_rows(db_file)
         
         return Response({
             'file_id': str(db_file.id),
             'filename': db_file.filename,
             'file_size': db_file.file_size,
             'status': db_file.status,
-            'total_rows': db_file.total_rows,
+            'total_rows': total_rows,
+            'total_rows_is_lower_bound': lower_bound,
+            'readable_rows': db_file.readable_rows if db_file.status == 'processing' else total_rows,
             'columns': db_file.columns,
             'dtypes': db_file.dtypes,
+            'validation': db_file.validation,
             'processing_progress': db_file.processing_progress,
             'error_message': db_file.error_message,
             'created_at': db_file.created_at,
@@ -97,67 +152,144 @@ def get_file_status(request, file_id):
         raise Http404("File not found")
 
 
+def _known_rows(db_file):
+    """
+    Row count to report for a file: while it is processing, the rows below
+    its readable watermark, which is a lower bound until the whole file
+    was scanned.
+    
+    Returns:
+        Tuple of (total_rows, is_lower_bound)
+    """
+    if db_file.status != 'processing':
+        return db_file.total_rows, False
+    scanned = db_file.readable_bytes is not None and db_file.readable_bytes >= db_file.file_size
+    return db_file.readable_rows, not scanned
+
+
+@offloaded
 @api_view(['GET'])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [RawCSVRenderer])
 def get_file_data(request, file_id):
     """
     Get paginated data from a processed CSV file.
     Supports efficient pagination for very large files.
+    
+    While the file is still processing, pages below its readable watermark
+    are served and total_rows is the number of readable rows
+    (total_rows_is_lower_bound tells whether more may follow).
+    
+    With ?format=raw (or Accept: text/csv) the page is returned as the
+    original CSV lines with the header prepended, sliced from the file
+    through the row index without parsing; pagination details are sent in
+    X-* response headers.
+    
+    Records of completed files come from the per-process file cache, so a
+    page usually needs no database query.
+    
+    Computed columns of the file are evaluated on the rows of the page only.
+    ?where=<expression> pages through the rows matching a filter (which may
+    use computed columns); the file is scanned up to the page, and
+    total_rows is a lower bound while more matches may follow.
     """
     try:
-        db_file = UploadedFile.objects.get(id=file_id)
+        db_file = file_cache.get_file(file_id)
+        computed = expressions.ComputedColumns(db_file.computed_columns, db_file.columns or [])
         
-        if db_file.status != 'completed':
+        readable = db_file.status == 'processing' and db_file.readable_rows is not None and db_file.columns
+        if db_file.status != 'completed' and not readable:
             return Response(
                 {'error': f'File processing not completed. Current status: {db_file.status}'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
+        total_rows, lower_bound = _known_rows(db_file)
+        storage.touch(db_file)
         
-        # Check if file was processed in memory (large files >1GB)
+        # Records processed in memory by earlier versions have no stored copy
         if not db_file.file_path:
             return Response(
-                {'error': 'Large files processed in memory do not support data viewing. Only metadata is available.'}, 
+                {'error': 'This file has no stored copy to read rows from. Only metadata is available.'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
         # Get pagination parameters
-        page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 100))
+        try:
+            page, page_size, offset = _page_params(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Validate pagination parameters
-        if page < 1:
-            page = 1
-        if page_size < 1 or page_size > 10000:  # Limit max page size
-            page_size = 100
+        # Optional column selection, kept in file order so equal selections
+        # share one read; computed columns follow in definition order
+        requested = {column.strip() for column in request.GET.get('columns', '').split(',') if column.strip()}
+        unknown = requested - set(db_file.columns or []) - set(computed.names)
+        if unknown:
+            return Response(
+                {'error': f'Unknown columns: {", ".join(sorted(unknown))}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        columns = [column for column in db_file.columns + computed.names if column in requested] if requested else None
+        names = columns or db_file.columns + computed.names
         
-        # Calculate offset
-        offset = (page - 1) * page_size
+        where = request.GET.get('where', '').strip()
+        if where:
+            if db_file.status != 'completed':
+                return Response(
+                    {'error': f'Filters are available once processing completed. Current status: {db_file.status}'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            predicate = computed.filter(where)
+        
+        if request.accepted_renderer.format == RawCSVRenderer.format:
+            if db_file.status != 'completed':
+                # Raw pages are sliced through the row index, which is
+                # written when the scan finishes
+                return Response(
+                    {'error': f'Raw pages are available once processing completed. Current status: {db_file.status}'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if columns or where:
+                return Response(
+                    {'error': 'Column selection and filters are not supported for raw pages'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            return _raw_page(db_file, page, page_size, offset)
+        
+        processor = LargeCSVProcessor()
+        if where:
+            return _filtered_page(db_file, processor, computed, predicate, names, page, page_size, offset)
         
-        # Check if offset is beyond file
-        if db_file.total_rows and offset >= db_file.total_rows:
+        # Check if offset is beyond file (or beyond the readable rows)
+        if (total_rows or lower_bound) and offset >= total_rows:
             return Response({
                 'data': [],
                 'page': page,
                 'page_size': page_size,
-                'total_rows': db_file.total_rows,
-                'total_pages': (db_file.total_rows + page_size - 1) // page_size,
+                'total_rows': total_rows,
+                'total_rows_is_lower_bound': lower_bound,
+                'total_pages': (total_rows + page_size - 1) // page_size,
                 'has_next': False,
-                'has_previous': page > 1
+                'has_previous': page > 1,
+                'status': db_file.status
             })
         
-        processor = LargeCSVProcessor()
-        
-        # Get the requested chunk of data
-        df_chunk = processor.get_data_chunk(db_file.file_path, offset, page_size)
-        
-        # Replace NaN values with None for JSON compatibility
-        import numpy as np
-        df_chunk = df_chunk.replace({np.nan: None})
+        # Get the requested chunk of data, clipped to the readable rows
+        # while processing. Only the file columns the page needs are read
+        limit = min(page_size, total_rows - offset) if lower_bound else page_size
+        sources = computed.sources(names) or db_file.columns[:1]
+        df_chunk = processor.get_data_chunk(
+            db_file.file_path, offset, limit, None if sources == db_file.columns else sources
+        )
+        df_chunk = computed.add_to(df_chunk, names)[names]
         
-        # Convert to records
-        data = df_chunk.to_dict('records')
+        with SERIALIZATION_SECONDS.labels(endpoint='get_file_data').time():
+            # Replace NaN values with None for JSON compatibility
+            df_chunk = df_chunk.replace({np.nan: None})
+            
+            # Convert to records
+            data = df_chunk.to_dict('records')
         
         # Calculate pagination info
-        total_pages = (db_file.total_rows + page_size - 1) // page_size if db_file.total_rows else 1
+        total_pages = (total_rows + page_size - 1) // page_size if total_rows else 1
         has_next = page < total_pages
         has_previous = page > 1
         
@@ -165,16 +297,20 @@ def get_file_data(request, file_id):
             'data': data,
             'page': page,
             'page_size': page_size,
-            'total_rows': db_file.total_rows,
+            'total_rows': total_rows,
+            'total_rows_is_lower_bound': lower_bound,
             'total_pages': total_pages,
             'has_next': has_next,
             'has_previous': has_previous,
-            'columns': db_file.columns,
-            'dtypes': db_file.dtypes
+            'columns': names,
+            'dtypes': _page_dtypes(db_file, df_chunk, computed),
+            'status': db_file.status
         })
         
     except UploadedFile.DoesNotExist:
         raise Http404("File not found")
+    except expressions.ExpressionError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         logger.error(f"Error getting file data: {e}")
         return Response(
@@ -183,6 +319,100 @@ def get_file_data(request, file_id):
         )
 
 
+def _page_dtypes(db_file, df_chunk, computed) -> dict:
+    dtypes = dict(db_file.dtypes or {})
+    for name in computed.names:
+        if name in df_chunk.columns:
+            dtypes[name] = str(df_chunk[name].dtype)
+    return dtypes
+
+
+def _filtered_page(db_file, processor, computed, predicate, names: list, page: int, page_size: int,
+                   offset: int) -> Response:
+    """
+    Page of the rows matching a filter, see get_file_data.
+    """
+    result = processor.filter_rows(db_file.file_path, computed, predicate, names, offset, page_size)
+    rows, has_next = result['rows'], result['has_next']
+    # Matches seen so far, one past the page if there are more
+    total_rows = offset + len(rows) + (1 if has_next else 0)
+    
+    return Response({
+        'data': _records(rows, 'get_file_data'),
+        'row_numbers': [int(row) for row in rows.index],
+        'page': page,
+        'page_size': page_size,
+        'total_rows': total_rows,
+        'total_rows_is_lower_bound': has_next,
+        'total_pages': (total_rows + page_size - 1) // page_size,
+        'has_next': has_next,
+        'has_previous': page > 1,
+        'columns': names,
+        'dtypes': _page_dtypes(db_file, rows, computed),
+        'where': predicate.text,
+        'scanned_rows': result['scanned_rows'],
+        'status': db_file.status
+    })
+
+
+def _raw_page(db_file, page: int, page_size: int, offset: int):
+    """
+    Stream rows [offset, offset + page_size) of the file as raw CSV bytes.
+    """
+    processor = LargeCSVProcessor()
+    try:
+        ranges = processor.get_raw_span(db_file.file_path, offset, page_size)
+    except RawRecordsUnavailable:
+        return Response(
+            {'error': 'Raw pages are not available for the CSV dialect of this file, request JSON pages instead'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    total_pages = (db_file.total_rows + page_size - 1) // page_size if db_file.total_rows else 1
+    
+    response = StreamingHttpResponse(iter_byte_ranges(db_file.file_path, ranges), content_type='text/csv')
+    response['Content-Length'] = str(sum(end - start for start, end in ranges))
+    response['X-Page'] = str(page)
+    response['X-Page-Size'] = str(page_size)
+    response['X-Total-Rows'] = str(db_file.total_rows or 0)
+    response['X-Total-Pages'] = str(total_pages)
+    response['X-Has-Next'] = 'true' if page < total_pages else 'false'
+    return response
+
+
+@offloaded(pool='write')
+@api_view(['POST'])
+@parser_classes([MultiPartParser])
+def append_to_file(request, file_id):
+    """
+    Append the rows of an uploaded CSV batch (same header) to a processed
+    file. Only the new rows are processed; row count, schema, statistics,
+    distributions, sample and row index are updated in place.
+    """
+    try:
+        try:
+            storage.check_upload_space(request.META.get('CONTENT_LENGTH'))
+        except storage.StorageFull as e:
+            logger.warning(f"Refused append to {file_id}: {e}")
+            return Response({'error': str(e)}, status=status.HTTP_507_INSUFFICIENT_STORAGE)
+        
+        if 'file' not in request.FILES:
+            return Response(
+                {'error': 'No file provided'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        processor = LargeCSVProcessor()
+        result = processor.append_to_file(str(file_id), request.FILES['file'])
+        logger.info(f"Appended {result['appended_rows']} rows to file {file_id}")
+        
+        return Response({'file_id': str(file_id), **result})
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+    except AppendError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
 @api_view(['GET'])
 def list_files(request):
     """
@@ -209,11 +439,15 @@ def list_files(request):
 @api_view(['DELETE'])
 def delete_file(request, file_id):
     """
-    Delete an uploaded file and its data.
+    Delete an uploaded file and its data. A queued ingest is revoked; a
+    running one stops at its next cancellation check and removes what it
+    wrote since.
     """
     try:
         db_file = UploadedFile.objects.get(id=file_id)
         filename = db_file.filename
+        if db_file.status in ('uploading', 'processing'):
+            revoke_ingest(db_file)
         db_file.delete()  # This will also delete the physical file
         
         return Response({
@@ -224,6 +458,46 @@ def delete_file(request, file_id):
         raise Http404("File not found")
 
 
+@api_view(['POST'])
+def retry_file_ingest(request, file_id):
+    """
+    Queue a failed ingest again. A failed distributed ingest is resumed:
+    ranges that finished before the failure are not processed again.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if db_file.status != 'failed':
+            return Response(
+                {'error': f'Only failed ingests can be retried. Current status: {db_file.status}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not db_file.file_path or not os.path.exists(db_file.file_path):
+            return Response(
+                {'error': 'The file has no stored copy to ingest again'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        # Claimed by status, so concurrent retries queue one ingest
+        claimed = UploadedFile.objects.filter(id=db_file.id, status='failed').update(
+            status='processing', error_message=None, processing_progress=0.0
+        )
+        if not claimed:
+            return Response({'error': 'The ingest was already retried'}, status=status.HTTP_409_CONFLICT)
+        
+        task = retry_ingest(db_file)
+        logger.info(f"Retrying ingest of {file_id} as task {task.id}")
+        
+        return Response({
+            'file_id': str(db_file.id),
+            'status': 'processing',
+            'task_id': task.id
+        }, status=status.HTTP_202_ACCEPTED)
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@offloaded
 @api_view(['GET'])
 def get_file_stats(request, file_id):
     """
@@ -237,9 +511,15 @@ def get_file_stats(request, file_id):
                 {'error': f'File processing not completed. Current status: {db_file.status}'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
+        storage.touch(db_file)
         
-        processor = LargeCSVProcessor()
-        stats = processor.get_file_statistics(db_file.file_path)
+        # Statistics gathered at ingest avoid a full scan per request
+        stats = db_file.statistics
+        if stats is None:
+            processor = LargeCSVProcessor()
+            # Rows with too many fields are parsed to the header's width, as at ingest
+            usecols = range(len(db_file.columns)) if db_file.columns else None
+            stats = processor.get_file_statistics(db_file.file_path, usecols=usecols)
         
         return Response({
             'file_id': str(db_file.id),
@@ -251,24 +531,868 @@ def get_file_stats(request, file_id):
         raise Http404("File not found")
 
 
+@offloaded
+@api_view(['GET'])
+def get_column_distribution(request, file_id, column):
+    """
+    Histogram (numeric columns) or top values (other columns) built at
+    ingest. Served from the database record, the CSV is never read.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if db_file.status != 'completed':
+            return Response(
+                {'error': f'File processing not completed. Current status: {db_file.status}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        distributions = db_file.column_distributions or {}
+        if column not in distributions:
+            if column in (db_file.columns or []):
+                return Response(
+                    {'error': 'No distribution was recorded for this column'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            raise Http404("Column not found")
+        
+        return Response({
+            'file_id': str(db_file.id),
+            'column': column,
+            'distribution': describe_column(distributions[column])
+        })
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@offloaded
+@api_view(['GET', 'POST'])
+def computed_columns(request, file_id):
+    """
+    GET: the computed columns of a file.
+    POST: define (or replace) one, body {"name": "margin", "expression": "(price - cost) / price"}
+    
+    Expressions are checked against the file's columns and evaluated on its
+    first rows before they are saved; see expressions.py for the syntax.
+    They are computed on each page served by get_file_data, never stored.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if request.method == 'GET':
+            return Response({'file_id': str(db_file.id), 'computed_columns': db_file.computed_columns or []})
+        
+        if db_file.status != 'completed':
+            return Response(
+                {'error': f'File processing not completed. Current status: {db_file.status}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        name = (request.data.get('name') or '').strip()
+        expression = (request.data.get('expression') or '').strip()
+        if not name or not expression:
+            return Response({'error': 'name and expression are required'}, status=status.HTTP_400_BAD_REQUEST)
+        if name in db_file.columns:
+            return Response({'error': f"'{name}' is a column of the file"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        with transaction.atomic():
+            db_file = UploadedFile.objects.select_for_update().get(id=file_id)
+            definitions = list(db_file.computed_columns or [])
+            replaced = next((i for i, definition in enumerate(definitions) if definition['name'] == name), None)
+            if replaced is None:
+                if len(definitions) >= settings.CSV_COMPUTED_COLUMNS_MAX:
+                    return Response(
+                        {'error': f'A file can have at most {settings.CSV_COMPUTED_COLUMNS_MAX} computed columns'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                definitions.append({'name': name, 'expression': expression})
+            else:
+                definitions[replaced] = {'name': name, 'expression': expression}
+            
+            try:
+                computed = expressions.ComputedColumns(definitions, db_file.columns)
+                # Catch errors that only show on values, e.g. dates in a numeric column
+                processor = LargeCSVProcessor()
+                first_rows = processor.get_data_chunk(
+                    db_file.file_path, 0, settings.CSV_COMPUTED_PREVIEW_ROWS, computed.sources([name]) or db_file.columns[:1]
+                )
+                preview = computed.add_to(first_rows, [name])[[name]]
+            except expressions.ExpressionError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            
+            db_file.computed_columns = definitions
+            db_file.save(update_fields=['computed_columns'])
+        logger.info(f"Computed column '{name}' of {db_file.id} set to {expression}")
+        
+        return Response({
+            'file_id': str(db_file.id),
+            'name': name,
+            'expression': expression,
+            'preview': [record[name] for record in _records(preview, 'computed_columns')],
+            'computed_columns': definitions,
+        }, status=status.HTTP_201_CREATED if replaced is None else status.HTTP_200_OK)
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@api_view(['DELETE'])
+def delete_computed_column(request, file_id, name):
+    """
+    Remove a computed column, unless another computed column uses it.
+    """
+    try:
+        with transaction.atomic():
+            db_file = UploadedFile.objects.select_for_update().get(id=file_id)
+            definitions = list(db_file.computed_columns or [])
+            if name not in [definition['name'] for definition in definitions]:
+                raise Http404("Computed column not found")
+            users = [
+                definition['name'] for definition in definitions
+                if name in expressions.parse(definition['expression']).columns
+            ]
+            if users:
+                return Response(
+                    {'error': f"'{name}' is used by {', '.join(users)}"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            db_file.computed_columns = [definition for definition in definitions if definition['name'] != name]
+            db_file.save(update_fields=['computed_columns'])
+        
+        return Response({'file_id': str(db_file.id), 'computed_columns': db_file.computed_columns})
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@offloaded
+@api_view(['GET'])
+def sample_file(request, file_id):
+    """
+    Random sample of rows, e.g. ?n=1000&seed=42&stratify=region
+    
+    Samples up to the reservoir size are drawn from the reservoir kept at
+    ingest, so the CSV is not read. Larger uniform samples pick row numbers
+    and read them through the row index. The same seed always returns the
+    same rows; without one a seed is chosen and returned.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if db_file.status != 'completed':
+            return Response(
+                {'error': f'File processing not completed. Current status: {db_file.status}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        storage.touch(db_file)
+        
+        if not db_file.file_path:
+            return Response(
+                {'error': 'This file has no stored copy to read rows from. Only metadata is available.'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            n = int(request.GET.get('n', 100))
+            seed = int(request.GET['seed']) if 'seed' in request.GET else None
+        except ValueError:
+            return Response({'error': 'n and seed must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+        if n < 1 or n > settings.CSV_SAMPLE_MAX:
+            return Response(
+                {'error': f'n must be between 1 and {settings.CSV_SAMPLE_MAX}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), 'little')
+        
+        stratify = request.GET.get('stratify')
+        if stratify and stratify not in (db_file.columns or []):
+            return Response({'error': f"Unknown column '{stratify}'"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        reservoir = sampling.load_reservoir(db_file.file_path)
+        if stratify:
+            if reservoir is None:
+                return Response(
+                    {'error': 'Stratified sampling needs the ingest reservoir, which this file does not have'}, 
+                    status=status.HTTP_409_CONFLICT
+                )
+            sample = sampling.stratified_sample(reservoir, stratify, n, seed)
+            method = 'stratified'
+        elif reservoir is not None and n <= len(reservoir):
+            sample = sampling.sample_frame(reservoir, n, seed)
+            method = 'reservoir'
+        else:
+            processor = LargeCSVProcessor()
+            rows = sampling.uniform_rows(db_file.total_rows or 0, n, seed)
+            sample = processor.read_rows(db_file.file_path, db_file.columns, rows)
+            method = 'row_index'
+        
+        return Response({
+            'file_id': str(db_file.id),
+            'method': method,
+            'seed': seed,
+            'n': len(sample),
+            'population': db_file.total_rows,
+            'stratify': stratify,
+            'row_numbers': [int(row) for row in sample.index],
+            'data': _records(sample, 'sample_file'),
+        })
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@offloaded
+@api_view(['GET'])
+def range_lookup(request, file_id):
+    """
+    Rows whose column value lies in an inclusive range, e.g.
+    ?column=ts&from=2024-01-01T00:00&to=2024-01-01T01:00&limit=1000
+    
+    Only the blocks whose zone map min/max overlaps the range are read,
+    so lookups on columns the file is sorted or clustered by touch a small
+    part of it. Either bound may be omitted.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if db_file.status != 'completed':
+            return Response(
+                {'error': f'File processing not completed. Current status: {db_file.status}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        storage.touch(db_file)
+        
+        if not db_file.file_path:
+            return Response(
+                {'error': 'This file has no stored copy to read rows from. Only metadata is available.'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        column = request.GET.get('column')
+        if column not in (db_file.columns or []):
+            return Response({'error': f"Unknown column '{column}'"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.GET.get('limit', 1000))
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or limit > settings.CSV_RANGE_MAX_ROWS:
+            return Response(
+                {'error': f'limit must be between 1 and {settings.CSV_RANGE_MAX_ROWS}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        zones = load_zone_map(db_file.file_path)
+        if zones is None or load_row_index(db_file.file_path) is None:
+            return Response(
+                {'error': 'Range lookups need the zone map and row index built at ingest, which this file does not have'}, 
+                status=status.HTTP_409_CONFLICT
+            )
+        try:
+            low = zones.parse_bound(column, request.GET.get('from'))
+            high = zones.parse_bound(column, request.GET.get('to'))
+        except ValueError:
+            return Response(
+                {'error': f"Column '{column}' is numeric, from and to must be numbers"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        processor = LargeCSVProcessor()
+        result = processor.find_in_range(db_file.file_path, db_file.columns, column, low, high, limit)
+        rows = result['rows']
+        
+        return Response({
+            'file_id': str(db_file.id),
+            'column': column,
+            'from': request.GET.get('from'),
+            'to': request.GET.get('to'),
+            'n': len(rows),
+            'truncated': result['truncated'],
+            'blocks_scanned': result['blocks_scanned'],
+            'blocks_total': result['blocks_total'],
+            'row_numbers': [int(row) for row in rows.index],
+            'data': _records(rows, 'range_lookup'),
+        })
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@offloaded
+@api_view(['GET'])
+def key_lookup(request, file_id):
+    """
+    Rows whose column holds exactly a value, e.g. ?column=order_id&value=A-1001
+    
+    Served from the key index of the column; values compare as raw text.
+    Without an index this queues a Celery task building it (once) and
+    returns 202 with the task id, or 500 if the build failed, like
+    aggregate_file.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if db_file.status != 'completed':
+            return Response(
+                {'error': f'File processing not completed. Current status: {db_file.status}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        storage.touch(db_file)
+        
+        if not db_file.file_path:
+            return Response(
+                {'error': 'This file has no stored copy to read rows from. Only metadata is available.'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        column = request.GET.get('column')
+        if column not in (db_file.columns or []):
+            return Response({'error': f"Unknown column '{column}'"}, status=status.HTTP_400_BAD_REQUEST)
+        value = request.GET.get('value')
+        if value is None:
+            return Response({'error': 'value is required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.GET.get('limit', 1000))
+        except ValueError:
+            return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or limit > settings.CSV_KEY_LOOKUP_MAX_ROWS:
+            return Response(
+                {'error': f'limit must be between 1 and {settings.CSV_KEY_LOOKUP_MAX_ROWS}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Nothing is queued once the index exists
+        task = queue_key_indexes(db_file, [column]).get(column)
+        if task is not None:
+            task_id = key_index_task_id(db_file, column)
+            if task.state == 'FAILURE':
+                return Response(
+                    {'status': 'failed', 'task_id': task_id, 'error': str(task.result)}, 
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+            return Response({
+                'status': 'indexing',
+                'task_id': task_id,
+                'progress': task.info if task.state == 'PROGRESS' else None
+            }, status=status.HTTP_202_ACCEPTED)
+        
+        processor = LargeCSVProcessor()
+        result = processor.find_by_key(db_file.file_path, db_file.columns, column, value, limit)
+        rows = result['rows']
+        
+        return Response({
+            'file_id': str(db_file.id),
+            'column': column,
+            'value': value,
+            'n': len(rows),
+            'truncated': result['truncated'],
+            'row_numbers': [int(row) for row in rows.index],
+            'data': _records(rows, 'key_lookup'),
+        })
+    
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@offloaded
+@api_view(['GET'])
+def bad_rows(request, file_id):
+    """
+    Rows that failed validation at ingest, e.g. ?reason=range&column=age&page=2
+    
+    Served from the bad-row index built during the ingest. Each row lists
+    its violations and its original record text; reason and column narrow
+    the rows to those with a matching violation.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if db_file.status != 'completed':
+            return Response(
+                {'error': f'File processing not completed. Current status: {db_file.status}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        storage.touch(db_file)
+        
+        reason = request.GET.get('reason')
+        if reason is not None and reason not in validation.REASONS:
+            return Response(
+                {'error': f"reason must be one of {', '.join(validation.REASONS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        column = request.GET.get('column')
+        if column is not None and column not in (db_file.columns or []):
+            return Response({'error': f"Unknown column '{column}'"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        entries = validation.load_bad_rows(db_file.file_path, db_file.validation_rules) if db_file.file_path else None
+        if entries is None or db_file.validation is None:
+            return Response(
+                {'error': 'No validation results for this file'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        try:
+            page, page_size, offset = _page_params(request, max_page_size=1000)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        matching = entries
+        if reason is not None:
+            matching = matching[matching['reason'] == validation.REASONS.index(reason)]
+        if column is not None:
+            matching = matching[matching['column'] == db_file.columns.index(column)]
+        # Entries are sorted by row
+        rows = np.unique(matching['row'])
+        page_rows = rows[offset:offset + page_size]
+        
+        starts = np.searchsorted(entries['row'], page_rows, side='left')
+        ends = np.searchsorted(entries['row'], page_rows, side='right')
+        processor = LargeCSVProcessor()
+        try:
+            records = processor.read_raw_records(db_file.file_path, page_rows)
+        except RawRecordsUnavailable:
+            # Violations are still listed, without the original text
+            records = [None] * len(page_rows)
+        data = []
+        for row, start, end, record in zip(page_rows, starts, ends, records):
+            data.append({
+                'row': int(row),
+                'violations': [
+                    {
+                        'reason': validation.REASONS[entry['reason']],
+                        'column': db_file.columns[entry['column']] if entry['column'] != validation.NO_COLUMN else None,
+                    }
+                    for entry in entries[start:end]
+                ],
+                'record': record,
+            })
+        
+        total_pages = (len(rows) + page_size - 1) // page_size if len(rows) else 1
+        return Response({
+            'file_id': str(db_file.id),
+            'validation': db_file.validation,
+            'reason': reason,
+            'column': column,
+            'page': page,
+            'page_size': page_size,
+            'total_rows': int(len(rows)),
+            'total_pages': total_pages,
+            'has_next': page < total_pages,
+            'data': data,
+        })
+    
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+def _page_params(request, default_page_size: int = 100, max_page_size: int = 10000):
+    """
+    Parse page/page_size query parameters; out of range values fall back to
+    the first page and the default page size.
+    
+    Returns:
+        Tuple of (page, page_size, offset)
+    
+    Raises:
+        ValueError: page or page_size is not an integer
+    """
+    try:
+        page = int(request.GET.get('page', 1))
+        page_size = int(request.GET.get('page_size', default_page_size))
+    except ValueError:
+        raise ValueError('page and page_size must be integers')
+    if page < 1:
+        page = 1
+    if page_size < 1 or page_size > max_page_size:
+        page_size = default_page_size
+    return page, page_size, (page - 1) * page_size
+
+
+def _records(df_chunk, endpoint: str) -> list:
+    """
+    Convert a DataFrame page to JSON-ready records (NaN becomes None).
+    """
+    with SERIALIZATION_SECONDS.labels(endpoint=endpoint).time():
+        return df_chunk.replace({np.nan: None}).to_dict('records')
+
+
+@offloaded
+@api_view(['GET'])
+def aggregate_file(request, file_id):
+    """
+    Group-by aggregation over a processed file, e.g.
+    ?group_by=region&metrics=sum(amount),count(),mean(price)
+    
+    Results are computed by a Celery task and cached per file version and
+    query; until the result exists this returns 202 with the task id, or
+    500 with the error if the task failed. Polls never queue a second run.
+    """
+    try:
+        db_file = UploadedFile.objects.get(id=file_id)
+        
+        if db_file.status != 'completed':
+            return Response(
+                {'error': f'File processing not completed. Current status: {db_file.status}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        storage.touch(db_file)
+        
+        group_by = [column.strip() for column in request.GET.get('group_by', '').split(',') if column.strip()]
+        try:
+            metrics = aggregation.parse_metrics(request.GET.get('metrics', 'count()'))
+        except aggregation.AggregationError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if not group_by:
+            return Response({'error': 'group_by is required'}, status=status.HTTP_400_BAD_REQUEST)
+        unknown = [column for column in group_by + [c for _, c in metrics if c] if column not in (db_file.columns or [])]
+        if unknown:
+            return Response(
+                {'error': f'Unknown columns: {", ".join(unknown)}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        key = aggregation.query_key(db_file, group_by, metrics)
+        cached = aggregation.load_cached_result(db_file.file_path, key)
+        record_cache_lookup('aggregate', cached is not None)
+        
+        if cached is None:
+            task_id = f"aggregate-{key}"
+            task = dispatch_once(
+                aggregate_csv, task_id, [str(db_file.id), group_by, [list(metric) for metric in metrics]]
+            )
+            if task.state == 'FAILURE':
+                return Response(
+                    {'status': 'failed', 'task_id': task_id, 'error': str(task.result)}, 
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+            return Response({
+                'status': 'processing',
+                'task_id': task_id,
+                'progress': task.info if task.state == 'PROGRESS' else None
+            }, status=status.HTTP_202_ACCEPTED)
+        
+        try:
+            page, page_size, offset = _page_params(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        total_groups = cached['total_groups']
+        data = []
+        if offset < total_groups:
+            processor = LargeCSVProcessor()
+            data = _records(
+                processor.get_data_chunk(aggregation.result_paths(db_file.file_path, key)['data'], offset, page_size),
+                'aggregate_file'
+            )
+        total_pages = max(1, (total_groups + page_size - 1) // page_size)
+        
+        return Response({
+            'status': 'completed',
+            'group_by': cached['group_by'],
+            'metrics': cached['metrics'],
+            'data': data,
+            'page': page,
+            'page_size': page_size,
+            'total_groups': total_groups,
+            'total_pages': total_pages,
+            'has_next': page < total_pages,
+            'has_previous': page > 1
+        })
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@offloaded
 @api_view(['GET'])
-def health_check(request):
-    """Health check endpoint."""
+def diff_files(request, file_id, other_id):
+    """
+    Rows added, removed and modified between two files, e.g.
+    /api/files/<old>/diff/<new>/?key=order_id&page=1&page_size=100
+    
+    Rows are matched on the comma separated key columns; without a key,
+    whole rows are compared as multisets. Values compare as raw text. The
+    diff is computed by Celery tasks and kept next to the old file; until it
+    exists this returns 202 with the task id and progress.
+    """
+    try:
+        db_a = UploadedFile.objects.get(id=file_id)
+        db_b = UploadedFile.objects.get(id=other_id)
+        
+        for db_file in (db_a, db_b):
+            if db_file.status != 'completed':
+                return Response(
+                    {'error': f'File {db_file.id} processing not completed. Current status: {db_file.status}'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if not db_file.file_path:
+                return Response(
+                    {'error': f'File {db_file.id} has no stored copy to read rows from. Only metadata is available.'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            storage.touch(db_file)
+        
+        key_columns = [column.strip() for column in request.GET.get('key', '').split(',') if column.strip()]
+        unknown = [
+            column for column in key_columns
+            if column not in (db_a.columns or []) or column not in (db_b.columns or [])
+        ]
+        if unknown:
+            return Response(
+                {'error': f'Key columns missing from one of the files: {", ".join(unknown)}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        key = diffing.diff_key(db_a, db_b, key_columns)
+        result = diffing.load_result(db_a.file_path, key)
+        if result and result['status'] == 'failed':
+            # Reported once; the next request starts the diff again
+            diffing.remove_result(db_a.file_path, key)
+            return Response(
+                {'status': 'failed', 'error': result['error']}, 
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        
+        if result is None:
+            task_id = f"diff-{key}"
+            plan = diffing.running_plan(db_a.file_path, key)
+            if plan is None:
+                diff_csv.apply_async(args=[str(db_a.id), str(db_b.id), key_columns], task_id=task_id)
+            return Response({
+                'status': 'processing',
+                'task_id': task_id,
+                'progress': diffing.diff_progress(plan) if plan else None
+            }, status=status.HTTP_202_ACCEPTED)
+        
+        try:
+            page, page_size, offset = _page_params(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data = []
+        if offset < result['total_changes']:
+            processor = LargeCSVProcessor()
+            rows = processor.read_rows(
+                diffing.result_paths(db_a.file_path, key)['data'], result['columns'],
+                range(offset, min(offset + page_size, result['total_changes'])), dtype=str
+            )
+            data = _records(rows, 'diff_files')
+        total_pages = max(1, (result['total_changes'] + page_size - 1) // page_size)
+        
+        return Response({
+            'status': 'completed',
+            'file_id': str(db_a.id),
+            'other_id': str(db_b.id),
+            'key': key_columns,
+            'added': result['added'],
+            'removed': result['removed'],
+            'modified': result['modified'],
+            'data': data,
+            'page': page,
+            'page_size': page_size,
+            'total_changes': result['total_changes'],
+            'total_pages': total_pages,
+            'has_next': page < total_pages,
+            'has_previous': page > 1
+        })
+        
+    except UploadedFile.DoesNotExist:
+        raise Http404("File not found")
+
+
+@api_view(['POST'])
+def submit_sql_query(request):
+    """
+    Run a read-only SQL query over uploaded files. Each completed file is a
+    table named file_<id without dashes>, e.g.
+    {"sql": "SELECT a.region, count(*) FROM file_<id> a JOIN file_<id> b USING (key) GROUP BY 1"}
+    
+    Queries run as Celery tasks; this returns 202 with the query id to poll.
+    """
+    sql = (request.data.get('sql') or '').strip()
+    if not sql:
+        return Response({'error': 'sql is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(sql) > settings.CSV_SQL_MAX_LENGTH:
+        return Response(
+            {'error': f'Query longer than {settings.CSV_SQL_MAX_LENGTH} characters'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    file_ids = sql_query.referenced_file_ids(sql)
+    files = {str(db_file.id): db_file for db_file in UploadedFile.objects.filter(id__in=file_ids)}
+    for file_id in file_ids:
+        db_file = files.get(file_id)
+        if db_file is None:
+            return Response({'error': f'Unknown table {sql_query.table_name(file_id)}'}, status=status.HTTP_400_BAD_REQUEST)
+        if db_file.status != 'completed' or not db_file.file_path:
+            return Response(
+                {'error': f'File {file_id} cannot be queried. Current status: {db_file.status}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        storage.touch(db_file)
+    
+    sql_query.expire_results()
+    query_id = sql_query.new_query_id()
+    run_sql_query.apply_async(args=[query_id, sql, file_ids], task_id=query_id)
+    logger.info(f"SQL query {query_id} queued over {len(file_ids)} files")
+    
+    return Response({
+        'query_id': query_id,
+        'status': 'queued',
+        'tables': {sql_query.table_name(file_id): files[file_id].filename for file_id in file_ids}
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+@offloaded
+@api_view(['GET', 'DELETE'])
+def sql_query_result(request, query_id):
+    """
+    GET: state of a SQL query, and a page of its rows once completed.
+    DELETE: cancel a running query, or discard a finished query's result.
+    """
+    try:
+        paths = sql_query.result_paths(query_id)
+    except sql_query.QueryError:
+        raise Http404("Query not found")
+    meta = sql_query.load_result_meta(query_id)
+    
+    if request.method == 'DELETE':
+        if meta is None:
+            sql_query.request_cancel(query_id)
+            AsyncResult(query_id).revoke()
+            return Response({'query_id': query_id, 'status': 'cancelling'}, status=status.HTTP_202_ACCEPTED)
+        sql_query.remove_result(query_id)
+        return Response({'query_id': query_id, 'status': 'deleted'})
+    
+    if meta is None:
+        task = AsyncResult(query_id)
+        if task.state == 'PENDING' and not os.path.exists(paths['cancel']):
+            return Response({'query_id': query_id, 'status': 'queued'}, status=status.HTTP_202_ACCEPTED)
+        if task.state == 'FAILURE':
+            # The task died before it could store its result
+            return Response({'query_id': query_id, 'status': 'failed', 'error': str(task.result)})
+        return Response({
+            'query_id': query_id,
+            'status': 'running',
+            'progress': task.info if task.state == 'PROGRESS' else None
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    if meta['status'] != 'completed':
+        return Response(meta)
+    
+    try:
+        page, page_size, offset = _page_params(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    total_rows = meta['total_rows']
+    data = []
+    if offset < total_rows:
+        processor = LargeCSVProcessor()
+        data = _records(processor.get_data_chunk(paths['data'], offset, page_size), 'sql_query_result')
+    total_pages = max(1, (total_rows + page_size - 1) // page_size)
+    
+    return Response({
+        **meta,
+        'data': data,
+        'page': page,
+        'page_size': page_size,
+        'total_pages': total_pages,
+        'has_next': page < total_pages,
+        'has_previous': page > 1
+    })
+
+
+@api_view(['GET'])
+def get_task_status(request, task_id):
+    """
+    State and progress of a background job (aggregation, ...).
+    """
+    task = AsyncResult(task_id)
+    info = task.info
+    if isinstance(info, Exception):
+        info = {'error': str(info)}
+    return Response({
+        'task_id': task_id,
+        'state': task.state,
+        'info': info
+    })
+
+
+async def health_check(request):
+    """Health check endpoint. Async, so it never waits behind blocking views."""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
     return JsonResponse({'status': 'healthy'})
 
 
+def metrics(request):
+    """
+    Prometheus scrape endpoint. Plain Django view so DRF content
+    negotiation does not get in the way of the text exposition format.
+    """
+    payload, content_type = render_latest()
+    return HttpResponse(payload, content_type=content_type)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def list_profiles(request):
+    """
+    List stored request/task profiles, newest first.
+    """
+    return Response({'profiles': profiling.list_profiles()})
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def download_profile(request, profile_id):
+    """
+    Download a stored profile.
+    ?output=pstats returns the raw cProfile dump, ?output=collapsed returns
+    flamegraph-ready collapsed stacks (converted on the fly for cProfile dumps).
+    """
+    try:
+        path = profiling.profile_path(profile_id)
+    except FileNotFoundError:
+        raise Http404("Profile not found")
+    
+    output = request.GET.get('output', 'pstats' if profile_id.endswith('.prof') else 'collapsed')
+    if output == 'pstats':
+        if not profile_id.endswith('.prof'):
+            return Response(
+                {'error': 'Sampled profiles are only available as collapsed stacks'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=profile_id)
+    
+    if output != 'collapsed':
+        return Response(
+            {'error': 'output must be pstats or collapsed'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    if profile_id.endswith('.prof'):
+        content = profiling.pstats_to_collapsed(path)
+    else:
+        with open(path) as profile_file:
+            content = profile_file.read()
+    
+    response = HttpResponse(content, content_type='text/plain')
+    response['Content-Disposition'] = f'attachment; filename="{os.path.splitext(profile_id)[0]}.collapsed"'
+    return response
+
+
 @api_view(['GET'])
 def get_disk_space(request):
     """
-    Get available disk space in the temporary directory where files are uploaded.
+    Get available disk space where files are uploaded, and what the storage
+    manager tracks: bytes in the upload directories, the quota and the
+    watermarks that trigger eviction.
     """
     try:
-        # Get disk usage for /tmp directory
-        disk_usage = shutil.disk_usage('/tmp')
+        usage = storage.storage_usage()
         
         # Convert to human readable format
-        total_bytes = disk_usage.total
-        free_bytes = disk_usage.free
+        total_bytes = usage['disk_total']
+        free_bytes = usage['disk_free']
         used_bytes = total_bytes - free_bytes
         
         def format_bytes(bytes_value):
@@ -280,7 +1404,7 @@ def get_disk_space(request):
             return f"{bytes_value:.1f} PB"
         
         return Response({
-            'path': '/tmp',
+            'path': settings.CSV_STORAGE_DIRS[0],
             'total_space': {
                 'bytes': total_bytes,
                 'formatted': format_bytes(total_bytes)
@@ -293,7 +1417,15 @@ def get_disk_space(request):
                 'bytes': used_bytes,
                 'formatted': format_bytes(used_bytes)
             },
-            'usage_percentage': round((used_bytes / total_bytes) * 100, 1)
+            'usage_percentage': round((used_bytes / total_bytes) * 100, 1),
+            'managed_space': {
+                'bytes': usage['managed_bytes'],
+                'formatted': format_bytes(usage['managed_bytes'])
+            },
+            'quota_bytes': usage['quota_bytes'],
+            'high_watermark': settings.CSV_STORAGE_HIGH_WATERMARK,
+            'low_watermark': settings.CSV_STORAGE_LOW_WATERMARK,
+            'bytes_to_free': storage.bytes_to_free(usage)
         })
         
     except Exception as e:
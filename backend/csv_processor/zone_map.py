@@ -0,0 +1,182 @@
+import os
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from .artifacts import artifact_path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A zone map splits the data rows into blocks of CSV_ZONE_MAP_BLOCK_ROWS rows
+# and keeps the minimum and maximum of every column per block. A range
+# lookup only reads the blocks whose [min, max] overlaps the range, which on
+# files clustered by the looked-up column is a handful of blocks. Numeric
+# columns compare as numbers, everything else as strings (so ISO-8601
+# timestamps work). Blocks hold first row numbers and are resolved to byte
+# offsets through the row index.
+
+ZONE_MAP_ARTIFACT = 'zonemap.pkl'
+
+
+def _comparable(series: pd.Series, kind: str) -> pd.Series:
+    """
+    Non-null values of ``series`` in the form used for comparisons.
+    """
+    if kind == 'numeric':
+        return pd.to_numeric(series, errors='coerce').dropna()
+    return series.dropna().astype(str)
+
+
+class ZoneMap:
+    """
+    Per-block row ranges with per-column minimums and maximums.
+    """
+
+    def __init__(self, kinds: dict, first_rows, row_counts, minimums: pd.DataFrame, maximums: pd.DataFrame):
+        self.kinds = kinds
+        self.first_rows = np.asarray(first_rows, dtype=np.int64)
+        self.row_counts = np.asarray(row_counts, dtype=np.int64)
+        self.minimums = minimums.reset_index(drop=True)
+        self.maximums = maximums.reset_index(drop=True)
+
+    def __len__(self):
+        return len(self.first_rows)
+
+    def shift(self, rows: int):
+        self.first_rows = self.first_rows + rows
+
+    def extend(self, other: 'ZoneMap'):
+        """
+        Append the blocks of a later part of the file. A column inferred as
+        numeric in one part and text in the other can no longer be pruned.
+        """
+        for column, kind in other.kinds.items():
+            if self.kinds.setdefault(column, kind) != kind:
+                self.kinds[column] = 'mixed'
+        self.first_rows = np.concatenate([self.first_rows, other.first_rows])
+        self.row_counts = np.concatenate([self.row_counts, other.row_counts])
+        self.minimums = pd.concat([self.minimums, other.minimums], ignore_index=True)
+        self.maximums = pd.concat([self.maximums, other.maximums], ignore_index=True)
+
+    def parse_bound(self, column: str, value):
+        """
+        Convert a query bound to the comparison type of ``column``.
+
+        Raises:
+            ValueError: A numeric column got a bound that is not a number
+        """
+        kind = self.kinds.get(column)
+        if value is None or kind == 'text':
+            return value
+        if kind == 'mixed':
+            try:
+                return float(value)
+            except ValueError:
+                return value
+        return float(value)
+
+    def overlapping_blocks(self, column: str, low=None, high=None) -> np.ndarray:
+        """
+        Positions of the blocks that may hold values of ``column`` in
+        [low, high]; a missing bound is open.
+        """
+        if self.kinds.get(column) == 'mixed':
+            return np.flatnonzero(self.row_counts > 0)
+        minimums, maximums = self.minimums[column], self.maximums[column]
+        present = (minimums.notna() & maximums.notna()).to_numpy()
+        mask = present.copy()
+        if high is not None:
+            mask[present] &= (minimums[present] <= high).to_numpy()
+        if low is not None:
+            mask[present] &= (maximums[present] >= low).to_numpy()
+        return np.flatnonzero(mask)
+
+    def in_range(self, series: pd.Series, column: str, low=None, high=None) -> pd.Series:
+        """
+        Row mask of the values of ``series`` within [low, high].
+        """
+        kind = self.kinds.get(column)
+        if kind == 'mixed':
+            kind = 'numeric' if isinstance(low if low is not None else high, float) else 'text'
+        values = _comparable(series, kind)
+        mask = pd.Series(True, index=values.index)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask.reindex(series.index, fill_value=False)
+
+    def save(self, path: str):
+        state = {
+            'kinds': self.kinds,
+            'first_rows': self.first_rows,
+            'row_counts': self.row_counts,
+            'minimums': self.minimums,
+            'maximums': self.maximums,
+        }
+        pd.to_pickle(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ZoneMap':
+        state = pd.read_pickle(path)
+        return cls(state['kinds'], state['first_rows'], state['row_counts'], state['minimums'], state['maximums'])
+
+
+class ZoneMapCollector:
+    """
+    Ingest collector building the zone map of the rows it is fed. Column
+    kinds are decided on the first chunk; row numbers start at ``row_base``.
+    """
+
+    def __init__(self, block_rows: int = None, row_base: int = 0):
+        self.block_rows = block_rows or settings.CSV_ZONE_MAP_BLOCK_ROWS
+        self.row_base = row_base
+        self.rows = 0
+        self.kinds = {}
+        self._minimums = {}
+        self._maximums = {}
+
+    def update(self, chunk: pd.DataFrame):
+        if not self.kinds:
+            for column in chunk.columns:
+                dtype = chunk[column].dtype
+                numeric = pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                self.kinds[column] = 'numeric' if numeric else 'text'
+                self._minimums[column] = []
+                self._maximums[column] = []
+        blocks = pd.Series((self.rows + np.arange(len(chunk))) // self.block_rows, index=chunk.index)
+        for column, kind in self.kinds.items():
+            values = _comparable(chunk[column], kind)
+            grouped = values.groupby(blocks[values.index])
+            self._minimums[column].append(grouped.min())
+            self._maximums[column].append(grouped.max())
+        self.rows += len(chunk)
+
+    def zone_map(self) -> ZoneMap:
+        block_count = -(-self.rows // self.block_rows)
+        blocks = range(block_count)
+        minimums = pd.DataFrame(index=blocks)
+        maximums = pd.DataFrame(index=blocks)
+        for column in self.kinds:
+            parts = [part for part in self._minimums[column] if len(part)]
+            minimums[column] = pd.concat(parts).groupby(level=0).min().reindex(blocks) if parts else np.nan
+            parts = [part for part in self._maximums[column] if len(part)]
+            maximums[column] = pd.concat(parts).groupby(level=0).max().reindex(blocks) if parts else np.nan
+        first_rows = self.row_base + np.arange(block_count, dtype=np.int64) * self.block_rows
+        row_counts = np.minimum(self.block_rows, self.rows - (first_rows - self.row_base))
+        return ZoneMap(dict(self.kinds), first_rows, row_counts, minimums, maximums)
+
+
+def zone_map_path(file_path: str) -> str:
+    return artifact_path(file_path, ZONE_MAP_ARTIFACT)
+
+
+def load_zone_map(file_path: str):
+    """
+    The zone map of ``file_path``, or None if it was not built.
+    """
+    path = zone_map_path(file_path)
+    if not os.path.exists(path):
+        return None
+    return ZoneMap.load(path)
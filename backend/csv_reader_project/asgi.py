@@ -0,0 +1,11 @@
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'csv_reader_project.settings')
+
+django.setup(set_prefix=False)
+
+from csv_processor.handlers import DisconnectAwareASGIHandler  # noqa: E402
+
+application = DisconnectAwareASGIHandler()
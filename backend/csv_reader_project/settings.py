@@ -29,6 +29,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'csv_processor.middleware.RequestMetricsMiddleware',
+    'csv_processor.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'csv_reader_project.urls'
@@ -50,6 +52,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'csv_reader_project.wsgi.application'
+ASGI_APPLICATION = 'csv_reader_project.asgi.application'
 
 DATABASES = {
     'default': {
@@ -100,6 +103,13 @@ CORS_ALLOWED_ORIGINS = [
 CORS_ALLOW_ALL_ORIGINS = True
 
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
+# Larger uploads are spooled to FILE_UPLOAD_TEMP_DIR (system temp by default),
+# hashed as they stream in and renamed into place, so keep it on the same
+# filesystem as the upload directory
+FILE_UPLOAD_HANDLERS = [
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'csv_processor.uploads.HashingTemporaryFileUploadHandler',
+]
 
 # Celery Configuration
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
@@ -108,6 +118,175 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+CELERY_TASK_TRACK_STARTED = True
+# Ingests run for minutes; a worker should not hold messages it cannot start yet
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ROUTES = {
+    'csv_processor.tasks.process_csv_range': {'queue': 'ingest_large'},
+    'csv_processor.tasks.merge_csv_ranges': {'queue': 'ingest_large'},
+    'csv_processor.tasks.partition_diff_range': {'queue': 'ingest_large'},
+    'csv_processor.tasks.diff_partition': {'queue': 'ingest_large'},
+    'csv_processor.tasks.finish_diff': {'queue': 'ingest_large'},
+}
+# Run `celery -A csv_reader_project beat` next to the workers for these
+CELERY_BEAT_SCHEDULE = {
+    'purge-deleted-files': {
+        'task': 'csv_processor.tasks.purge_deleted_files',
+        'schedule': 10.0,
+    },
+    'enforce-storage-limits': {
+        'task': 'csv_processor.tasks.enforce_storage_limits',
+        'schedule': 60.0,
+    },
+    'reconcile-storage': {
+        'task': 'csv_processor.tasks.reconcile_storage',
+        'schedule': 15 * 60.0,
+    },
+}
+
+# Prometheus: export PROMETHEUS_MULTIPROC_DIR (an empty, writable directory)
+# for both Django and Celery processes so /metrics aggregates all workers.
+
+# Distributed ingest: files at or above the threshold are split into
+# record-aligned byte ranges and processed by a Celery chord
+CSV_DISTRIBUTED_INGEST_THRESHOLD = 2 * 1024 ** 3  # 2GB
+CSV_DISTRIBUTED_RANGE_BYTES = 256 * 1024 ** 2  # target size of one range task
+CSV_DISTRIBUTED_RANGE_RETRIES = 3
+CSV_ROW_INDEX_STRIDE = 1024  # rows between row index checkpoints
+
+# Ingest scheduling: uploads go to the first queue whose size limit (bytes,
+# exclusive) they are under, each served by its own workers, e.g.
+#   celery -A csv_reader_project worker -Q ingest_small -c 8
+#   celery -A csv_reader_project worker -Q ingest_large -c 2
+# Ingests of CSV_INGEST_ADMISSION_MIN_BYTES or more share a budget of
+# CSV_INGEST_MAX_BYTES in flight (tracked in Redis) and are retried every
+# CSV_INGEST_ADMISSION_RETRY_SECONDS until they fit
+CSV_INGEST_QUEUES = [
+    (64 * 1024 ** 2, 'ingest_small'),
+    (2 * 1024 ** 3, 'ingest_medium'),
+    (None, 'ingest_large'),
+]
+CSV_INGEST_ADMISSION_MIN_BYTES = 64 * 1024 ** 2
+CSV_INGEST_MAX_BYTES = 8 * 1024 ** 3
+CSV_INGEST_ADMISSION_RETRY_SECONDS = 15
+CSV_INGEST_RESERVATION_TTL = 6 * 60 * 60  # seconds, frees reservations of crashed workers
+CSV_INGEST_CANCEL_CHECK_SECONDS = 1.0  # how often a running ingest checks for deletion
+CSV_WATERMARK_INTERVAL_SECONDS = 1.0  # how often a running ingest publishes its readable rows
+
+# Storage manager: files of CSV_STORAGE_DEFERRED_DELETE_BYTES or more are
+# deleted in the background; unreferenced entries older than the grace period
+# are removed; when the disk (or the quota of the upload directories) is
+# fuller than the high watermark, artifacts and then files are evicted by
+# last access until it is back under the low watermark. Uploads are refused
+# with 507 unless CSV_STORAGE_UPLOAD_OVERHEAD times their size fits with
+# CSV_STORAGE_MIN_FREE_BYTES to spare.
+CSV_STORAGE_DIRS = ['/tmp/csv_uploads', '/tmp/csv_temp_uploads']
+CSV_STORAGE_DEFERRED_DELETE_BYTES = 64 * 1024 ** 2
+CSV_STORAGE_ORPHAN_GRACE_SECONDS = 24 * 60 * 60
+CSV_STORAGE_QUOTA_BYTES = None  # no quota, only the disk watermarks
+CSV_STORAGE_HIGH_WATERMARK = 0.90
+CSV_STORAGE_LOW_WATERMARK = 0.80
+CSV_STORAGE_EVICT_FILES = True  # False: only evict rebuildable artifacts
+CSV_STORAGE_MIN_IDLE_SECONDS = 60 * 60  # never evict what was used more recently
+CSV_STORAGE_ACCESS_RESOLUTION_SECONDS = 60
+CSV_STORAGE_UPLOAD_OVERHEAD = 1.5
+CSV_STORAGE_MIN_FREE_BYTES = 1024 ** 3
+CSV_STORAGE_USAGE_MAX_AGE = 30  # seconds the upload check reuses the size of the storage dirs
+
+# Column distributions built at ingest
+CSV_HISTOGRAM_BINS = 64
+CSV_TOP_K_VALUES = 20
+
+# Blocking endpoints run on bounded thread pools, one for reads (pages,
+# stats, samples, queries) and one for uploads and appends; beyond
+# workers + queue requests get 503 with Retry-After (seconds)
+CSV_READ_EXECUTOR_WORKERS = 8
+CSV_READ_EXECUTOR_QUEUE = 32
+CSV_WRITE_EXECUTOR_WORKERS = 4
+CSV_WRITE_EXECUTOR_QUEUE = 8
+CSV_EXECUTOR_RETRY_AFTER = 2
+
+# Redis used on the request path (single-flight locks); optional, requests
+# fall back to process-local behaviour for CSV_REDIS_RETRY_SECONDS after an error
+CSV_REDIS_URL = 'redis://localhost:6379/1'
+CSV_REDIS_RETRY_SECONDS = 30
+
+# Per-process cache of completed file records and LRU pool of mapped files
+# for the page request path, invalidated through Redis pub/sub
+CSV_FILE_CACHE_SIZE = 10000  # records
+CSV_FILE_CACHE_TTL = 300  # seconds, bounds staleness if a message is lost
+CSV_FILE_CACHE_CHANNEL = 'csv:file-invalidated'
+CSV_FILE_HANDLE_POOL_SIZE = 64  # mapped files
+
+# Identical concurrent page reads share one parse within a process; other
+# processes wait (through a Redis lock) for it to finish before parsing.
+# Pages sliced from a pooled mapping skip Redis
+CSV_SINGLE_FLIGHT_WAIT_SECONDS = 60
+CSV_SINGLE_FLIGHT_POLL_SECONDS = 0.02
+
+# Chunk sizing: rows per parsed chunk are chosen so a chunk takes about
+# CSV_CHUNK_MEMORY_BUDGET bytes, measured on the chunks read so far. The
+# budget shrinks to CSV_CHUNK_AVAILABLE_FRACTION of the memory still
+# available. Before the first chunk, parsed rows are assumed to take
+# CSV_CHUNK_PARSE_EXPANSION times their raw size.
+CSV_CHUNK_MEMORY_BUDGET = 128 * 1024 ** 2
+CSV_CHUNK_AVAILABLE_FRACTION = 0.25
+CSV_CHUNK_PARSE_EXPANSION = 5
+CSV_CHUNK_INITIAL_ROWS = 10000
+CSV_CHUNK_MIN_ROWS = 100
+CSV_CHUNK_MAX_ROWS = 1_000_000
+
+# Zone maps: per-block column min/max recorded at ingest for range lookups
+CSV_ZONE_MAP_BLOCK_ROWS = 16384
+CSV_RANGE_MAX_ROWS = 10000  # largest limit one range lookup may ask for
+
+# Key indexes for point lookups: (hash, row) pairs sorted in memory up to
+# CSV_KEY_INDEX_RUN_ROWS, beyond that spilled as sorted runs and merged
+CSV_KEY_INDEX_RUN_ROWS = 8_000_000
+CSV_KEY_LOOKUP_MAX_ROWS = 10000  # largest limit one key lookup may ask for
+
+# File diffs: both inputs are spilled to hash partitions of about this many
+# bytes, each diffed in memory by its own task
+CSV_DIFF_PARTITION_BYTES = 128 * 1024 ** 2
+CSV_DIFF_MIN_PARTITIONS = 4
+CSV_DIFF_STALL_SECONDS = 6 * 60 * 60  # a diff running longer is started again
+
+# Ingest validation: entries kept in a bad-row index (counts stay exact
+# beyond it)
+CSV_VALIDATION_MAX_ENTRIES = 1_000_000
+
+# Computed columns and filters: expression size limits, and the most
+# computed columns one file may have
+CSV_EXPRESSION_MAX_LENGTH = 2000  # characters
+CSV_EXPRESSION_MAX_NODES = 200
+CSV_COMPUTED_COLUMNS_MAX = 50
+CSV_COMPUTED_PREVIEW_ROWS = 100  # rows a new definition is tried on
+
+# Random sampling: rows kept in the ingest-time reservoir, and the largest
+# sample one request may ask for
+CSV_RESERVOIR_SIZE = 10000
+CSV_SAMPLE_MAX = 100000
+
+# Group-by aggregation: groups kept in memory before spilling to disk
+CSV_AGGREGATE_MAX_GROUPS = 1_000_000
+CSV_AGGREGATE_SPILL_PARTITIONS = 16
+
+# Read-only SQL endpoint: per-query limits and where results are kept
+CSV_SQL_RESULT_DIR = '/tmp/csv_sql_results'
+CSV_SQL_RESULT_TTL = 24 * 60 * 60  # seconds
+CSV_SQL_TIMEOUT_SECONDS = 300
+CSV_SQL_MEMORY_LIMIT = 512 * 1024 ** 2  # SQLite heap limit while a query runs
+CSV_SQL_CACHE_KB = 64 * 1024
+CSV_SQL_MAX_RESULT_ROWS = 10_000_000
+CSV_SQL_FETCH_ROWS = 10000
+CSV_SQL_MAX_LENGTH = 100_000  # characters
+
+# Opt-in profiling: X-CSV-Profile request header or profile= task argument
+CSV_PROFILING_ENABLED = True
+CSV_PROFILE_STAFF_ONLY = True  # ignore the header from non-staff users
+CSV_PROFILE_DIR = '/tmp/csv_profiles'
+CSV_PROFILE_RETENTION = 50  # newest profiles kept on disk
+CSV_PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples
 
 # Logging Configuration
 LOGGING = {
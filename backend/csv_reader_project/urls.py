@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.urls import path, include
+from csv_processor import views as csv_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('csv_processor.urls')),
+    path('metrics', csv_views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -3,4 +3,4 @@ echo "Starting Django backend..."
 cd backend
 pip install -r requirements.txt
 python3 manage.py migrate
-python3 manage.py runserver
\ No newline at end of file
+python3 -m uvicorn csv_reader_project.asgi:application --reload --port 8000
\ No newline at end of file
@@ -27,7 +27,7 @@ echo "  python3 manage.py runserver"
 echo ""
 echo "To run Celery worker (in another terminal):"
 echo "  cd backend"
-echo "  celery -A csv_reader_project worker --loglevel=info"
+echo "  celery -A csv_reader_project worker -Q celery,ingest_small,ingest_medium,ingest_large --loglevel=info"
 echo ""
 echo "To run the frontend:"
 echo "  cd frontend"